@@ -58,3 +58,60 @@ def nostdout():
     sys.stdout = StringIO()
     yield
     sys.stdout = save_stdout
+
+
+def get_n_jobs(n_jobs=1):
+    """
+    Number of processes to use for a given n_jobs, within the CPU budget
+
+    As in joblib, n_jobs < 0 counts back from the number of cpus
+    (-1 = all cpus). The budget is the number of cpus, lowered to
+    NEUROPYPE_EPHY_MAX_JOBS if this environment variable is set (e.g. to the
+    number of cpus divided by the number of nipype MultiProc processes), so
+    that nested parallelism does not oversubscribe the machine.
+    """
+    import multiprocessing
+
+    n_cpus = multiprocessing.cpu_count()
+
+    budget = n_cpus
+    if os.environ.get('NEUROPYPE_EPHY_MAX_JOBS'):
+        budget = min(budget, max(1, int(os.environ['NEUROPYPE_EPHY_MAX_JOBS'])))
+
+    if n_jobs is None or n_jobs == 0:
+        n_jobs = 1
+    elif n_jobs < 0:
+        n_jobs = max(1, n_cpus + 1 + n_jobs)
+
+    return min(n_jobs, budget)
+
+
+def get_float_dtype(precision='float64'):
+    """
+    numpy float dtype for a precision option, 'float32' (or 'single') or 'float64' (or 'double')
+    """
+    import numpy as np
+
+    dtypes = {'float32': np.float32, 'single': np.float32, 'f': np.float32,
+              'float64': np.float64, 'double': np.float64, 'float': np.float64}
+
+    if precision not in dtypes:
+        raise ValueError("precision should be 'float32' or 'float64', not {}".format(precision))
+
+    return np.dtype(dtypes[precision])
+
+
+def cast_to_precision(data, precision='float64'):
+    """
+    Cast real or complex data to single or double precision (no copy if already the case)
+
+    Complex data is cast to complex64 or complex128
+    """
+    import numpy as np
+
+    dtype = get_float_dtype(precision)
+
+    if np.iscomplexobj(data):
+        dtype = np.result_type(dtype, np.complex64)
+
+    return np.asarray(data).astype(dtype, copy=False)
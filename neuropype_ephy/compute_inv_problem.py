@@ -147,7 +147,6 @@ def compute_ROIs_inv_sol(raw_filename, sbj_id, sbj_dir, fwd_filename, cov_fname,
     import os.path as op
     import numpy as np
     import mne
-    import pickle
 
     from mne.io import Raw
     from mne.minimum_norm import make_inverse_operator, apply_inverse_raw
@@ -157,6 +156,7 @@ def compute_ROIs_inv_sol(raw_filename, sbj_id, sbj_dir, fwd_filename, cov_fname,
 
     from neuropype_ephy.compute_inv_problem import get_aseg_labels
     from neuropype_ephy.preproc import create_reject_dict
+    from neuropype_ephy.labels_store import save_labels_store
     
     print '\n*** READ raw filename %s ***\n' % raw_filename
     raw = Raw(raw_filename)
@@ -273,11 +273,7 @@ def compute_ROIs_inv_sol(raw_filename, sbj_id, sbj_dir, fwd_filename, cov_fname,
     print labels[0].pos
     print len(labels)
 
-    labels_file = op.abspath('labels.dat')
-    with open(labels_file, "wb") as f:
-        pickle.dump(len(labels), f)
-        for value in labels:
-            pickle.dump(value, f)
+    labels_file = save_labels_store(op.abspath('labels.npz'), labels)
 
     label_names_file = op.abspath('label_names.txt')
     label_coords_file = op.abspath('label_coords.txt')
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed disk cache of connectivity results
+
+Entries are keyed by a hash of the time series content (not of the file
+path or timestamp) and of the parameters of the computation, so that a node
+rerun on identical data returns the cached files. Each entry is a directory
+with the result files and a manifest; the least recently used entries are
+removed when the cache exceeds max_size (in MB).
+
+Keys start with CACHE_VERSION, which is increased whenever the results of the
+computations change (or the format of the entries), so that entries of
+previous versions are never returned (they are removed as the least recently
+used ones).
+"""
+
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def get_conmat_cache_dir():
+    """
+    Default cache directory, NEUROPYPE_EPHY_CONMAT_CACHE_DIR or ~/.neuropype_ephy/conmat_cache
+    """
+    return os.environ.get('NEUROPYPE_EPHY_CONMAT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.neuropype_ephy', 'conmat_cache'))
+
+
+def hash_array_file(array_file, block_size=2 ** 24):
+    """
+    sha1 of the content of an array file (.npy), read by blocks of about block_size bytes
+    """
+    import hashlib
+
+    data = np.load(array_file, mmap_mode='r')
+
+    sha = hashlib.sha1()
+
+    sha.update('{}{}'.format(data.shape, data.dtype.str).encode())
+
+    if data.ndim == 0 or data.size == 0:
+        sha.update(np.ascontiguousarray(data).tobytes())
+        return sha.hexdigest()
+
+    step = max(1, block_size // max(1, data[0].nbytes))
+
+    for start in range(0, data.shape[0], step):
+        sha.update(np.ascontiguousarray(data[start:start + step]).tobytes())
+
+    return sha.hexdigest()
+
+
+def hash_params(params):
+    """
+    sha1 of a dict of parameters (values are compared by their repr)
+    """
+    import hashlib
+
+    return hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()
+
+
+class ConmatCache(object):
+    """
+    LRU disk cache of result files, keyed by data and parameters hashes
+
+    Example:
+
+    >> cache = ConmatCache('/tmp/conmat_cache', max_size = 1000)
+    >> key = cache.make_key(ts_file, {'con_method': 'coh', 'freq_band': [8, 12]})
+    >> outputs = cache.get(key)    # None on a miss, else output files copied in the current directory
+    >> cache.put(key, {'conmat_file': conmat_file})
+
+    hits and misses count the lookups
+    """
+    def __init__(self, cache_dir, max_size=1000.):
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, data_file, params):
+
+        return 'v{}_'.format(CACHE_VERSION) + hash_array_file(data_file) + '_' + hash_params(params)
+
+    def _get_entry_dir(self, key):
+
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, out_dir=None):
+        """
+        Copy the files of entry key in out_dir (default, current directory)
+
+        Returns a dict of output names to file paths (or lists of file paths), or None if key is not cached
+        """
+        import json
+        import shutil
+
+        entry_dir = self._get_entry_dir(key)
+        manifest_file = os.path.join(entry_dir, 'manifest.json')
+
+        if not os.path.exists(manifest_file):
+
+            self.misses += 1
+            print "conmat cache miss ({})".format(key)
+
+            return None
+
+        self.hits += 1
+        print "conmat cache hit ({})".format(key)
+
+        if out_dir is None:
+            out_dir = os.getcwd()
+
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+        for fname in manifest['files']:
+            shutil.copy(os.path.join(entry_dir, fname), os.path.join(out_dir, fname))
+
+        ### most recently used
+        os.utime(manifest_file, None)
+
+        outputs = {}
+
+        for name, value in manifest['outputs'].items():
+
+            if isinstance(value, list):
+                outputs[name] = [os.path.join(out_dir, fname) for fname in value]
+            else:
+                outputs[name] = os.path.join(out_dir, value)
+
+        return outputs
+
+    def put(self, key, outputs, extra_files=[]):
+        """
+        Store output files (dict of output names to file paths or lists of file paths)
+        and extra_files under key, then evict least recently used entries
+        """
+        import json
+        import shutil
+
+        entry_dir = self._get_entry_dir(key)
+
+        if os.path.exists(entry_dir):
+            return
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        files = []
+        manifest_outputs = {}
+
+        for name, value in outputs.items():
+
+            if isinstance(value, list):
+                files.extend(value)
+                manifest_outputs[name] = [os.path.basename(fname) for fname in value]
+            else:
+                files.append(value)
+                manifest_outputs[name] = os.path.basename(value)
+
+        files.extend(extra_files)
+
+        ### write then rename, so that concurrent processes never read a partial entry
+        tmp_dir = entry_dir + '.{}.tmp'.format(os.getpid())
+        os.makedirs(tmp_dir)
+
+        for fname in files:
+            shutil.copy(fname, tmp_dir)
+
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump({'outputs': manifest_outputs, 'files': [os.path.basename(fname) for fname in files]}, f)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            ### stored meanwhile by another process
+            shutil.rmtree(tmp_dir)
+
+        self.evict()
+
+    def get_entries(self):
+        """
+        Cached entries as (last use time, size in bytes, entry dir), least recently used first
+        """
+        entries = []
+
+        if not os.path.exists(self.cache_dir):
+            return entries
+
+        for key in os.listdir(self.cache_dir):
+
+            entry_dir = self._get_entry_dir(key)
+            manifest_file = os.path.join(entry_dir, 'manifest.json')
+
+            if not os.path.exists(manifest_file):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry_dir, fname)) for fname in os.listdir(entry_dir))
+
+            entries.append((os.path.getmtime(manifest_file), size, entry_dir))
+
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is smaller than max_size MB
+        (the most recent entry is always kept)
+        """
+        import shutil
+
+        entries = self.get_entries()
+
+        total_size = sum(size for mtime, size, entry_dir in entries)
+
+        for mtime, size, entry_dir in entries[:-1]:
+
+            if total_size <= self.max_size * 1024 ** 2:
+                break
+
+            print "conmat cache eviction ({})".format(os.path.basename(entry_dir))
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+            total_size -= size
+
+    def stats(self):
+
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.get_entries())}
+
+    def __repr__(self):
+
+        return 'ConmatCache(size = {size}, hits = {hits}, misses = {misses})'.format(**self.stats())
@@ -2,23 +2,70 @@
 
 from neuropype_ephy.aux_tools import nostdout
 
-def ep2ts(fif_file):
+def get_ch_type_picks(info, ch_types=('meg',)):
+    """Indexes of the channels of the given types ('meg', 'mag', 'grad',
+    'eeg', 'eog', 'ecg', 'seeg'...), bad channels being excluded
+    """
+    from mne import pick_types
+
+    ch_types = list(ch_types)
+
+    kwargs = dict([(ch_type, True) for ch_type in ch_types
+                   if ch_type not in ('meg', 'mag', 'grad')])
+
+    if 'meg' in ch_types or ('mag' in ch_types and 'grad' in ch_types):
+        kwargs['meg'] = True
+    elif 'mag' in ch_types:
+        kwargs['meg'] = 'mag'
+    elif 'grad' in ch_types:
+        kwargs['meg'] = 'grad'
+    else:
+        kwargs['meg'] = False
+
+    return pick_types(info, exclude='bads', **kwargs)
+
+
+def ep2ts(fif_file, precision='float64', ch_types=('meg',), chunk_size=None):
     """Read fif file with raw data or epochs and save
-    timeseries to .npy
+    timeseries to .npy, in single ('float32') or double ('float64') precision
+
+    Channels of ch_types are kept (default, MEG channels). If chunk_size is
+    set, epochs are read chunk_size at a time and written in a memory-mapped
+    .npy file of the final shape, so that epochs are never all in memory
     """
     from mne import read_epochs
-    from mne import pick_types
 
     from numpy import save
+    from numpy.lib.format import open_memmap
     import os.path as op
 
+    from neuropype_ephy.aux_tools import cast_to_precision, get_float_dtype
+
+    save_path = op.abspath('ts_epochs.npy')
+
     with nostdout():
-        epochs = read_epochs(fif_file)
+        epochs = read_epochs(fif_file, preload=chunk_size is None)
 
-    epochs_meg = epochs.pick_types(meg=True, eeg=False, eog=False, ecg=False)
+    picks = get_ch_type_picks(epochs.info, ch_types)
 
-    data = epochs_meg.get_data()
-    save_path = op.abspath('ts_epochs.npy')
-    save(save_path, data)
-    return save_path
+    if chunk_size is None:
+        epochs.pick_channels([epochs.ch_names[pick] for pick in picks])
+        data = cast_to_precision(epochs.get_data(), precision)
+        save(save_path, data)
+        return save_path
+
+    ### bad epochs are known only once they have been read
+    with nostdout():
+        epochs.drop_bad()
+
+    ts = open_memmap(save_path, mode='w+', dtype=get_float_dtype(precision),
+                     shape=(len(epochs), len(picks), len(epochs.times)))
+
+    for start in range(0, len(epochs), chunk_size):
+        with nostdout():
+            ts[start:start + chunk_size] = epochs[start:start + chunk_size].get_data()[:, picks]
 
+    ts.flush()
+    del ts
+
+    return save_path
@@ -64,29 +64,82 @@ def import_mat_to_conmat(mat_file,orig_channel_names_file,orig_channel_coords_fi
 
     return conmat_file,channel_coords_file,channel_names_file
 
-def import_tsmat_to_ts(tsmat_file,data_field_name = 'F', good_channels_field_name = 'ChannelFlag'):
-    #,orig_channel_names_file,orig_channel_coords_file):
-
-    import os
+def is_mat_v73(mat_file):
+    """
+    True if mat_file is a matlab v7.3 file (HDF5 format, after a 512 bytes header)
+    """
+    with open(mat_file,'rb') as f:
+        f.seek(512)
+        return f.read(8) == b'\x89HDF\r\n\x1a\n'
+
+def read_h5mat_ts(tsmat_file,data_field_name = 'F',good_channels_field_name = 'ChannelFlag',precision = 'float32',block_size = 2 ** 24):
+    """
+    Read the (nb_channels, nb_timepoints) field of a v7.3 .mat file with h5py,
+    keeping only good channels (good_channels_field_name == 1, or all channels if None)
+
+    Only the two fields are read. As matlab arrays are stored in column-major
+    order, the dataset is (nb_timepoints, nb_channels) in the file, and is read
+    by blocks of timepoints (about block_size values), good channels only.
+    """
     import numpy as np
+    import h5py
 
-    import mne
+    from neuropype_ephy.aux_tools import get_float_dtype
 
-    from mne.io import RawArray	
-    from nipype.utils.filemanip import split_filename as split_f
+    with h5py.File(tsmat_file,'r') as mat:
+
+        dset = mat[data_field_name]
+
+        nb_timepoints,nb_channels = dset.shape
+
+        if good_channels_field_name != None:
+            good_channels = np.array(mat[good_channels_field_name]).reshape(-1)
+            good_indexes = np.where(good_channels == 1)[0]
+        else:
+            good_indexes = np.arange(nb_channels)
+
+        good_data = np.empty((len(good_indexes),nb_timepoints),dtype = get_float_dtype(precision))
+
+        step = max(1,block_size // max(1,nb_channels))
+
+        for start in range(0,nb_timepoints,step):
+
+            if len(good_indexes) == nb_channels:
+                block = dset[start:start + step]
+            else:
+                block = dset[start:start + step,list(good_indexes)]
+
+            good_data[:,start:start + step] = block.T
+
+    return good_data
+
+def read_tsmat(tsmat_file,data_field_name = 'F',good_channels_field_name = 'ChannelFlag',precision = 'float32'):
+    """
+    Read the (nb_channels, nb_timepoints) field of a .mat file, keeping only
+    good channels (good_channels_field_name == 1, or all channels if None)
+
+    v7.3 files are read lazily with h5py (see read_h5mat_ts), other versions
+    with loadmat, loading only these two fields
+    """
+    import numpy as np
+
+    from neuropype_ephy.aux_tools import get_float_dtype
 
     from scipy.io import loadmat
-    print tsmat_file
-        
-    subj_path,basename,ext = split_f(tsmat_file)
 
-    mat = loadmat(tsmat_file)
+    if is_mat_v73(tsmat_file):
+        print "Reading v7.3 (HDF5) mat file"
+        return read_h5mat_ts(tsmat_file,data_field_name,good_channels_field_name,precision)
 
-    raw_data = np.array(mat[data_field_name],dtype = "f")
+    variable_names = [data_field_name]
+    if good_channels_field_name != None:
+        variable_names.append(good_channels_field_name)
+
+    mat = loadmat(tsmat_file,variable_names = variable_names)
+
+    raw_data = np.array(mat[data_field_name],dtype = get_float_dtype(precision))
     print raw_data.shape
 
-    print [key for key in mat.keys()]
-    
     if good_channels_field_name != None:
         
         print "Using good channels to sort channels"
@@ -105,6 +158,20 @@ def import_tsmat_to_ts(tsmat_file,data_field_name = 'F', good_channels_field_nam
     else:
         print "No channel sorting" 
         good_data = raw_data
+
+    return good_data
+
+def import_tsmat_to_ts(tsmat_file,data_field_name = 'F', good_channels_field_name = 'ChannelFlag', precision = 'float32'):
+    #,orig_channel_names_file,orig_channel_coords_file):
+
+    import os
+    import numpy as np
+
+    from neuropype_ephy.import_mat import read_tsmat
+
+    print tsmat_file
+
+    good_data = read_tsmat(tsmat_file,data_field_name,good_channels_field_name,precision)
         
     #### save data
     print good_data.shape
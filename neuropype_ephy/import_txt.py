@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 
 
-def split_txt(sample_size,txt_file,sep_label_name, repair = True, sep = ";"):
+def split_txt(sample_size,txt_file,sep_label_name, repair = True, sep = ";", precision = 'float64'):
 
     import os
 
     import numpy as np
     import pandas as pd
 
+    from neuropype_ephy.aux_tools import get_float_dtype
+
     if repair == True:
         
         df_data = []
@@ -102,7 +104,7 @@ def split_txt(sample_size,txt_file,sep_label_name, repair = True, sep = ";"):
 
     print splitted_ts[0]
 
-    np_splitted_ts = np.array(splitted_ts,dtype = 'float')
+    np_splitted_ts = np.array(splitted_ts,dtype = get_float_dtype(precision))
 
     print np_splitted_ts.shape
 
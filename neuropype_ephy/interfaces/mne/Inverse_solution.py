@@ -73,7 +73,7 @@ class InverseSolutionConnInputSpec(BaseInterfaceInputSpec):
 class InverseSolutionConnOutputSpec(TraitedSpec):
 
     ts_file = File(exists=False, desc='source reconstruction in .npy format')
-    labels = File(exists=False, desc='labels file in pickle format')
+    labels = File(exists=False, desc='labels file in .npz format (see labels_store)')
     label_names = File(exists=False, desc='labels name file in txt format')
     label_coords = File(exists=False, desc='labels coords file in txt format')
 
@@ -1,3 +1,3 @@
 from .spectral import (SpectralConn)
-from .power import (Power)
+from .power import (Power, TFRPower)
 from .preproc import (CompIca)
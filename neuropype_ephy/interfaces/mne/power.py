@@ -3,28 +3,47 @@ Power computation module
 """
 
 from nipype.interfaces.base import BaseInterface, \
-    BaseInterfaceInputSpec, traits, File, TraitedSpec
+    BaseInterfaceInputSpec, traits, File, TraitedSpec, isdefined
 from nipype.utils.filemanip import split_filename
 
 import nibabel as nbconvert
 import numpy as np
 import os
 
-from neuropype_ephy.power import compute_and_save_psd
+from neuropype_ephy.power import compute_and_save_psd, compute_and_save_band_power, compute_and_save_tfr
 
 class PowerInputSpec(BaseInterfaceInputSpec):
-    epochs_file = traits.File(exists=True, desc='File with mne.Epochs', mandatory=True)
-    fmin = traits.Float(desc='lower psd frequency', mandatory=False)
-    fmax = traits.Float(desc='higher psd frequency', mandatory=False)
-    method = traits.Enum('welch', 'multitaper', desc='power spectral density computation method')
+    epochs_file = traits.File(exists=True, desc='File with mne.Epochs (-epo.fif), or with mne.io.Raw', mandatory=True, xor=['epochs_files'])
+    epochs_files = traits.List(traits.File(exists=True), desc='Files with mne.Epochs (or mne.io.Raw) of several subjects, summarized in band powers (freq_bands is then mandatory)', mandatory=True, xor=['epochs_file'])
+    freq_bands = traits.Dict(traits.String, traits.List(traits.Float), desc='frequency bands {name: [f_lower, f_upper]}; band powers are saved instead of psds', mandatory=False)
+    fmin = traits.Float(0., desc='lower psd frequency', usedefault=True)
+    fmax = traits.Float(120., desc='higher psd frequency', usedefault=True)
+    method = traits.Enum('welch', 'multitaper', desc='power spectral density computation method (raw files support welch only)', usedefault=True)
+    n_fft = traits.Int(256, desc='length of welch segments', usedefault=True)
+    n_overlap = traits.Int(0, desc='overlap of welch segments', usedefault=True)
+    picks = traits.List(traits.Int, desc='indexes of the channels (default, MEG channels)', mandatory=False)
+    proj = traits.Bool(False, desc='apply SSP projections', usedefault=True)
+    n_jobs = traits.Int(1, desc='number of processes (channels are spread over them)', usedefault=True)
+    chunk_size = traits.Int(32, desc='number of epochs (or of welch segments for raw files) read at once', usedefault=True)
+    bandwidth = traits.Float(desc='bandwidth of the multitaper tapers in Hz (default, half-bandwidth of 4), epochs files only', mandatory=False)
+    adaptive = traits.Bool(False, desc='combine multitaper spectra with adaptive weights, epochs files only', usedefault=True)
 
 
 class PowerOutputSpec(TraitedSpec):
     psds_file = File(exists=True, desc='psd tensor and frequencies in .npz format')
+    band_power_file = File(exists=True, desc='band powers (files, epochs, channels, bands) in .npz format')
 
 class Power(BaseInterface):
     """
-    Compute power spectral density on epochs
+    Compute power spectral density on epochs (psd of each epoch), or on raw
+    data (welch psd of the whole recording), reading data by chunks
+
+    Raw files support method='welch' only (bandwidth and adaptive are
+    multitaper parameters, used for epochs files); epoch the data for a
+    multitaper psd
+
+    If freq_bands is set, psds of epochs_file (or of all epochs_files) are only
+    reduced to band powers, saved in a single band_power_file
     """
     input_spec = PowerInputSpec
     output_spec = PowerOutputSpec
@@ -35,10 +54,84 @@ class Power(BaseInterface):
         fmin = self.inputs.fmin
         fmax = self.inputs.fmax
         method = self.inputs.method
-        self.psds_file = compute_and_save_psd(epochs_file, fmin, fmax, method)
+        picks = self.inputs.picks if isdefined(self.inputs.picks) else None
+        bandwidth = self.inputs.bandwidth if isdefined(self.inputs.bandwidth) else None
+        self.psds_file = None
+        self.band_power_file = None
+
+        if isdefined(self.inputs.freq_bands):
+            if isdefined(self.inputs.epochs_files):
+                epochs_files = self.inputs.epochs_files
+            else:
+                epochs_files = [epochs_file]
+            # bands ordered by frequency
+            band_names = sorted(self.inputs.freq_bands.keys(),
+                                key=lambda name: self.inputs.freq_bands[name])
+            freq_bands = [self.inputs.freq_bands[name] for name in band_names]
+            self.band_power_file = compute_and_save_band_power(
+                epochs_files, freq_bands, band_names, fmin, fmax, method,
+                self.inputs.n_fft, self.inputs.n_overlap, picks,
+                self.inputs.proj, self.inputs.n_jobs,
+                chunk_size=self.inputs.chunk_size, bandwidth=bandwidth,
+                adaptive=self.inputs.adaptive)
+        elif isdefined(self.inputs.epochs_files):
+            raise ValueError('freq_bands should be set with epochs_files')
+        else:
+            self.psds_file = compute_and_save_psd(epochs_file, fmin, fmax,
+                                                  method, self.inputs.n_fft,
+                                                  self.inputs.n_overlap, picks,
+                                                  self.inputs.proj,
+                                                  self.inputs.n_jobs,
+                                                  chunk_size=self.inputs.chunk_size,
+                                                  bandwidth=bandwidth,
+                                                  adaptive=self.inputs.adaptive)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        if self.psds_file is not None:
+            outputs['psds_file'] = self.psds_file
+        if self.band_power_file is not None:
+            outputs['band_power_file'] = self.band_power_file
+        return outputs
+
+
+class TFRPowerInputSpec(BaseInterfaceInputSpec):
+    epochs_file = traits.File(exists=True, desc='File with mne.Epochs', mandatory=True)
+    freqs = traits.List(traits.Float, desc='frequencies of the morlet wavelets', mandatory=True)
+    n_cycles = traits.Either(traits.Float, traits.List(traits.Float), default=7., desc='number of cycles of the wavelets (or for each frequency)', usedefault=True)
+    decim = traits.Int(1, desc='decimation factor in time', usedefault=True)
+    picks = traits.List(traits.Int, desc='indexes of the channels (default, MEG channels)', mandatory=False)
+    proj = traits.Bool(False, desc='apply SSP projections', usedefault=True)
+    n_jobs = traits.Int(1, desc='number of processes (frequencies are spread over them)', usedefault=True)
+    chunk_size = traits.Int(32, desc='number of epochs read at once', usedefault=True)
+    precision = traits.Enum('float64', 'float32', desc='precision of the saved power', usedefault=True)
+
+
+class TFRPowerOutputSpec(TraitedSpec):
+    tfr_file = File(exists=True, desc='power (epochs, channels, freqs, times) in .npy format')
+    tfr_info_file = File(exists=True, desc='frequencies, times and channel names in .npz format')
+
+
+class TFRPower(BaseInterface):
+    """
+    Compute time-frequency (morlet wavelet) power on epochs, processed by
+    chunks and written in a memory-mapped .npy file (optionally decimated)
+    """
+    input_spec = TFRPowerInputSpec
+    output_spec = TFRPowerOutputSpec
+
+    def _run_interface(self, runtime):
+        print 'in TFRPower'
+        picks = self.inputs.picks if isdefined(self.inputs.picks) else None
+        self.tfr_file, self.tfr_info_file = compute_and_save_tfr(
+            self.inputs.epochs_file, self.inputs.freqs, self.inputs.n_cycles,
+            self.inputs.decim, picks, self.inputs.proj, self.inputs.n_jobs,
+            self.inputs.chunk_size, self.inputs.precision)
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['psds_file'] = self.psds_file
+        outputs['tfr_file'] = self.tfr_file
+        outputs['tfr_info_file'] = self.tfr_info_file
         return outputs
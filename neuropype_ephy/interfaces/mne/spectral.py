@@ -5,7 +5,6 @@ Definition of nodes for computing and plotting spectral connectivity
 """
 import numpy as np
 import os
-import pickle
 
 from nipype.interfaces.base import BaseInterface, \
     BaseInterfaceInputSpec, traits, File, TraitedSpec, isdefined
@@ -14,7 +13,9 @@ from nipype.utils.filemanip import split_filename as split_f
     
 ############################################################################################### SpectralConn #####################################################################################################
 
-from neuropype_ephy.spectral import compute_and_save_spectral_connectivity
+from neuropype_ephy.spectral import compute_and_save_spectral_connectivity, compute_and_save_multiband_spectral_connectivity, get_epochs_view, get_pair_indices
+from neuropype_ephy.conmat_cache import ConmatCache, get_conmat_cache_dir, hash_array_file
+from neuropype_ephy.aux_tools import cast_to_precision
 
 class SpectralConnInputSpec(BaseInterfaceInputSpec):
     
@@ -22,20 +23,60 @@ class SpectralConnInputSpec(BaseInterfaceInputSpec):
     
     sfreq = traits.Float(desc='sampling frequency', mandatory=True)
     
-    freq_band = traits.List(traits.Float(exists=True), desc='frequency bands', mandatory=True)
+    freq_band = traits.List(traits.Float(exists=True), desc='frequency bands', mandatory=True, xor = ['freq_bands'])
     
-    con_method = traits.Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased",desc='metric computed on time series for connectivity')
+    freq_bands = traits.List(traits.List(traits.Float), desc='list of frequency bands, computed in a single pass', mandatory=True, xor = ['freq_band'])
+    
+    freq_band_names = traits.List(traits.String, desc='names of the frequency bands (used in conmat file names)', mandatory=False)
+    
+    con_method = traits.Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased","aec","aec_orth",desc='metric computed on time series for connectivity')
+    
+    mode = traits.Enum("multitaper","cwt_morlet", desc='spectral estimation mode (cwt_morlet connectivity is averaged over time)', usedefault = True)
+    
+    cwt_freqs = traits.List(traits.Float, desc='frequencies of the morlet wavelets (default, 1Hz steps in each band)', mandatory=False)
+    
+    cwt_n_cycles = traits.Either(traits.Float, traits.List(traits.Float), desc='number of cycles of the morlet wavelets, fixed or one per frequency (default, frequency / 7)', mandatory=False)
     
     epoch_window_length = traits.Float(desc='epoched data', mandatory=False)
     
+    epoch_window_overlap = traits.Float(0.0, desc='overlap between consecutive epochs, in seconds (should be smaller than epoch_window_length)', usedefault = True)
+    
     export_to_matlab = traits.Bool(False, desc='If conmat is exported to .mat format as well',usedefault = True)
     
     index = traits.String("0",desc = "What to add to the name of the file" ,usedefault = True)
     
+    n_jobs = traits.Int(1, desc='number of processes (-1 for all cpus), within the NEUROPYPE_EPHY_MAX_JOBS budget', usedefault = True)
+    
+    streaming = traits.Bool(False, desc='If True, ts_file is memory-mapped and cross-spectra are accumulated by chunks of epochs (multitaper spectral methods only, ts_file should be epoched or epoch_window_length set)', usedefault = True)
+    
+    chunk_size = traits.Int(32, desc='number of epochs loaded at once in streaming mode', usedefault = True)
+    
+    packed_output = traits.Bool(False, desc='If True, conmats are saved in packed float32 triangle format (.npz)', usedefault = True)
+    
+    node_names_file = traits.File(exists=True, desc='node names in txt format (one per line), saved with packed conmats', mandatory=False)
+    
+    seed_indices = traits.List(traits.Int, desc='if set, connectivity is only computed between these nodes and target_indices, and saved in sparse (COO) .npz format (multitaper only)', mandatory=False, xor = ['pairs_file'])
+    
+    target_indices = traits.List(traits.Int, desc='targets of seed_indices (all nodes if not set)', mandatory=False, requires = ['seed_indices'])
+    
+    pairs_file = traits.File(exists=True, desc='pairs for which connectivity is computed, in .npy format: (2, n_pairs) indices or nodes * nodes mask; output is saved in sparse (COO) .npz format (multitaper only)', mandatory=False, xor = ['seed_indices'])
+    
+    use_cache = traits.Bool(False, desc='If True, results are cached on disk, keyed by the content of ts_file and the parameters', usedefault = True)
+    
+    cache_dir = traits.String(desc='cache directory (default, NEUROPYPE_EPHY_CONMAT_CACHE_DIR or ~/.neuropype_ephy/conmat_cache)', mandatory=False)
+    
+    cache_max_size = traits.Float(1000., desc='maximal size of the cache in MB, least recently used results are removed', usedefault = True)
+    
+    precision = traits.Enum('float64','float32', desc='precision of the computation (in streaming mode, the one of ts_file) and of the saved conmats', usedefault = True)
+    
 class SpectralConnOutputSpec(TraitedSpec):
     
     conmat_file = File(exists=True, desc="spectral connectivty matrix in .npy format")
     
+    conmat_files = traits.List(File(exists=True), desc="spectral connectivty matrices in .npy format, one per frequency band")
+    
+    stacked_conmat_file = File(exists=True, desc="spectral connectivty matrices of all frequency bands stacked (n_bands * n * n) in .npy format")
+    
 class SpectralConn(BaseInterface):
     
     """
@@ -52,54 +93,338 @@ class SpectralConn(BaseInterface):
         type = Float, desc='sampling frequency', mandatory=True
     
     freq_band 
-        type = List(Float) , exists=True, desc='frequency bands', mandatory=True
+        type = List(Float) , exists=True, desc='frequency bands', mandatory=True, xor = ['freq_bands']
+    
+    freq_bands
+        type = List(List(Float)), desc='list of frequency bands, computed in a single pass', mandatory=True, xor = ['freq_band']
+    
+    freq_band_names
+        type = List(String), desc='names of the frequency bands (used in conmat file names)', mandatory=False
     
     con_method 
-        type = Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased") , desc='metric computed on time series for connectivity'
+        type = Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased","aec","aec_orth") , desc='metric computed on time series for connectivity (aec: amplitude envelope correlation, aec_orth: aec of pairwise orthogonalized signals)'
+        
+    mode
+        type = Enum("multitaper","cwt_morlet"), default = "multitaper", desc='spectral estimation mode (cwt_morlet connectivity is averaged over time)', usedefault = True
+        
+    cwt_freqs
+        type = List(Float), desc='frequencies of the morlet wavelets (default, 1Hz steps in each band)', mandatory=False
+        
+    cwt_n_cycles
+        type = Float or List(Float), desc='number of cycles of the morlet wavelets, fixed or one per frequency (default, frequency / 7)', mandatory=False
         
     epoch_window_length 
         type = Float, desc='epoched data', mandatory=False
     
+    epoch_window_overlap
+        type = Float, default = 0.0, desc='overlap between consecutive epochs, in seconds (should be smaller than epoch_window_length)', usedefault = True
+    
     export_to_matlab 
         type = Bool, default = False, desc='If conmat is exported to .mat format as well',usedefault = True
    
     index
         type = String, default = "0", desc='What to add to the name of the file',usedefault = True
         
+    n_jobs
+        type = Int, default = 1, desc='number of processes (-1 for all cpus), within the NEUROPYPE_EPHY_MAX_JOBS budget', usedefault = True
+        
+    streaming
+        type = Bool, default = False, desc='If True, ts_file is memory-mapped and cross-spectra are accumulated by chunks of epochs (multitaper spectral methods only, ts_file should be epoched or epoch_window_length set)', usedefault = True
+        
+    chunk_size
+        type = Int, default = 32, desc='number of epochs loaded at once in streaming mode', usedefault = True
+        
+    packed_output
+        type = Bool, default = False, desc='If True, conmats are saved in packed float32 triangle format (.npz)', usedefault = True
+        
+    node_names_file
+        type = File, exists=True, desc='node names in txt format (one per line), saved with packed conmats', mandatory=False
+        
+    seed_indices
+        type = List(Int), desc='if set, connectivity is only computed between these nodes and target_indices, and saved in sparse (COO) .npz format (multitaper only)', mandatory=False, xor = ['pairs_file']
+        
+    target_indices
+        type = List(Int), desc='targets of seed_indices (all nodes if not set)', mandatory=False, requires = ['seed_indices']
+        
+    pairs_file
+        type = File, exists=True, desc='pairs for which connectivity is computed, in .npy format: (2, n_pairs) indices or nodes * nodes mask; output is saved in sparse (COO) .npz format (multitaper only)', mandatory=False, xor = ['seed_indices']
+        
+    use_cache
+        type = Bool, default = False, desc='If True, results are cached on disk, keyed by the content of ts_file and the parameters', usedefault = True
+        
+    cache_dir
+        type = String, desc='cache directory (default, NEUROPYPE_EPHY_CONMAT_CACHE_DIR or ~/.neuropype_ephy/conmat_cache)', mandatory=False
+        
+    cache_max_size
+        type = Float, default = 1000., desc='maximal size of the cache in MB, least recently used results are removed', usedefault = True
+        
+    precision
+        type = Enum('float64','float32'), default = 'float64', desc='precision of the computation (in streaming mode, the one of ts_file) and of the saved conmats', usedefault = True
+        
     Outputs:
     
     conmat_file 
         type = File, exists=True, desc="spectral connectivty matrix in .npy format"
     
+    conmat_files
+        type = List(File), exists=True, desc="spectral connectivty matrices in .npy format, one per frequency band" (only if freq_bands is set)
+    
+    stacked_conmat_file
+        type = File, exists=True, desc="spectral connectivty matrices of all frequency bands stacked (n_bands * n * n) in .npy format" (only if freq_bands is set)
+    
     
     """
     input_spec = SpectralConnInputSpec
     output_spec = SpectralConnOutputSpec
 
+    ### inputs which change the results (n_jobs, streaming and chunk_size do not)
+    cache_params = ['sfreq','freq_band','freq_bands','freq_band_names','con_method','mode','cwt_freqs','cwt_n_cycles',
+                    'epoch_window_length','epoch_window_overlap','export_to_matlab','index','packed_output',
+                    'seed_indices','target_indices','precision']
+    
+    def _get_cache_key(self, cache):
+        
+        params = dict([(name, getattr(self.inputs, name)) for name in self.cache_params])
+        
+        ### files are compared by content
+        if isdefined(self.inputs.node_names_file):
+            params['node_names'] = [line.strip() for line in open(self.inputs.node_names_file)]
+            
+        if isdefined(self.inputs.pairs_file):
+            params['pairs'] = hash_array_file(self.inputs.pairs_file)
+            
+        return cache.make_key(self.inputs.ts_file, params)
+        
     def _run_interface(self, runtime):
                 
         print 'in SpectralConn'
         
+        if self.inputs.use_cache:
+            
+            cache_dir = self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else get_conmat_cache_dir()
+            
+            cache = ConmatCache(cache_dir, self.inputs.cache_max_size)
+            
+            cache_key = self._get_cache_key(cache)
+            
+            cached_outputs = cache.get(cache_key)
+            
+            if cached_outputs is not None:
+                
+                for name, value in cached_outputs.items():
+                    setattr(self, name, value)
+                    
+                return runtime
+                
         ts_file = self.inputs.ts_file
         sfreq = self.inputs.sfreq
         freq_band = self.inputs.freq_band
+        freq_bands = self.inputs.freq_bands
+        freq_band_names = self.inputs.freq_band_names
         con_method = self.inputs.con_method
         epoch_window_length = self.inputs.epoch_window_length
         export_to_matlab = self.inputs.export_to_matlab
         index = self.inputs.index
+        n_jobs = self.inputs.n_jobs
+        packed = self.inputs.packed_output
+        mode = self.inputs.mode
+        cwt_freqs = self.inputs.cwt_freqs if isdefined(self.inputs.cwt_freqs) else None
+        cwt_n_cycles = self.inputs.cwt_n_cycles if isdefined(self.inputs.cwt_n_cycles) else None
+        
+        if isdefined(self.inputs.node_names_file):
+            node_names = [line.strip() for line in open(self.inputs.node_names_file)]
+        else:
+            node_names = None
+        
+        if self.inputs.streaming:
+            
+            ### peak memory is bounded by one chunk of epochs, epochs being views on the memory-mapped file
+            chunk_size = self.inputs.chunk_size
+            
+            raw_data = np.load(ts_file, mmap_mode = 'r')
+            
+        else:
+            
+            chunk_size = None
+            
+            raw_data = cast_to_precision(np.load(ts_file), self.inputs.precision)
+            
+        if epoch_window_length == traits.Undefined:
+            data = raw_data
+        else:
+            ### epochs are a strided view on raw_data (no copy), the remainder is dropped
+            win = int(epoch_window_length * sfreq)
+            
+            data = get_epochs_view(raw_data, win, step = win - int(self.inputs.epoch_window_overlap * sfreq))
+            
+            print "epoching data with {}s by window ({}s overlap), resulting in {} epochs".format(epoch_window_length,self.inputs.epoch_window_overlap,data.shape[0])
+        
+        ### subset of pairs
+        if isdefined(self.inputs.pairs_file):
+            indices = get_pair_indices(data.shape[-2], pairs_file = self.inputs.pairs_file)
+        elif isdefined(self.inputs.seed_indices):
+            target_indices = self.inputs.target_indices if isdefined(self.inputs.target_indices) else None
+            indices = get_pair_indices(data.shape[-2], seed_indices = self.inputs.seed_indices, target_indices = target_indices)
+        else:
+            indices = None
+            
+        if isdefined(freq_bands):
+            
+            if not isdefined(freq_band_names):
+                freq_band_names = None
+                
+            self.conmat_files, self.stacked_conmat_file = compute_and_save_multiband_spectral_connectivity(data = data,con_method = con_method,index = index, sfreq=sfreq, freq_bands = freq_bands, freq_band_names = freq_band_names, export_to_matlab = export_to_matlab, n_jobs = n_jobs, chunk_size = chunk_size, packed = packed, node_names = node_names, indices = indices, mode = mode, cwt_freqs = cwt_freqs, cwt_n_cycles = cwt_n_cycles, precision = self.inputs.precision)
+            
+        else:
+            
+            self.conmat_file = compute_and_save_spectral_connectivity(data = data,con_method = con_method,index = index, sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1],export_to_matlab = export_to_matlab, n_jobs = n_jobs, chunk_size = chunk_size, packed = packed, node_names = node_names, indices = indices, mode = mode, cwt_freqs = cwt_freqs, cwt_n_cycles = cwt_n_cycles, precision = self.inputs.precision)
+        
+        if self.inputs.use_cache:
+            
+            if isdefined(freq_bands):
+                outputs = {'conmat_files': self.conmat_files, 'stacked_conmat_file': self.stacked_conmat_file}
+                conmat_files = self.conmat_files + [self.stacked_conmat_file]
+            else:
+                outputs = {'conmat_file': self.conmat_file}
+                conmat_files = [self.conmat_file]
+                
+            ### .mat exports are written next to conmat files
+            mat_files = [os.path.splitext(conmat_file)[0] + ".mat" for conmat_file in conmat_files]
+            
+            cache.put(cache_key, outputs, extra_files = [mat_file for mat_file in mat_files if os.path.exists(mat_file)])
+            
+        return runtime
+        
+    def _list_outputs(self):
+        
+        outputs = self._outputs().get()
+        
+        if isdefined(self.inputs.freq_bands):
+            
+            outputs["conmat_files"] = self.conmat_files
+            outputs["stacked_conmat_file"] = self.stacked_conmat_file
+            
+        else:
+            
+            outputs["conmat_file"] = self.conmat_file
+        
+        return outputs
+        
+############################################################################################### SpectralConnSurrogates #####################################################################################################
+
+from neuropype_ephy.spectral import compute_and_save_surrogate_spectral_connectivity
+
+class SpectralConnSurrogatesInputSpec(BaseInterfaceInputSpec):
+    
+    ts_file = traits.File(exists=True, desc='nodes * time series in .npy format', mandatory=True)
+    
+    sfreq = traits.Float(desc='sampling frequency', mandatory=True)
+    
+    freq_band = traits.List(traits.Float(exists=True), desc='frequency band', mandatory=True)
+    
+    con_method = traits.Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased",desc='metric computed on time series for connectivity')
+    
+    epoch_window_length = traits.Float(desc='epoched data', mandatory=False)
+    
+    n_surrogates = traits.Int(200, desc='number of surrogates', usedefault = True)
+    
+    surrogate_method = traits.Enum("trial_shuffle","phase_randomization", desc='how surrogates are generated from the tapered spectra', usedefault = True)
+    
+    alpha = traits.Float(0.05, desc='significance level of the threshold matrix', usedefault = True)
+    
+    n_jobs = traits.Int(1, desc='number of processes (-1 for all cpus), within the NEUROPYPE_EPHY_MAX_JOBS budget', usedefault = True)
+    
+    seed = traits.Int(desc='seed of the random generator', mandatory=False)
+    
+    index = traits.String("0",desc = "What to add to the name of the file" ,usedefault = True)
+    
+class SpectralConnSurrogatesOutputSpec(TraitedSpec):
+    
+    conmat_file = File(exists=True, desc="spectral connectivty matrix in .npy format")
+    
+    pval_file = File(exists=True, desc="p-values of the connectivity matrix against surrogates, in .npy format")
+    
+    threshold_file = File(exists=True, desc="(1 - alpha) quantile of the surrogate connectivity matrices, in .npy format")
+    
+class SpectralConnSurrogates(BaseInterface):
+    
+    """
+    Description:
+    
+    Compute spectral connectivity (multitaper) in a given frequency band, and its significance against surrogate data
+    
+    Tapered spectra are computed once, surrogates (trials shuffled across nodes, or random phases)
+    only cost a cross-spectrum reduction
+    
+    Inputs:
+    
+    ts_file 
+        type = File , exists=True, desc='nodes * time series in .npy format', mandatory=True
+    
+    sfreq 
+        type = Float, desc='sampling frequency', mandatory=True
+    
+    freq_band 
+        type = List(Float) , exists=True, desc='frequency band', mandatory=True
+    
+    con_method 
+        type = Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased") , desc='metric computed on time series for connectivity'
+        
+    epoch_window_length 
+        type = Float, desc='epoched data', mandatory=False
+    
+    n_surrogates
+        type = Int, default = 200, desc='number of surrogates', usedefault = True
+        
+    surrogate_method
+        type = Enum("trial_shuffle","phase_randomization"), default = "trial_shuffle", desc='how surrogates are generated from the tapered spectra', usedefault = True
+        
+    alpha
+        type = Float, default = 0.05, desc='significance level of the threshold matrix', usedefault = True
+        
+    n_jobs
+        type = Int, default = 1, desc='number of processes (-1 for all cpus), within the NEUROPYPE_EPHY_MAX_JOBS budget', usedefault = True
+        
+    seed
+        type = Int, desc='seed of the random generator', mandatory=False
+        
+    index
+        type = String, default = "0", desc='What to add to the name of the file',usedefault = True
+        
+    Outputs:
+    
+    conmat_file 
+        type = File, exists=True, desc="spectral connectivty matrix in .npy format"
+    
+    pval_file
+        type = File, exists=True, desc="p-values of the connectivity matrix against surrogates, in .npy format"
+    
+    threshold_file
+        type = File, exists=True, desc="(1 - alpha) quantile of the surrogate connectivity matrices, in .npy format"
+    
+    """
+    input_spec = SpectralConnSurrogatesInputSpec
+    output_spec = SpectralConnSurrogatesOutputSpec
+
+    def _run_interface(self, runtime):
+                
+        print 'in SpectralConnSurrogates'
+        
+        sfreq = self.inputs.sfreq
+        freq_band = self.inputs.freq_band
+        epoch_window_length = self.inputs.epoch_window_length
+        
+        raw_data = np.load(self.inputs.ts_file)
         
         if epoch_window_length == traits.Undefined:
-            data = np.load(ts_file)
+            data = raw_data
         else:
-            raw_data = np.load(ts_file)
-            nb_splits = raw_data.shape[1] // (epoch_window_length * sfreq)
-            reste = raw_data.shape[1] % int(epoch_window_length * sfreq)
-            if reste != 0:
-                raw_data = raw_data[:,:-reste]
-            print "epoching data with {}s by window, resulting in {} epochs (rest = {})".format(epoch_window_length,nb_splits,reste)
-            data = np.array(np.array_split(raw_data,nb_splits,axis = 1))
+            data = get_epochs_view(raw_data, int(epoch_window_length * sfreq))
+            print "epoching data with {}s by window, resulting in {} epochs".format(epoch_window_length,data.shape[0])
+        
+        seed = self.inputs.seed if isdefined(self.inputs.seed) else None
         
-        self.conmat_file = compute_and_save_spectral_connectivity(data = data,con_method = con_method,index = index, sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1],export_to_matlab = export_to_matlab)
+        self.conmat_file, self.pval_file, self.threshold_file = compute_and_save_surrogate_spectral_connectivity(data = data, con_method = self.inputs.con_method, sfreq = sfreq, fmin = freq_band[0], fmax = freq_band[1], index = self.inputs.index, n_surrogates = self.inputs.n_surrogates, surrogate_method = self.inputs.surrogate_method, alpha = self.inputs.alpha, n_jobs = self.inputs.n_jobs, seed = seed)
         
         return runtime
         
@@ -108,16 +433,22 @@ class SpectralConn(BaseInterface):
         outputs = self._outputs().get()
         
         outputs["conmat_file"] = self.conmat_file
+        outputs["pval_file"] = self.pval_file
+        outputs["threshold_file"] = self.threshold_file
         
         return outputs
         
 ############################################################################################### PlotSpectralConn #####################################################################################################
 
-from neuropype_ephy.spectral import plot_circular_connectivity
+from neuropype_ephy.spectral import plot_circular_connectivity, plot_circular_connectivity_batch
+from neuropype_ephy.packed_conmat import load_conmat, read_node_names
+from neuropype_ephy.labels_store import load_labels_store
 
 class PlotSpectralConnInputSpec(BaseInterfaceInputSpec):
     
-    conmat_file = traits.File(exists=True, desc='connectivity matrix in .npy format', mandatory=True)
+    conmat_file = traits.File(exists=True, desc='connectivity matrix in .npy format, or in packed .npz format', mandatory=True, xor = ['conmat_files'])
+    
+    conmat_files = traits.List(traits.File(exists=True), desc='connectivity matrices plotted in batch, with the same nodes', mandatory=True, xor = ['conmat_file'])
     
     is_sensor_space = traits.Bool(True, desc = 'if True uses labels as returned from mne', usedefault = True)
     
@@ -127,11 +458,21 @@ class PlotSpectralConnInputSpec(BaseInterfaceInputSpec):
     
     nb_lines = traits.Int(200, desc='nb lines kept in the representation', usedefault = True)
     
-    labels_file = traits.File(desc='list of labels associated with nodes')
+    labels_file = traits.File(desc='list of labels associated with nodes (names in .txt format in sensor space, labels store in .npz format in source space)')
+    
+    plot_format = traits.Enum('eps','png', desc='format of the plots (default, eps for a single conmat and png in batch)')
+    
+    dpi = traits.Int(100, desc='resolution of rasterized plots', usedefault = True)
+    
+    multi_panel = traits.Bool(False, desc='in batch, plot all conmats in a single multi-panel file instead of one image per conmat', usedefault = True)
+    
+    n_jobs = traits.Int(1, desc='number of processes rendering the images in batch (-1 for all cpus)', usedefault = True)
     
 class PlotSpectralConnOutputSpec(TraitedSpec):
     
-    plot_conmat_file = File(exists=True, desc="plot spectral connectivity matrix in .eps format")
+    plot_conmat_file = File(exists=True, desc="plot spectral connectivity matrix in .eps format (or multi-panel plot in batch)")
+    
+    plot_conmat_files = traits.List(File(exists=True), desc="plots of each connectivity matrix in batch")
     
 class PlotSpectralConn(BaseInterface):
     
@@ -140,10 +481,18 @@ class PlotSpectralConn(BaseInterface):
     
     Plot connectivity matrix using mne plot_circular_connectivity function
     
+    In batch (conmat_files, or a stacked conmat file of bands/windows), the
+    circular layout is computed once and the nb_lines strongest edges of each
+    conmat are rendered either in one image per conmat (in parallel) or in a
+    single multi-panel file
+    
     Inputs:
     
     conmat_file 
-        type = File, exists=True, desc='connectivity matrix in .npy format', mandatory=True
+        type = File, exists=True, desc='connectivity matrix in .npy format, or in packed .npz format', mandatory=True, xor = ['conmat_files']
+    
+    conmat_files
+        type = List(File), exists=True, desc='connectivity matrices plotted in batch, with the same nodes', mandatory=True, xor = ['conmat_file']
     
     is_sensor_space 
         type = Bool, default = True, desc = 'if True uses labels as returned from mne', usedefault = True
@@ -158,12 +507,27 @@ class PlotSpectralConn(BaseInterface):
         type = Int, default = 200, desc='nb lines kept in the representation', usedefault = True
     
     labels_file 
-        type = File, desc='list of labels associated with nodes'
+        type = File, desc='list of labels associated with nodes (names in .txt format in sensor space, labels store in .npz format in source space)'
+    
+    plot_format
+        type = Enum('eps','png'), desc='format of the plots (default, eps for a single conmat and png in batch)'
+    
+    dpi
+        type = Int, default = 100, desc='resolution of rasterized plots', usedefault = True
+    
+    multi_panel
+        type = Bool, default = False, desc='in batch, plot all conmats in a single multi-panel file instead of one image per conmat', usedefault = True
+    
+    n_jobs
+        type = Int, default = 1, desc='number of processes rendering the images in batch (-1 for all cpus)', usedefault = True
     
     Outputs:
     
     plot_conmat_file
-        type = File, exists=True, desc="plot spectral connectivity matrix in .eps format"
+        type = File, exists=True, desc="plot spectral connectivity matrix in .eps format (or multi-panel plot in batch)"
+        
+    plot_conmat_files
+        type = List(File), exists=True, desc="plots of each connectivity matrix in batch"
         
     
     """
@@ -175,23 +539,43 @@ class PlotSpectralConn(BaseInterface):
                 
         print 'in PlotSpectralConn'
         
-        conmat_file = self.inputs.conmat_file
         vmin = self.inputs.vmin
         vmax = self.inputs.vmax
         nb_lines = self.inputs.nb_lines
         is_sensor_space = self.inputs.is_sensor_space
         labels_file =self.inputs.labels_file
         
+        if isdefined(self.inputs.conmat_files):
+            conmat_files = self.inputs.conmat_files
+        else:
+            conmat_files = [self.inputs.conmat_file]
         
-        ### reading matrix and base filename from conmat_file
-        path,fname,ext = split_f(conmat_file)    
-        print fname
+        conmat_file = conmat_files[0]
         
-        conmat = np.load(conmat_file)
-        print conmat.shape
+        ### reading matrices and base filenames from conmat_files
+        conmats = []
+        fnames = []
         
-        assert conmat.ndim == 2, "Warning, conmat should be 2D matrix , ndim = {}".format(conmat.ndim)
-        assert conmat.shape[0] == conmat.shape[1], "Warning, conmat should be a squared matrix , {} != {}".format(conmat.shape[0],conmat.shape[1])
+        for batch_conmat_file in conmat_files:
+            
+            path,fname,ext = split_f(batch_conmat_file)    
+            print fname
+            
+            conmat = load_conmat(batch_conmat_file)
+            print conmat.shape
+            
+            assert conmat.ndim in [2,3], "Warning, conmat should be 2D matrix (or a stack of 2D matrices), ndim = {}".format(conmat.ndim)
+            assert conmat.shape[-2] == conmat.shape[-1], "Warning, conmat should be a squared matrix , {} != {}".format(conmat.shape[-2],conmat.shape[-1])
+            
+            if conmat.ndim == 3:
+                ### stacked conmats (bands, windows...)
+                conmats.extend(conmat)
+                fnames.extend([fname + '_' + str(i) for i in range(conmat.shape[0])])
+            else:
+                conmats.append(conmat)
+                fnames.append(fname)
+        
+        is_batch = isdefined(self.inputs.conmat_files) or len(conmats) > 1
         
             
         if isdefined(labels_file):
@@ -202,56 +586,22 @@ class PlotSpectralConn(BaseInterface):
                 node_colors = None
             
             else:
-                labels = []
-                with open(labels_file, "rb") as f:
-                    for _ in range(pickle.load(f)):
-                        labels.append(pickle.load(f))
-                
-                print '\n ********************** \n' 
-                print len(labels)
-                print '\n ********************** \n' 
-#                0/0
-                # read colors
-                node_colors = [label.color for label in labels]    
-                
-                # reorder the labels based on their location in the left hemi
-                label_names = [label.name for label in labels]
-                lh_labels = [name for name in label_names if name.endswith('lh')]
-                rh_labels = [name for name in label_names if name.endswith('rh')]
-                
-                # Get the y-location of the label
-                label_ypos_lh = list()
-                for name in lh_labels:
-                    idx = label_names.index(name)
-                    ypos = np.mean(labels[idx].pos[:, 1])
-                    label_ypos_lh.append(ypos)
+                ### labels store (or pickled labels of previous versions)
+                with load_labels_store(labels_file) as labels_store:
+                    
+                    # read colors
+                    node_colors = labels_store.colors
                     
-                try:
-                    idx = label_names.index('Brain-Stem')
-                    ypos = np.mean(labels[idx].pos[:, 1])
-                    lh_labels.append('Brain-Stem')
-                    label_ypos_lh.append(ypos)
-                except ValueError:
-                    pass
-                        
-                # Reorder the labels based on their location
-                lh_labels = [label for (yp, label) in sorted(zip(label_ypos_lh, lh_labels))]
-#                rh_labels = [label for (yp, label) in sorted(zip(label_ypos_rh, rh_labels))]
+                    # plot order precomputed from the y-location of the labels
+                    label_names = labels_store.names
+                    node_order = labels_store.node_order
                 
-                # For the right hemi
-                rh_labels = [label[:-2] + 'rh' for label in lh_labels
-                            if label != 'Brain-Stem' and label[:-2]+ 'rh' in rh_labels]
-
-                # Save the plot order 
-                node_order = list()
-                node_order.extend(lh_labels[::-1])  # reverse the order
-                node_order.extend(rh_labels)    
-                print '\n ********************** \n'  
-                print lh_labels
-                print rh_labels
-                print '\n ********************** \n'  
+        elif len(read_node_names(conmat_file)) != 0:
+            label_names = read_node_names(conmat_file)
+            node_order  = label_names
+            node_colors = None
         else:
-            label_names = range(conmat.shape[0])
+            label_names = range(conmats[0].shape[0])
             node_order  = label_names
             node_colors = None
            
@@ -260,7 +610,25 @@ class PlotSpectralConn(BaseInterface):
         print len(node_order)
         print '\n ********************** \n'   
 #        0/0
-        self.plot_conmat_file = plot_circular_connectivity(conmat,label_names,node_colors,node_order, vmin,vmax ,nb_lines, fname)
+        if not is_batch:
+            
+            plot_format = self.inputs.plot_format if isdefined(self.inputs.plot_format) else 'eps'
+            
+            self.plot_conmat_file = plot_circular_connectivity(conmats[0],label_names,node_colors,node_order, vmin,vmax ,nb_lines, fnames[0], plot_format = plot_format, dpi = self.inputs.dpi)
+            self.plot_conmat_files = [self.plot_conmat_file]
+            
+        else:
+            
+            plot_format = self.inputs.plot_format if isdefined(self.inputs.plot_format) else 'png'
+            
+            plot_files = plot_circular_connectivity_batch(conmats,label_names,node_colors,node_order, vmin,vmax ,nb_lines, fnames, plot_format = plot_format, dpi = self.inputs.dpi, multi_panel = self.inputs.multi_panel, n_jobs = self.inputs.n_jobs)
+            
+            if self.inputs.multi_panel:
+                self.plot_conmat_file = plot_files
+                self.plot_conmat_files = []
+            else:
+                self.plot_conmat_file = None
+                self.plot_conmat_files = plot_files
 
         return runtime
         
@@ -268,7 +636,10 @@ class PlotSpectralConn(BaseInterface):
         
         outputs = self._outputs().get()
         
-        outputs["plot_conmat_file"] = self.plot_conmat_file
+        if self.plot_conmat_file is not None:
+            outputs["plot_conmat_file"] = self.plot_conmat_file
+        
+        outputs["plot_conmat_files"] = self.plot_conmat_files
         
         return outputs
         
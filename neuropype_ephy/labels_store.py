@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Compact storage of the labels (ROIs) of source space time series
+
+Instead of pickled mne.Label objects, labels are saved in a .npz file with,
+for each label (in the order of the time series): name, color (RGBA, nan if
+undefined), hemisphere and centroid (mean position of its vertices), and the
+node order of the circular plots (left hemisphere labels from front to back,
+then the matching right hemisphere labels).
+
+Vertices and positions are optional, stored for all labels as concatenated
+arrays with offsets (label i is vertices[offsets[i]:offsets[i + 1]]). The
+.npz file is not compressed, so these arrays are memory-mapped in place (see
+memmap_npz_member): only the vertices of the requested labels are read.
+"""
+
+import numpy as np
+
+
+def compute_plot_order(names, centroids):
+    """
+    Node order of circular plots: left hemisphere labels (and Brain-Stem) reversed
+    by their y-position, then the right hemisphere labels in the same order
+    """
+    names = list(names)
+
+    lh_labels = [name for name in names if name.endswith('lh')]
+    rh_labels = [name for name in names if name.endswith('rh')]
+
+    label_ypos_lh = [centroids[names.index(name)][1] for name in lh_labels]
+
+    if 'Brain-Stem' in names:
+        lh_labels.append('Brain-Stem')
+        label_ypos_lh.append(centroids[names.index('Brain-Stem')][1])
+
+    # Reorder the labels based on their location
+    lh_labels = [label for (yp, label) in sorted(zip(label_ypos_lh, lh_labels))]
+
+    # For the right hemi
+    rh_labels = [label[:-2] + 'rh' for label in lh_labels
+                 if label != 'Brain-Stem' and label[:-2] + 'rh' in rh_labels]
+
+    node_order = list()
+    node_order.extend(lh_labels[::-1])  # reverse the order
+    node_order.extend(rh_labels)
+
+    return node_order
+
+
+def save_labels_store(labels_file, labels, save_vertices=True):
+    """
+    Save a list of mne.Label in labels store format (.npz)
+    """
+    names = [label.name for label in labels]
+
+    colors = np.array([label.color if label.color is not None else (np.nan,) * 4 for label in labels], dtype=float)
+
+    centroids = np.array([np.mean(label.pos, axis=0) for label in labels], dtype=float)
+
+    store = dict(names=np.array(names, dtype=str),
+                 colors=colors.reshape(len(labels), 4),
+                 hemis=np.array([label.hemi for label in labels], dtype=str),
+                 centroids=centroids.reshape(len(labels), 3),
+                 plot_order=np.array([names.index(name) for name in compute_plot_order(names, centroids)], dtype=int),
+                 format='labels')
+
+    if save_vertices:
+        store['offsets'] = np.concatenate([[0], np.cumsum([len(label.vertices) for label in labels])])
+        store['vertices'] = np.concatenate([label.vertices for label in labels]).astype(int)
+        store['pos'] = np.concatenate([label.pos for label in labels]).astype(np.float32)
+
+    np.savez(labels_file, **store)
+
+    return labels_file
+
+
+def read_pickled_labels(labels_file):
+    """
+    Read labels.dat files of previous versions (number of labels followed by pickled mne.Label)
+    """
+    import pickle
+
+    labels = []
+
+    with open(labels_file, "rb") as f:
+        for _ in range(pickle.load(f)):
+            labels.append(pickle.load(f))
+
+    return labels
+
+
+def memmap_npz_member(npz_file, name):
+    """
+    Memory-map an array of an uncompressed .npz file (as written by np.savez),
+    from the position of its .npy member in the zip archive
+    """
+    import struct
+    import zipfile
+
+    with zipfile.ZipFile(npz_file) as zip_file:
+        info = zip_file.getinfo(name + '.npy')
+
+    assert info.compress_type == zipfile.ZIP_STORED, "Error, {} is compressed in {}, it cannot be memory-mapped".format(name, npz_file)
+
+    with open(npz_file, 'rb') as f:
+
+        ### the local header (30 bytes, then the file name and extra field) precedes the data
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+
+        version = np.lib.format.read_magic(f)
+
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+        offset = f.tell()
+
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+
+    return np.memmap(npz_file, dtype=dtype, mode='r', shape=shape, offset=offset,
+                     order='F' if fortran_order else 'C')
+
+
+def is_labels_store_file(labels_file):
+
+    if not labels_file.endswith('.npz'):
+        return False
+
+    with np.load(labels_file) as npz:
+        return 'plot_order' in npz.files
+
+
+class LabelsStore(object):
+    """
+    Reader for labels store files, with random access by name or index
+
+    Names, hemispheres, centroids, colors and plot order are read when the
+    store is opened; vertex arrays are memory-mapped on first access, until
+    close is called.
+
+    Example:
+
+    >> labels_store = LabelsStore('labels.npz')
+    >> labels_store.names                  # in the order of the time series
+    >> labels_store.node_order             # names in the order of circular plots
+    >> labels_store['precentral-lh']       # dict with name, color, hemi and centroid
+    >> labels_store.get_pos('precentral-lh')   # vertex positions of this label
+    >> labels_store.close()
+
+    or, closing the memory-mapped arrays automatically:
+
+    >> with LabelsStore('labels.npz') as labels_store:
+    >>     vertices = labels_store.get_vertices('precentral-lh')
+
+    """
+    def __init__(self, labels_file):
+
+        self.labels_file = labels_file
+
+        with np.load(labels_file) as npz:
+
+            assert 'plot_order' in npz.files, "Error, {} is not a labels store file".format(labels_file)
+
+            self.names = npz['names'].tolist()
+            self.hemis = npz['hemis'].tolist()
+            self.centroids = npz['centroids']
+
+            self._colors = npz['colors']
+            self._plot_order = npz['plot_order']
+
+            self._files = npz.files
+
+        self._indexes = dict([(name, index) for index, name in enumerate(self.names)])
+
+        ### memory-mapped vertex arrays, opened on first access
+        self._vertex_arrays = {}
+
+    @property
+    def colors(self):
+        """
+        RGBA colors, as in mne.Label (None if undefined)
+        """
+        return [None if np.any(np.isnan(color)) else tuple(color) for color in self._colors]
+
+    @property
+    def node_order(self):
+
+        return [self.names[index] for index in self._plot_order]
+
+    @property
+    def has_vertices(self):
+
+        return 'offsets' in self._files
+
+    def __len__(self):
+
+        return len(self.names)
+
+    def index(self, name):
+
+        return self._indexes[name]
+
+    def __getitem__(self, key):
+
+        index = key if isinstance(key, (int, np.integer)) else self.index(key)
+
+        color = self._colors[index]
+
+        return {'name': self.names[index], 'hemi': self.hemis[index], 'centroid': self.centroids[index],
+                'color': None if np.any(np.isnan(color)) else tuple(color)}
+
+    def _get_vertex_array(self, array_name, key):
+
+        assert self.has_vertices, "Error, vertices were not saved in {}".format(self.labels_file)
+
+        for name in ['offsets', array_name]:
+            if name not in self._vertex_arrays:
+                self._vertex_arrays[name] = memmap_npz_member(self.labels_file, name)
+
+        offsets = self._vertex_arrays['offsets']
+
+        index = key if isinstance(key, (int, np.integer)) else self.index(key)
+
+        return np.array(self._vertex_arrays[array_name][offsets[index]:offsets[index + 1]])
+
+    def get_vertices(self, key):
+
+        return self._get_vertex_array('vertices', key)
+
+    def get_pos(self, key):
+
+        return self._get_vertex_array('pos', key)
+
+    def close(self):
+
+        self._vertex_arrays = {}
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+def load_labels_store(labels_file):
+    """
+    Open a labels store file, labels.dat files of previous versions being converted
+    (in labels.npz, in the current directory)
+    """
+    import os
+
+    if not is_labels_store_file(labels_file):
+        labels_file = save_labels_store(os.path.abspath('labels.npz'), read_pickled_labels(labels_file))
+
+    return LabelsStore(labels_file)
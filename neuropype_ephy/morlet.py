@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Morlet wavelet transform on batches of time series
+
+Wavelet coefficients are computed by FFT convolution on the whole
+(..., nb_nodes, nb_timepoints) array, a few frequencies at a time.
+Conventions (zero-mean wavelets, 'same' centering, default frequency grid
+and minimum of 5 cycles per epoch) follow mne.connectivity.spectral_connectivity
+with mode = 'cwt_morlet'
+"""
+
+import numpy as np
+
+
+def get_cwt_freqs(freq_bands, n_times, sfreq, cwt_freqs=None):
+    """
+    Frequency grid of the wavelet transform for a list of frequency bands
+
+    If cwt_freqs is None, frequencies are np.arange(f_lower, f_upper, 1) merged
+    over all bands. Frequencies with less than 5 cycles in an epoch are dropped,
+    as in spectral_connectivity.
+
+    Returns the kept frequencies, the mask over cwt_freqs and, for each band,
+    the indexes of its frequencies (f_lower <= f < f_upper) among the kept ones
+    """
+    if cwt_freqs is None:
+        cwt_freqs = np.unique(np.concatenate([np.arange(f_lower, f_upper, 1) for f_lower, f_upper in freq_bands]))
+
+    cwt_freqs = np.asarray(cwt_freqs, dtype=float)
+
+    if np.any(cwt_freqs > sfreq / 2.):
+        raise ValueError('entries in cwt_freqs cannot be larger than Nyquist ({}Hz)'.format(sfreq / 2.))
+
+    five_cycle_freq = 5. * sfreq / n_times
+
+    freq_mask = cwt_freqs >= five_cycle_freq
+
+    freqs = cwt_freqs[freq_mask]
+
+    freq_idx_bands = [np.where((freqs >= f_lower) & (freqs < f_upper))[0] for f_lower, f_upper in freq_bands]
+
+    for (f_lower, f_upper), freq_idx in zip(freq_bands, freq_idx_bands):
+        if len(freq_idx) == 0:
+            raise ValueError('There are no frequency points between {}Hz and {}Hz with at least 5 cycles ({}Hz), change the band specification or the frequency grid'.format(f_lower, f_upper, five_cycle_freq))
+
+    return freqs, freq_mask, freq_idx_bands
+
+
+def compute_morlet_fft(n_times, sfreq, freqs, n_cycles=7.):
+    """
+    FFT of the (zero-mean) Morlet wavelets of each frequency
+
+    Returns the wavelet FFTs (n_freqs, fsize), the offset of the 'same' part
+    of each convolution, and fsize (a power of 2 at least n_times + max wavelet length - 1)
+    """
+    from mne.time_frequency.tfr import morlet
+
+    wavelets = morlet(sfreq, freqs, n_cycles=n_cycles, zero_mean=True)
+
+    fsize = 2 ** int(np.ceil(np.log2(n_times + max(len(w) for w in wavelets) - 1)))
+
+    fft_wavelets = np.array([np.fft.fft(w, fsize) for w in wavelets])
+
+    offsets = np.array([(len(w) - 1) // 2 for w in wavelets])
+
+    return fft_wavelets, offsets, fsize
+
+
+def compute_morlet_coefs(fft_data, fft_wavelets, offsets, n_times):
+    """
+    Wavelet coefficients from data already transformed with np.fft.fft(data, fsize)
+
+    fft_data : array, shape (..., nb_nodes, fsize)
+
+    Returns coefs, shape (..., nb_nodes, n_freqs, n_times)
+    """
+    coefs = np.empty(fft_data.shape[:-1] + (len(fft_wavelets), n_times), dtype=np.complex128)
+
+    for freq_index, (fft_wavelet, offset) in enumerate(zip(fft_wavelets, offsets)):
+        coefs[..., freq_index, :] = np.fft.ifft(fft_data * fft_wavelet)[..., offset:offset + n_times]
+
+    return coefs
+
+
+def compute_morlet_power(fft_data, fft_wavelets, offsets, n_times, decim=1):
+    """
+    Wavelet power from data already transformed with np.fft.fft(data, fsize),
+    decimated in time (one time point out of decim)
+
+    fft_data : array, shape (..., nb_nodes, fsize)
+
+    Returns power, shape (..., nb_nodes, n_freqs, n_decim_times)
+    """
+    n_decim_times = len(range(0, n_times, decim))
+
+    power = np.empty(fft_data.shape[:-1] + (len(fft_wavelets), n_decim_times))
+
+    for freq_index, (fft_wavelet, offset) in enumerate(zip(fft_wavelets, offsets)):
+        power[..., freq_index, :] = np.abs(np.fft.ifft(fft_data * fft_wavelet)[..., offset:offset + n_times:decim]) ** 2
+
+    return power
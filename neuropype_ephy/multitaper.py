@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Multitaper spectral estimation on batches of time series
+
+Tapered spectra are computed with a single FFT on the whole
+(..., nb_nodes, nb_timepoints) array, and cross-spectral densities are
+reduced with einsum, instead of one spectral_connectivity call per sample.
+Conventions (DPSS tapers, DC/Nyquist scaling, normalisation) follow
+mne.time_frequency.multitaper, so results match spectral_connectivity with
+mode = 'multitaper' and mt_adaptive = False
+"""
+
+import os
+
+import numpy as np
+
+
+def make_dpss(n_times, sfreq, bandwidth=None, low_bias=True):
+    """
+    Compute DPSS tapers for a given epoch length (no cache, see compute_dpss)
+
+    Returns tapers (n_tapers, n_times) and their eigenvalues (n_tapers)
+    """
+    from mne.time_frequency.multitaper import dpss_windows
+
+    if bandwidth is not None:
+        half_nbw = float(bandwidth) * n_times / (2. * sfreq)
+    else:
+        half_nbw = 4.
+
+    if half_nbw < 0.5:
+        raise ValueError('bandwidth value {} yields a normalized bandwidth of {} < 0.5, use a value of at least {}'.format(bandwidth, half_nbw, sfreq / n_times))
+
+    n_tapers_max = int(2 * half_nbw)
+
+    tapers, eigvals = dpss_windows(n_times, half_nbw, n_tapers_max, low_bias=low_bias)
+
+    return tapers, eigvals
+
+
+class DPSSCache(object):
+    """
+    LRU cache of DPSS tapers, keyed by (n_times, sfreq, bandwidth, low_bias)
+
+    If cache_dir is set, tapers are also saved there in .npz format and
+    reloaded by other processes (e.g. other MapNode iterations). Cached arrays
+    are read-only. hits, disk_hits and misses count the lookups.
+    """
+    def __init__(self, max_size=32, cache_dir=None):
+
+        from collections import OrderedDict
+
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+
+        self._cache = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _get_cache_file(self, key):
+
+        n_times, sfreq, bandwidth, low_bias = key
+
+        return os.path.join(self.cache_dir, 'dpss_{}_{}_{}_{}.npz'.format(n_times, sfreq, bandwidth, int(low_bias)))
+
+    def get(self, n_times, sfreq, bandwidth=None, low_bias=True):
+        """
+        Tapers and eigenvalues for these parameters, computed only if not cached
+        """
+        if bandwidth is not None:
+            bandwidth = float(bandwidth)
+
+        key = (int(n_times), float(sfreq), bandwidth, bool(low_bias))
+
+        if key in self._cache:
+
+            self.hits += 1
+
+            ### move to the end (most recently used)
+            value = self._cache.pop(key)
+            self._cache[key] = value
+
+            return value
+
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = self._get_cache_file(key)
+
+        if cache_file is not None and os.path.exists(cache_file):
+
+            self.disk_hits += 1
+
+            with np.load(cache_file) as cached:
+                tapers, eigvals = cached['tapers'], cached['eigvals']
+
+        else:
+
+            self.misses += 1
+
+            tapers, eigvals = make_dpss(*key)
+
+            if cache_file is not None:
+
+                if not os.path.exists(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+
+                ### write then rename, so that concurrent processes never read a partial file
+                tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+                with open(tmp_file, 'wb') as f:
+                    np.savez(f, tapers=tapers, eigvals=eigvals)
+                os.rename(tmp_file, cache_file)
+
+        tapers.flags.writeable = False
+        eigvals.flags.writeable = False
+
+        self._cache[key] = (tapers, eigvals)
+
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+        return tapers, eigvals
+
+    def clear(self):
+
+        self._cache.clear()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def stats(self):
+
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'size': len(self._cache)}
+
+    def __repr__(self):
+
+        return 'DPSSCache(size = {size}, hits = {hits}, disk_hits = {disk_hits}, misses = {misses})'.format(**self.stats())
+
+
+### process-wide cache, persisted on disk if NEUROPYPE_EPHY_DPSS_CACHE_DIR is set
+dpss_cache = DPSSCache(cache_dir=os.environ.get('NEUROPYPE_EPHY_DPSS_CACHE_DIR'))
+
+
+def compute_dpss(n_times, sfreq, bandwidth=None, low_bias=True):
+    """
+    Compute DPSS tapers for a given epoch length, using the process-wide dpss_cache
+
+    Returns tapers (n_tapers, n_times) and their eigenvalues (n_tapers), read-only
+    """
+    return dpss_cache.get(n_times, sfreq, bandwidth, low_bias)
+
+
+def get_freq_mask(n_times, sfreq, freq_bands):
+    """
+    Frequencies of the rfft kept for a list of frequency bands
+
+    Returns the kept frequencies, the mask over all rfft frequencies and,
+    for each band, the indexes of its frequencies among the kept ones
+    """
+    freqs_all = np.fft.rfftfreq(n_times, 1. / sfreq)
+
+    freq_mask = np.zeros(len(freqs_all), dtype=bool)
+
+    for f_lower, f_upper in freq_bands:
+        freq_mask |= (freqs_all >= f_lower) & (freqs_all <= f_upper)
+
+    freqs = freqs_all[freq_mask]
+
+    freq_idx_bands = [np.where((freqs >= f_lower) & (freqs <= f_upper))[0] for f_lower, f_upper in freq_bands]
+
+    for (f_lower, f_upper), freq_idx in zip(freq_bands, freq_idx_bands):
+        if len(freq_idx) == 0:
+            raise ValueError('There are no frequency points between {}Hz and {}Hz, change the band specification or the frequency resolution'.format(f_lower, f_upper))
+
+    return freqs, freq_mask, freq_idx_bands
+
+
+def compute_eigenspectra(data, tapers):
+    """
+    rfft of the demeaned time series (..., nb_timepoints) multiplied by each taper,
+    all computed in a single FFT
+
+    Returns x_mt, shape (..., n_tapers, n_freqs) (all rfft frequencies, unweighted)
+    """
+    n_times = data.shape[-1]
+
+    data = data - np.mean(data, axis=-1, keepdims=True)
+
+    x_mt = np.fft.rfft(data[..., np.newaxis, :] * tapers, n=n_times)
+
+    ### adjust DC and Nyquist, as for a one-sided transform
+    x_mt[..., 0] /= np.sqrt(2.)
+    if n_times % 2 == 0:
+        x_mt[..., -1] /= np.sqrt(2.)
+
+    return x_mt
+
+
+def weight_tapered_spectra(x_mt, eigvals):
+    """
+    Apply taper weights and normalisation to x_mt (..., n_tapers, n_freqs), in place,
+    so that csd is a plain product and psd the sum of |x_mt| ** 2 over tapers
+    """
+    weights = np.sqrt(eigvals)
+
+    x_mt *= (weights * np.sqrt(2. / np.sum(weights ** 2)))[:, np.newaxis]
+
+    return x_mt
+
+
+def compute_tapered_spectra(data, sfreq, freq_bands, bandwidth=None):
+    """
+    Compute multitaper spectra of all time series in a single FFT
+
+    data : array, shape (..., nb_nodes, nb_timepoints)
+
+    Returns the weighted tapered spectra x_mt, shape (..., nb_nodes, n_tapers, n_freqs),
+    the kept frequencies and, for each band, the indexes of its frequencies
+
+    x_mt is complex64 for float32 data (np.fft computes in double precision,
+    but spectra and the cross-spectra computed from them are kept in single precision)
+    """
+    n_times = data.shape[-1]
+
+    tapers, eigvals = compute_dpss(n_times, sfreq, bandwidth)
+
+    single = data.dtype == np.float32
+
+    if single:
+        tapers = tapers.astype(np.float32)
+
+    freqs, freq_mask, freq_idx_bands = get_freq_mask(n_times, sfreq, freq_bands)
+
+    x_mt = compute_eigenspectra(data, tapers)[..., freq_mask]
+
+    if single:
+        x_mt = x_mt.astype(np.complex64)
+
+    ### apply taper weights and normalisation once, so that csd is a plain product
+    x_mt = weight_tapered_spectra(x_mt, eigvals)
+
+    return x_mt, freqs, freq_idx_bands
+
+
+def compute_csd(x_mt):
+    """
+    Cross-spectral density between all pairs of nodes
+
+    x_mt : weighted tapered spectra, shape (..., nb_nodes, n_tapers, n_freqs)
+
+    Returns csd, shape (..., nb_nodes, nb_nodes, n_freqs)
+    """
+    return np.einsum('...itf,...jtf->...ijf', x_mt, x_mt.conj())
+
+
+def compute_pair_csd(x_mt, seeds, targets, block_size=4096):
+    """
+    Cross-spectral density for a subset of pairs (seeds[k], targets[k])
+
+    x_mt : weighted tapered spectra, shape (nb_nodes, n_tapers, n_freqs)
+
+    Pairs are processed block_size at a time, to bound the size of the gathered spectra
+
+    Returns csd, shape (n_pairs, n_freqs)
+    """
+    return np.concatenate([np.einsum('ptf,ptf->pf', x_mt[seeds[start:start + block_size]],
+                                     x_mt[targets[start:start + block_size]].conj())
+                           for start in range(0, len(seeds), block_size)])
@@ -30,6 +30,8 @@ class ImportMatInputSpec(BaseInterfaceInputSpec):
                                                    choosing nodes, name of\
                                                    structure in matlab file')
 
+    precision = traits.Enum('float32', 'float64', desc='precision of the saved time series', usedefault=True)
+
 class ImportMatOutputSpec(TraitedSpec):
     ''' Output spec for Import Mat '''
 
@@ -42,6 +44,9 @@ class ImportMat(BaseInterface):
 
     Import matlab file to numpy ndarry, and save it as numpy file .npy
 
+    Only data_field_name and good_channels_field_name are read; v7.3 (HDF5)
+    files are read lazily with h5py, good channels only
+
     Inputs:
 
     tsmat_file:
@@ -55,6 +60,9 @@ class ImportMat(BaseInterface):
         type = String, default = 'ChannelFlag',
                desc='Boolean structure for choosing nodes, name of structure in matlab file'
 
+    precision
+        type = Enum('float32', 'float64'), default = 'float32', desc='precision of the saved time series', usedefault=True
+
     Outputs:
 
     ts_file
@@ -78,7 +86,7 @@ class ImportMat(BaseInterface):
         if not isdefined(good_channels_field_name):
             good_channels_field_name = None
 
-        self.ts_file = import_tsmat_to_ts(tsmat_file, data_field_name, good_channels_field_name)
+        self.ts_file = import_tsmat_to_ts(tsmat_file, data_field_name, good_channels_field_name, precision=self.inputs.precision)
 
         return runtime
 
@@ -112,6 +120,8 @@ class ImportBrainVisionAsciiInputSpec(BaseInterfaceInputSpec):
 
     sep = traits.Str(";", desc="Separator between time points", usedefault=True)
 
+    precision = traits.Enum('float64', 'float32', desc='precision of the saved time series', usedefault=True)
+
 class ImportBrainVisionAsciiOutputSpec(TraitedSpec):
     ''' Output specification for ImportBrainVisionAscii '''
 
@@ -146,6 +156,9 @@ class ImportBrainVisionAscii(BaseInterface):
     sep
         type = String, default = ";","Separator between time points",usedefault = True)
 
+    precision
+        type = Enum('float64', 'float32'), default = 'float64', desc='precision of the saved time series', usedefault=True
+
     Outputs:
 
     splitted_ts_file
@@ -175,7 +188,8 @@ class ImportBrainVisionAscii(BaseInterface):
         sep = self.inputs.sep
 
         split_txt(txt_file=txt_file, sample_size=sample_size,
-                  sep_label_name=sep_label_name, repair=repair, sep=sep)
+                  sep_label_name=sep_label_name, repair=repair, sep=sep,
+                  precision=self.inputs.precision)
 
         return runtime
 
@@ -197,6 +211,12 @@ class Ep2tsInputSpec(BaseInterfaceInputSpec):
     ''' Input specification for Ep2ts '''
     fif_file = File(exists=True, desc='fif file with epochs', mandatory=True)
 
+    precision = traits.Enum('float64', 'float32', desc='precision of the saved time series', usedefault=True)
+
+    ch_types = traits.List(traits.String, ['meg'], desc='types of the channels kept (meg, mag, grad, eeg, eog, ecg, seeg...)', usedefault=True)
+
+    chunk_size = traits.Int(desc='if set, number of epochs read at once and written in a memory-mapped .npy file', mandatory=False)
+
 
 class Ep2tsOutputSpec(TraitedSpec):
     ''' Output specification for Ep2ts '''
@@ -211,8 +231,23 @@ class Ep2ts(BaseInterface):
 
     Inputs:
 
+    fif_file
+        type = File, exists=True, desc='fif file with epochs', mandatory=True
+
+    precision
+        type = Enum('float64', 'float32'), default = 'float64', desc='precision of the saved time series', usedefault=True
+
+    ch_types
+        type = List(String), default = ['meg'], desc='types of the channels kept (meg, mag, grad, eeg, eog, ecg, seeg...)', usedefault=True
+
+    chunk_size
+        type = Int, desc='if set, number of epochs read at once and written in a memory-mapped .npy file', mandatory=False
+
     Outputs:
 
+    ts_file
+        type = File, exists=True, desc="time series in .npy format"
+
     """
     input_spec = Ep2tsInputSpec
     output_spec = Ep2tsOutputSpec
@@ -223,7 +258,10 @@ class Ep2ts(BaseInterface):
 
         fif_file = self.inputs.fif_file
 
-        self.ts_file = ep2ts(fif_file=fif_file)
+        chunk_size = self.inputs.chunk_size if isdefined(self.inputs.chunk_size) else None
+
+        self.ts_file = ep2ts(fif_file=fif_file, precision=self.inputs.precision,
+                             ch_types=self.inputs.ch_types, chunk_size=chunk_size)
 
         return runtime
 
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Compact storage of connectivity matrices
+
+Conmats computed by the spectral module are lower triangular (zero diagonal),
+so only the n * (n - 1) / 2 values of the triangle are kept, in float32, in
+a .npz file with the number of nodes and (optionally) the node names in the
+order of the matrix rows. Values are stored in the order of the upper
+triangle of the symmetric matrix (np.triu_indices(n_nodes, 1)).
+
+Stacks of conmats (bands, windows...) are packed as (..., n_pairs) arrays.
+Complex conmats (cohy) are packed in complex64.
+
+Connectivity computed on a subset of pairs (seeds, targets) is stored in
+sparse COO format: row (seeds), col (targets), data (..., n_pairs), shape and
+the connectivity method (to reorient pairs with seed < target when loaded).
+"""
+
+import numpy as np
+
+
+def pack_conmat(conmat, dtype=np.float32):
+    """
+    Pack lower triangular conmat(s) of shape (..., n_nodes, n_nodes) into (..., n_pairs)
+
+    Complex conmats are packed in the complex dtype of the same precision (complex64 for float32)
+    """
+    n_nodes = conmat.shape[-1]
+
+    if np.iscomplexobj(conmat):
+        dtype = np.result_type(dtype, np.complex64)
+
+    triu_indices = np.triu_indices(n_nodes, 1)
+
+    ### upper triangle of the symmetric matrix = lower triangle of conmat
+    return np.asarray(conmat.swapaxes(-1, -2)[..., triu_indices[0], triu_indices[1]], dtype=dtype)
+
+
+def unpack_conmat(packed, n_nodes, symmetric=False):
+    """
+    Expand packed values (..., n_pairs) into lower triangular (or symmetric) conmat(s)
+    """
+    triu_indices = np.triu_indices(n_nodes, 1)
+
+    conmat = np.zeros(packed.shape[:-1] + (n_nodes, n_nodes), dtype=packed.dtype)
+
+    conmat[..., triu_indices[1], triu_indices[0]] = packed
+
+    if symmetric:
+        conmat[..., triu_indices[0], triu_indices[1]] = packed
+
+    return conmat
+
+
+def save_packed_conmat(conmat_file, conmat, node_names=None, dtype=np.float32):
+    """
+    Save lower triangular conmat(s) in packed format (.npz)
+    """
+    n_nodes = conmat.shape[-1]
+
+    assert conmat.shape[-2] == n_nodes, "Error, conmat should be squared, {} != {}".format(conmat.shape[-2], n_nodes)
+
+    if node_names is None:
+        node_names = []
+
+    assert len(node_names) in [0, n_nodes], "Error, {} node names for {} nodes".format(len(node_names), n_nodes)
+
+    np.savez(conmat_file, packed=pack_conmat(conmat, dtype), n_nodes=n_nodes,
+             node_names=np.array(node_names, dtype=str), format='packed_triu')
+
+    return conmat_file
+
+
+class PackedConmat(object):
+    """
+    Reader for packed conmat files, expanding matrices only when requested
+
+    Example:
+
+    >> packed_conmat = PackedConmat('conmat_0_coh_bands.npz')
+    >> packed_conmat.shape            # (n_bands, n_nodes, n_nodes)
+    >> conmat = packed_conmat[2]      # only the third matrix is expanded
+    >> packed_conmat.close()
+
+    or, closing the file automatically:
+
+    >> with PackedConmat('conmat_0_coh_bands.npz') as packed_conmat:
+    >>     conmat = packed_conmat[2]
+
+    """
+    def __init__(self, conmat_file):
+
+        self.conmat_file = conmat_file
+
+        self._npz = np.load(conmat_file)
+
+        assert 'packed' in self._npz.files, "Error, {} is not a packed conmat file".format(conmat_file)
+
+        self.n_nodes = int(self._npz['n_nodes'])
+        self.node_names = self._npz['node_names'].tolist()
+
+        self._packed = None
+
+    @property
+    def packed(self):
+
+        if self._packed is None:
+            self._packed = self._npz['packed']
+
+        return self._packed
+
+    @property
+    def shape(self):
+
+        return self.packed.shape[:-1] + (self.n_nodes, self.n_nodes)
+
+    @property
+    def ndim(self):
+
+        return len(self.shape)
+
+    def __len__(self):
+
+        return self.shape[0]
+
+    def __getitem__(self, index):
+
+        return unpack_conmat(self.packed[index], self.n_nodes)
+
+    def to_dense(self, symmetric=False):
+
+        return unpack_conmat(self.packed, self.n_nodes, symmetric=symmetric)
+
+    def close(self):
+
+        self._npz.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+
+def save_sparse_conmat(conmat_file, indices, data, n_nodes, con_method=None):
+    """
+    Save connectivity of a subset of pairs in COO format (.npz)
+
+    indices : (seeds, targets), data : (..., n_pairs)
+    """
+    seeds, targets = indices
+
+    assert data.shape[-1] == len(seeds), "Error, {} values for {} pairs".format(data.shape[-1], len(seeds))
+
+    sparse_conmat = dict(row=np.asarray(seeds, dtype=int), col=np.asarray(targets, dtype=int),
+                         data=data, shape=np.array((n_nodes, n_nodes)), format='coo')
+
+    if con_method is not None:
+        sparse_conmat['con_method'] = con_method
+
+    np.savez(conmat_file, **sparse_conmat)
+
+    return conmat_file
+
+
+def load_sparse_conmat(conmat_file):
+    """
+    Load a sparse conmat file as a scipy.sparse.coo_matrix (or a list of them for stacked conmats)
+    """
+    from scipy.sparse import coo_matrix
+
+    with np.load(conmat_file) as npz:
+        row, col, data, shape = npz['row'], npz['col'], npz['data'], tuple(npz['shape'])
+
+    if data.ndim == 1:
+        return coo_matrix((data, (row, col)), shape=shape)
+
+    return [coo_matrix((band_data, (row, col)), shape=shape) for band_data in data]
+
+
+def _has_npz_key(npz_file, key):
+
+    if not npz_file.endswith('.npz'):
+        return False
+
+    with np.load(npz_file) as npz:
+        return key in npz.files
+
+
+def is_sparse_conmat_file(conmat_file):
+
+    return _has_npz_key(conmat_file, 'row')
+
+
+def is_packed_conmat_file(conmat_file):
+
+    return _has_npz_key(conmat_file, 'packed')
+
+
+def read_node_names(conmat_file):
+    """
+    Node names saved in a packed conmat file ([] for other files, or if no names were saved)
+    """
+    if not is_packed_conmat_file(conmat_file):
+        return []
+
+    with np.load(conmat_file) as npz:
+        return npz['node_names'].tolist()
+
+
+def reverse_pair_orientation(data, con_method):
+    """
+    Connectivity target -> seed from seed -> target values: imcoh changes sign,
+    cohy is conjugated, the other methods are symmetric
+    """
+    if con_method == 'imcoh':
+        return -data
+
+    if con_method == 'cohy':
+        return np.conj(data)
+
+    return data
+
+
+def load_conmat(conmat_file, symmetric=False):
+    """
+    Load a conmat file as a dense array, either .npy (dense), .npz (packed) or sparse .npz
+
+    Pairs of sparse conmats are put in the lower triangle (row > col), as the
+    other conmats; pairs with row < col are reoriented (see reverse_pair_orientation),
+    so that conmat[i, j] is always the connectivity i -> j
+    """
+    if is_sparse_conmat_file(conmat_file):
+
+        with np.load(conmat_file) as npz:
+            row, col, data, shape = npz['row'], npz['col'], npz['data'], tuple(npz['shape'])
+            con_method = str(npz['con_method']) if 'con_method' in npz.files else None
+
+        lower_row, lower_col = np.maximum(row, col), np.minimum(row, col)
+
+        pairs = lower_row * shape[1] + lower_col
+
+        assert len(np.unique(pairs)) == len(pairs), \
+            "Error, some pairs of {} are given twice (or in both directions)".format(conmat_file)
+
+        reversed_pairs = row < col
+
+        if np.any(reversed_pairs):
+
+            assert con_method is not None, \
+                "Error, pairs with row < col cannot be reoriented, con_method is not saved in {}".format(conmat_file)
+
+            data = data.copy()
+            data[..., reversed_pairs] = reverse_pair_orientation(data[..., reversed_pairs], con_method)
+
+        conmat = np.zeros(data.shape[:-1] + shape, dtype=data.dtype)
+
+        conmat[..., lower_row, lower_col] = data
+
+        if symmetric:
+            conmat = conmat + conmat.swapaxes(-1, -2)
+
+        return conmat
+
+    if is_packed_conmat_file(conmat_file):
+        with PackedConmat(conmat_file) as packed_conmat:
+            return packed_conmat.to_dense(symmetric=symmetric)
+
+    conmat = np.load(conmat_file)
+
+    if symmetric:
+        conmat = conmat + conmat.swapaxes(-1, -2)
+
+    return conmat
+
+
+def export_conmat_to_matlab(conmat_file, conmat_matfile=None):
+    """
+    Export a conmat file (dense or packed) to a symmetric conmat in .mat format
+    """
+    import os
+
+    from scipy.io import savemat
+
+    if conmat_matfile is None:
+        conmat_matfile = os.path.abspath(os.path.splitext(os.path.basename(conmat_file))[0] + ".mat")
+
+    conmat = load_conmat(conmat_file)
+
+    ### symmetrize the last two dimensions (transpose only them for stacked conmats)
+    savemat(conmat_matfile, {"conmat": conmat + conmat.swapaxes(-1, -2)})
+
+    return conmat_matfile
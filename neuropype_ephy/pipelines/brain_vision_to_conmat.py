@@ -19,7 +19,7 @@ from neuropype_ephy.nodes.ts_tools import SplitWindows
 ###TODO
 #from neuropype_ephy.nodes.? import filter_adj_plot_mat
 
-def create_pipeline_brain_vision_ascii_to_spectral_connectivity(main_path,pipeline_name="brain_vision_to_conmat", con_method = "coh", sample_size = 512, sep_label_name = "", sfreq = 512,filter_spectral = True, k_neigh = 3, n_windows = [], multicon = False):
+def create_pipeline_brain_vision_ascii_to_spectral_connectivity(main_path,pipeline_name="brain_vision_to_conmat", con_method = "coh", sample_size = 512, sep_label_name = "", sfreq = 512,filter_spectral = True, k_neigh = 3, n_windows = [], multicon = False, precision = 'float64'):
     
     """
     Description:
@@ -27,6 +27,8 @@ def create_pipeline_brain_vision_ascii_to_spectral_connectivity(main_path,pipeli
     Create pipeline from intraEEG times series in ascii format exported out of BrainVision, split txt and compute spectral connectivity.
     Possibly also filter out connections between "adjacent" contacts (on the same electrode)
     
+    precision ('float64' or 'float32') is the precision of the imported time series,
+    of the computation and of the saved conmats
     
     """
     pipeline = pe.Workflow(name=pipeline_name )
@@ -43,6 +45,7 @@ def create_pipeline_brain_vision_ascii_to_spectral_connectivity(main_path,pipeli
     
     split_ascii.inputs.sample_size = sample_size
     split_ascii.inputs.sep_label_name = sep_label_name
+    split_ascii.inputs.precision = precision
     
     pipeline.connect(inputnode, 'txt_file',split_ascii,'txt_file')
 
@@ -60,6 +63,7 @@ def create_pipeline_brain_vision_ascii_to_spectral_connectivity(main_path,pipeli
             
             spectral.inputs.con_method = con_method    
             spectral.inputs.sfreq = sfreq
+            spectral.inputs.precision = precision
             
             pipeline.connect(inputnode, 'freq_band', spectral, 'freq_band')
             
@@ -132,6 +136,7 @@ def create_pipeline_brain_vision_ascii_to_spectral_connectivity(main_path,pipeli
             
             spectral.inputs.con_method = con_method    
             spectral.inputs.sfreq = sfreq
+            spectral.inputs.precision = precision
             
             #spectral.inputs.epoch_window_length = epoch_window_length
             pipeline.connect(win_ts, 'win_ts_files', spectral, 'ts_file')
@@ -11,11 +11,31 @@ from nipype.interfaces.utility import IdentityInterface
 
 from neuropype_ephy.interfaces.mne.spectral import  SpectralConn,PlotSpectralConn
 
+from neuropype_ephy.aux_tools import get_n_jobs
+
 ### to modify and add in "Nodes"
 #from neuropype_ephy.spectral import  filter_adj_plot_mat
 
-def create_pipeline_time_series_to_spectral_connectivity( main_path, pipeline_name = "ts_to_conmat",con_method = "coh", multicon = False, export_to_matlab = False, temporal_windows = []):
+def create_pipeline_time_series_to_spectral_connectivity( main_path, pipeline_name = "ts_to_conmat",con_method = "coh", multicon = False, export_to_matlab = False, temporal_windows = [], n_jobs = 1, use_cache = False, precision = 'float64'):
+    
+    """
+    Description:
+    
+    Compute spectral connectivity of time series and plot it.
+    
+    n_jobs is the number of processes used by each spectral node (-1 for all cpus);
+    it is also declared as n_procs of the node, so that nipype MultiProc plugin
+    reserves the corresponding cpus and does not oversubscribe the machine
+    
+    If use_cache is True, spectral nodes reuse the results of identical time
+    series and parameters from a disk cache (see SpectralConn), even if upstream
+    nodes were rerun
+    
+    precision ('float64' or 'float32') is the precision of the computation and
+    of the saved conmats (float32 halves memory and disk usage)
+    """
     
+    n_jobs = get_n_jobs(n_jobs)
     
     pipeline = pe.Workflow(name= pipeline_name)
     pipeline.base_dir = main_path
@@ -29,6 +49,10 @@ def create_pipeline_time_series_to_spectral_connectivity( main_path, pipeline_na
         
         spectral.inputs.con_method = con_method  
         spectral.inputs.export_to_matlab = export_to_matlab
+        spectral.inputs.n_jobs = n_jobs
+        spectral.n_procs = n_jobs
+        spectral.inputs.use_cache = use_cache
+        spectral.inputs.precision = precision
         
         pipeline.connect(inputnode, 'sfreq', spectral, 'sfreq')
         pipeline.connect(inputnode, 'ts_file', spectral, 'ts_file')
@@ -84,6 +108,10 @@ def create_pipeline_time_series_to_spectral_connectivity( main_path, pipeline_na
         
         spectral.inputs.con_method = con_method  
         spectral.inputs.export_to_matlab = export_to_matlab
+        spectral.inputs.n_jobs = n_jobs
+        spectral.n_procs = n_jobs
+        spectral.inputs.use_cache = use_cache
+        spectral.inputs.precision = precision
         
         pipeline.connect(inputnode, 'sfreq', spectral, 'sfreq')
         pipeline.connect(inputnode, 'ts_file', spectral, 'ts_file')
@@ -1,29 +1,504 @@
-def compute_and_save_psd(epochs_fname, fmin=0, fmax=120,
-                         method='welch', n_fft=256, n_overlap=0, 
-                         picks=None, proj=False, n_jobs=1, verbose=None):
+def is_epochs_file(fname):
     """
-    Load epochs from file,
-    compute psd and save the result in numpy arrays
+    Whether a fif file contains epochs (rather than raw data), found from its
+    block tree (without reading the data) whatever the file name
+    """
+    from mne.io.constants import FIFF
+    from mne.io.open import fiff_open
+    from mne.io.tree import dir_tree_find
+
+    fid, tree, _ = fiff_open(fname)
+
+    with fid:
+        ### 122 is the epochs block of files saved before mne 0.11
+        return any(len(dir_tree_find(tree, kind)) > 0
+                   for kind in (FIFF.FIFFB_MNE_EPOCHS, 122))
+
+
+def get_psd_picks(info, picks=None):
+    """
+    Indexes of the channels of the psd (default, MEG channels)
     """
     import numpy as np
-    import os
-    from mne import read_epochs
-    epochs = read_epochs(epochs_fname)
-    epochs_meg = epochs.pick_types(meg=True, eeg=False, eog=False, ecg=False)
+    from mne import pick_types
+
+    if picks is None:
+        picks = pick_types(info, meg=True, eeg=False, eog=False, ecg=False)
+
+    return np.asarray(picks, dtype=int)
+
+
+def combine_eigenspectra(power_mt, weights):
+    """
+    psd from eigenspectra powers |x_mt| ** 2 (..., n_tapers, n_freqs) and
+    adaptive taper weights (broadcastable to power_mt)
+    """
+    import numpy as np
+
+    weights = weights ** 2
+
+    return 2. * np.sum(weights * power_mt, axis=-2) / np.sum(weights * np.ones_like(power_mt), axis=-2)
+
+
+def compute_adaptive_psd(power_mt, eigvals, variance, max_iter=150):
+    """
+    psd with adaptive weights (Percival and Walden 1993, as in mne and nitime),
+    iterated for all signals at once; each signal stops when its weights have
+    converged (max over frequencies of the mean squared change < 1e-10)
+
+    power_mt : |x_mt| ** 2, shape (n_signals, n_tapers, n_freqs)
+    variance : variance of each signal, shape (n_signals,)
+
+    Returns psd (n_signals, n_freqs)
+    """
+    import numpy as np
+
+    rt_eig = np.sqrt(eigvals)[:, np.newaxis]
+    eigvals = eigvals[:, np.newaxis]
+
+    # start with an estimate from the first 2 tapers
+    psd = combine_eigenspectra(power_mt[:, :2], rt_eig[:2])
+
+    err = np.zeros_like(power_mt)
+
+    active = np.arange(len(power_mt))
+
+    for n in range(max_iter):
+
+        psd_iter = psd[active][:, np.newaxis, :]
+
+        d_k = psd_iter / (eigvals * psd_iter + (1 - eigvals) * variance[active, np.newaxis, np.newaxis])
+        d_k *= rt_eig
+
+        converged = np.max(np.mean((err[active] - d_k) ** 2, axis=1), axis=-1) < 1e-10
+
+        active, d_k = active[~converged], d_k[~converged]
+
+        if len(active) == 0:
+            break
+
+        # update the iterative estimate with these weights
+        psd[active] = combine_eigenspectra(power_mt[active], d_k)
+        err[active] = d_k
+
+    else:
+        print 'Warning, adaptive weights did not converge for {} signals'.format(len(active))
+
+    return psd
+
+
+def compute_multitaper_psd_block(data, tapers, eigvals, freq_mask, adaptive=False):
+    """
+    Multitaper psd of a block of signals (n_signals, n_times), from the
+    tapered spectra of the multitaper module (the ones of connectivity)
+    """
+    import numpy as np
+
+    from neuropype_ephy.multitaper import compute_eigenspectra, weight_tapered_spectra
+
+    x_mt = compute_eigenspectra(data, tapers)
+
+    if not adaptive:
+        return np.sum(np.abs(weight_tapered_spectra(x_mt[..., freq_mask], eigvals)) ** 2, axis=-2)
+
+    power_mt = np.abs(x_mt) ** 2
+
+    # variance of each signal, from the full band psd with fixed weights
+    psd_est = np.sum(np.abs(weight_tapered_spectra(x_mt, eigvals)) ** 2, axis=-2)
+    variance = np.trapz(psd_est, dx=np.pi / power_mt.shape[-1]) / (2 * np.pi)
+
+    return compute_adaptive_psd(power_mt[..., freq_mask], eigvals, variance)
+
+
+def compute_multitaper_psd(data, sfreq, fmin=0, fmax=120, bandwidth=None,
+                           adaptive=False, low_bias=True, n_jobs=1,
+                           block_size=50e6):
+    """
+    Multitaper psd of data (..., n_times), as mne psd_array_multitaper
+    (normalization = 'length')
+
+    DPSS tapers come from the process-wide cache of the multitaper module, so
+    that they are computed once per (n_times, sfreq, bandwidth). Eigenspectra of
+    all signals (epochs x channels) are computed in one FFT per block of about
+    block_size bytes, blocks being spread over n_jobs. With adaptive, tapers are
+    combined with adaptive weights (if there are at least 3 tapers).
+
+    Returns psds (..., n_freqs) and freqs
+    """
+    import numpy as np
+
+    from neuropype_ephy.multitaper import compute_dpss
+
+    dshape = data.shape[:-1]
+    n_times = data.shape[-1]
+
+    data = data.reshape(-1, n_times)
+
+    tapers, eigvals = compute_dpss(n_times, sfreq, bandwidth, low_bias)
+
+    if adaptive and len(eigvals) < 3:
+        print 'Warning, not adaptively combining the spectral estimators, {} tapers < 3'.format(len(eigvals))
+        adaptive = False
+
+    freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+    freq_mask = (freqs >= fmin) & (freqs <= fmax)
+    freqs = freqs[freq_mask]
+
+    n_block = max(1, int(block_size // (len(freq_mask) * len(eigvals) * 16)))
+
+    blocks = [data[start:start + n_block] for start in range(0, len(data), n_block)]
+
+    if n_jobs == 1 or len(blocks) == 1:
+
+        psds = [compute_multitaper_psd_block(block, tapers, eigvals, freq_mask, adaptive) for block in blocks]
+
+    else:
+
+        from mne.parallel import parallel_func
+
+        parallel, p_compute_multitaper_psd_block, _ = parallel_func(compute_multitaper_psd_block, n_jobs)
+
+        psds = parallel(p_compute_multitaper_psd_block(block, tapers, eigvals, freq_mask, adaptive) for block in blocks)
+
+    return np.concatenate(psds).reshape(dshape + (-1,)), freqs
+
+
+def compute_psd_array(data, sfreq, fmin=0, fmax=120, method='welch', n_fft=256,
+                      n_overlap=0, n_jobs=1, verbose=None, bandwidth=None,
+                      adaptive=False):
+    """
+    psd of an array of shape (..., n_times), channels being spread over n_jobs
+    (bandwidth and adaptive are the multitaper parameters)
+    """
     if method == 'welch':
-        from mne.time_frequency import psd_welch
-        psds, freqs = psd_welch(epochs_meg)
+        from mne.time_frequency import psd_array_welch
+        return psd_array_welch(data, sfreq, fmin=fmin, fmax=fmax, n_fft=n_fft,
+                               n_overlap=n_overlap, n_jobs=n_jobs, verbose=verbose)
     elif method == 'multitaper':
-        from mne.time_frequency import psd_multitaper
-        psds, freqs = psd_multitaper(epochs_meg)
+        return compute_multitaper_psd(data, sfreq, fmin=fmin, fmax=fmax,
+                                      bandwidth=bandwidth, adaptive=adaptive,
+                                      n_jobs=n_jobs)
     else:
         raise Exception('nonexistent method for psd computation')
+
+
+def compute_epochs_psd(epochs_fname, fmin=0, fmax=120, method='welch',
+                       n_fft=256, n_overlap=0, picks=None, proj=False,
+                       n_jobs=1, chunk_size=32, verbose=None, bandwidth=None,
+                       adaptive=False):
+    """
+    psd of each epoch, epochs being read from file chunk_size at a time
+
+    Returns psds (n_epochs, n_channels, n_freqs), freqs and channel names
+    """
+    import numpy as np
+    from mne import read_epochs
+
+    epochs = read_epochs(epochs_fname, proj=proj, preload=False,
+                         verbose=verbose)
+
+    ### bad epochs are known only once they have been read
+    epochs.drop_bad()
+
+    picks = get_psd_picks(epochs.info, picks)
+
+    psds = None
+
+    for start in range(0, len(epochs), chunk_size):
+
+        data = epochs[start:start + chunk_size].get_data()[:, picks]
+
+        chunk_psds, freqs = compute_psd_array(data, epochs.info['sfreq'], fmin,
+                                              fmax, method, n_fft, n_overlap,
+                                              n_jobs, verbose, bandwidth,
+                                              adaptive)
+
+        if psds is None:
+            psds = np.empty((len(epochs),) + chunk_psds.shape[1:])
+
+        psds[start:start + chunk_size] = chunk_psds
+
+    return psds, freqs, [epochs.ch_names[pick] for pick in picks]
+
+
+def compute_raw_psd(raw_fname, fmin=0, fmax=120, method='welch', n_fft=256,
+                    n_overlap=0, picks=None, proj=False, n_jobs=1,
+                    chunk_size=32, verbose=None):
+    """
+    Welch psd of a raw file, read by segments of chunk_size windows of n_fft
+    samples (with n_overlap); the average over windows is accumulated over
+    segments, and is the same as for the whole recording
+
+    Returns psds (n_channels, n_freqs), freqs and channel names
+    """
+    import numpy as np
+    from mne.io import read_raw_fif
+
+    if method != 'welch':
+        raise Exception('only welch psd is computed on raw files, '
+                        'epoch the data for {} psd'.format(method))
+
+    raw = read_raw_fif(raw_fname, preload=False, verbose=verbose)
+
+    if proj:
+        raw.apply_proj()
+
+    picks = get_psd_picks(raw.info, picks)
+
+    step = n_fft - n_overlap
+    n_windows = (raw.n_times - n_fft) // step + 1
+
+    if n_windows < 1:
+        raise ValueError('n_fft ({}) is longer than the recording ({} '
+                         'samples)'.format(n_fft, raw.n_times))
+
+    psds = 0.
+
+    for first_window in range(0, n_windows, chunk_size):
+
+        nb_chunk_windows = min(chunk_size, n_windows - first_window)
+
+        start = first_window * step
+        stop = start + (nb_chunk_windows - 1) * step + n_fft
+
+        data = raw.get_data(picks, start, stop)
+
+        chunk_psds, freqs = compute_psd_array(data, raw.info['sfreq'], fmin,
+                                              fmax, method, n_fft, n_overlap,
+                                              n_jobs, verbose)
+
+        psds = psds + chunk_psds * nb_chunk_windows
+
+    return psds / n_windows, freqs, [raw.ch_names[pick] for pick in picks]
+
+
+def compute_and_save_psd(epochs_fname, fmin=0, fmax=120,
+                         method='welch', n_fft=256, n_overlap=0,
+                         picks=None, proj=False, n_jobs=1, verbose=None,
+                         chunk_size=32, bandwidth=None, adaptive=False):
+    """
+    Load epochs (or raw data) from file by chunks,
+    compute psd and save the result in numpy arrays
+
+    Epochs files give a psd per epoch, raw files a Welch psd of the whole
+    recording (the type is read from the file, whatever its name) (see compute_epochs_psd and compute_raw_psd)
+
+    bandwidth and adaptive are the parameters of multitaper psd (see
+    compute_multitaper_psd), which is only computed on epochs files
+    """
+    import numpy as np
+    import os
+
+    if is_epochs_file(epochs_fname):
+        psds, freqs, ch_names = compute_epochs_psd(epochs_fname, fmin, fmax,
+                                                   method, n_fft, n_overlap,
+                                                   picks, proj, n_jobs,
+                                                   chunk_size, verbose,
+                                                   bandwidth, adaptive)
+    else:
+        psds, freqs, ch_names = compute_raw_psd(epochs_fname, fmin, fmax,
+                                                method, n_fft, n_overlap,
+                                                picks, proj, n_jobs,
+                                                chunk_size, verbose)
+
     path, name = os.path.split(epochs_fname)
     base, ext = os.path.splitext(name)
     psds_fname = base + '-psds.npz'
     # freqs_fname = base + '-freqs.npy'
     psds_fname = os.path.abspath(psds_fname)
     # print(psds.shape)
-    np.savez(psds_fname, psds=psds, freqs=freqs)
+    np.savez(psds_fname, psds=psds, freqs=freqs,
+             ch_names=np.array(ch_names, dtype=str))
     # np.save(freqs_file, freqs)
     return psds_fname
+
+
+def compute_band_power(psds, freqs, freq_bands):
+    """
+    Power integrated in each band (f_lower <= f < f_upper) of psds (..., n_freqs),
+    computed for all bands at once as a product with a (n_freqs, n_bands) weight matrix
+
+    Returns band powers (..., n_bands)
+    """
+    import numpy as np
+
+    freqs = np.asarray(freqs)
+
+    df = freqs[1] - freqs[0] if len(freqs) > 1 else 1.
+
+    weights = np.array([(freqs >= f_lower) & (freqs < f_upper)
+                        for f_lower, f_upper in freq_bands], dtype=float).T * df
+
+    return np.dot(psds, weights)
+
+
+def compute_and_save_band_power(epochs_fnames, freq_bands, band_names=None,
+                                fmin=0, fmax=120, method='welch', n_fft=256,
+                                n_overlap=0, picks=None, proj=False, n_jobs=1,
+                                verbose=None, chunk_size=32, bandwidth=None,
+                                adaptive=False):
+    """
+    Band powers of several epochs (or raw) files, saved in a single .npz file,
+    psds being reduced to bands without being saved
+
+    band_power has shape (n_files, n_epochs, n_channels, n_bands); files with
+    less epochs than the others are padded with nan (n_epochs gives the number
+    of epochs of each file, 1 for raw files)
+    """
+    import numpy as np
+    import os
+
+    if band_names is None:
+        band_names = ['{}-{}Hz'.format(f_lower, f_upper)
+                      for f_lower, f_upper in freq_bands]
+
+    assert len(band_names) == len(freq_bands), \
+        "Error, {} names for {} bands".format(len(band_names), len(freq_bands))
+
+    all_band_power = []
+    all_ch_names = None
+
+    for epochs_fname in epochs_fnames:
+
+        if is_epochs_file(epochs_fname):
+            psds, freqs, ch_names = compute_epochs_psd(epochs_fname, fmin,
+                                                       fmax, method, n_fft,
+                                                       n_overlap, picks, proj,
+                                                       n_jobs, chunk_size,
+                                                       verbose, bandwidth,
+                                                       adaptive)
+        else:
+            psds, freqs, ch_names = compute_raw_psd(epochs_fname, fmin, fmax,
+                                                    method, n_fft, n_overlap,
+                                                    picks, proj, n_jobs,
+                                                    chunk_size, verbose)
+            psds = psds[np.newaxis]
+
+        if all_ch_names is None:
+            all_ch_names = ch_names
+
+        assert ch_names == all_ch_names, \
+            "Error, channels of {} differ from the ones of {}".format(
+                epochs_fname, epochs_fnames[0])
+
+        all_band_power.append(compute_band_power(psds, freqs, freq_bands))
+
+    n_epochs = np.array([len(band_power) for band_power in all_band_power])
+
+    band_powers = np.full((len(epochs_fnames), n_epochs.max(),
+                           len(all_ch_names), len(freq_bands)), np.nan)
+
+    for i, band_power in enumerate(all_band_power):
+        band_powers[i, :len(band_power)] = band_power
+
+    if len(epochs_fnames) == 1:
+        base, ext = os.path.splitext(os.path.basename(epochs_fnames[0]))
+        band_power_fname = os.path.abspath(base + '-band_power.npz')
+    else:
+        band_power_fname = os.path.abspath('band_power.npz')
+
+    np.savez(band_power_fname, band_power=band_powers, n_epochs=n_epochs,
+             freq_bands=np.array(freq_bands, dtype=float),
+             band_names=np.array(band_names, dtype=str),
+             ch_names=np.array(all_ch_names, dtype=str),
+             files=np.array(epochs_fnames, dtype=str))
+
+    return band_power_fname
+
+
+def compute_tfr_block(data, fft_wavelets, offsets, fsize, decim=1, n_jobs=1):
+    """
+    Morlet power of a block of epochs (n_epochs, n_channels, n_times), from
+    the wavelet FFTs of morlet.compute_morlet_fft (computed once for all
+    blocks), frequencies being spread over n_jobs
+
+    Returns power (n_epochs, n_channels, n_freqs, n_decim_times)
+    """
+    import numpy as np
+    from neuropype_ephy.morlet import compute_morlet_power
+
+    n_times = data.shape[-1]
+
+    fft_data = np.fft.fft(data, fsize)
+
+    if n_jobs == 1:
+        return compute_morlet_power(fft_data, fft_wavelets, offsets, n_times,
+                                    decim)
+
+    from mne.parallel import parallel_func
+
+    parallel, p_compute_morlet_power, _ = parallel_func(compute_morlet_power,
+                                                        n_jobs)
+
+    freq_batches = np.array_split(np.arange(len(fft_wavelets)), n_jobs)
+
+    return np.concatenate(parallel(
+        p_compute_morlet_power(fft_data, fft_wavelets[batch], offsets[batch],
+                               n_times, decim)
+        for batch in freq_batches if len(batch)), axis=-2)
+
+
+def compute_and_save_tfr(epochs_fname, freqs, n_cycles=7., decim=1,
+                         picks=None, proj=False, n_jobs=1, chunk_size=32,
+                         precision='float64', verbose=None):
+    """
+    Time-frequency (Morlet wavelet) power of each epoch
+
+    Epochs are read chunk_size at a time, and their power is written in a
+    memory-mapped (n_epochs, n_channels, n_freqs, n_decim_times) array in
+    .npy format, so that only the output file has to hold the whole result.
+    Frequencies, decimated times and channel names are saved in a .npz file.
+
+    Returns tfr_fname and tfr_info_fname
+    """
+    import numpy as np
+    import os
+    from mne import read_epochs
+
+    from neuropype_ephy.aux_tools import get_float_dtype, get_n_jobs
+    from neuropype_ephy.morlet import compute_morlet_fft
+
+    n_jobs = get_n_jobs(n_jobs)
+
+    freqs = np.asarray(freqs, dtype=float)
+
+    epochs = read_epochs(epochs_fname, proj=proj, preload=False,
+                         verbose=verbose)
+
+    ### bad epochs are known only once they have been read
+    epochs.drop_bad()
+
+    picks = get_psd_picks(epochs.info, picks)
+
+    times = epochs.times[::decim]
+
+    path, name = os.path.split(epochs_fname)
+    base, ext = os.path.splitext(name)
+    tfr_fname = os.path.abspath(base + '-tfr.npy')
+    tfr_info_fname = os.path.abspath(base + '-tfr_info.npz')
+
+    tfr = np.lib.format.open_memmap(tfr_fname, mode='w+',
+                                    dtype=get_float_dtype(precision),
+                                    shape=(len(epochs), len(picks),
+                                           len(freqs), len(times)))
+
+    ### all epochs have the same length, wavelets are transformed once
+    fft_wavelets, offsets, fsize = compute_morlet_fft(len(epochs.times),
+                                                      epochs.info['sfreq'],
+                                                      freqs, n_cycles)
+
+    for start in range(0, len(epochs), chunk_size):
+
+        data = epochs[start:start + chunk_size].get_data()[:, picks]
+
+        tfr[start:start + chunk_size] = compute_tfr_block(
+            data, fft_wavelets, offsets, fsize, decim, n_jobs)
+
+    tfr.flush()
+    del tfr
+
+    np.savez(tfr_info_fname, freqs=freqs, times=times,
+             ch_names=np.array([epochs.ch_names[pick] for pick in picks],
+                               dtype=str))
+
+    return tfr_fname, tfr_info_fname
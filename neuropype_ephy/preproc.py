@@ -154,7 +154,7 @@ def create_reject_dict(raw_info):
     return reject
 
 
-def create_ts(raw_fname):
+def create_ts(raw_fname, precision='float64'):
 
     import os
     import numpy as np
@@ -164,6 +164,8 @@ def create_ts(raw_fname):
 
     from nipype.utils.filemanip import split_filename as split_f
 
+    from neuropype_ephy.aux_tools import cast_to_precision
+
     raw = Raw(raw_fname, preload=True)
 
     subj_path, basename, ext = split_f(raw_fname)
@@ -190,7 +192,7 @@ def create_ts(raw_fname):
     print data.shape
 
     ts_file = os.path.abspath(basename + '.npy')
-    np.save(ts_file, data)
+    np.save(ts_file, cast_to_precision(data, precision))
     print '\n *** TS FILE ' + ts_file + '*** \n'
 
     return ts_file, channel_coords_file, channel_names_file, raw.info['sfreq']
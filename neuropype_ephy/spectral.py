@@ -5,97 +5,1467 @@ import numpy as np
 
 ################################################### compute spectral connectivity #############################################################################"
 
-def compute_and_save_spectral_connectivity(data,con_method,sfreq,fmin,fmax,index = 0,mode = 'multitaper',export_to_matlab = False):
+def compute_spectral_connectivity_bands(data,con_method,sfreq,freq_bands,mode = 'multitaper',n_jobs = 1,chunk_size = None,cwt_freqs = None,cwt_n_cycles = None):
+    """
+    Compute spectral connectivity for several frequency bands at once
 
-    import sys,os
-    from mne.connectivity import spectral_connectivity
+    Tapered spectra and cross-spectra are computed only once, and averaged
+    within each band. In multitaper mode, they are computed by the engine of
+    streaming_spectral_connectivity (DPSS tapers from the cache of the
+    multitaper module, cross-spectra reduced with einsum), the same estimates
+    as spectral_connectivity with mt_adaptive = False.
+
+    Epochs are spread over n_jobs processes (see aux_tools.get_n_jobs).
+
+    If chunk_size is set (multitaper only), data can be memory-mapped: epochs
+    are read and their cross-spectra accumulated chunk_size epochs at a time
+    (see streaming_spectral_connectivity). A ValueError is raised for
+    cwt_morlet and envelope methods, which are not computed by chunks.
+
+    In cwt_morlet mode, connectivity is averaged over time and within bands
+    (see morlet_spectral_connectivity for cwt_freqs and cwt_n_cycles).
+
+    con_method can also be aec or aec_orth (amplitude envelope correlation,
+    see envelope_connectivity_bands), whatever the mode.
+
+    Returns an array of shape (n_bands, nb_nodes, nb_nodes) (lower triangular),
+    or None if mode is not implemented
+    """
+
+    import sys
+
+    import numpy as np
+
+    from neuropype_ephy.aux_tools import get_n_jobs
+
+    n_jobs = get_n_jobs(n_jobs)
+
+    if chunk_size is not None:
+
+        if mode != 'multitaper' or con_method in ['aec','aec_orth']:
+            raise ValueError("streaming (chunk_size) is only implemented for multitaper spectral methods, not for {} in {} mode".format(con_method,mode))
+
+        if len(data.shape) < 3:
+            print "Warning, data are not epoched, streaming reads the whole time series at once (set epoch_window_length)"
+
+    if len(data.shape) < 3:
+        if con_method in ['coh','cohy','imcoh','aec','aec_orth']:
+            data = data.reshape(1,data.shape[0],data.shape[1])
+
+        elif con_method in ['pli','plv','ppc' ,'pli','pli2_unbiased' ,'wpli' ,'wpli2_debiased']:
+            print "warning, only work with epoched time series"
+            sys.exit()
+
+    if con_method in ['aec','aec_orth']:
+
+        from neuropype_ephy.spectral import envelope_connectivity_bands
+
+        ### envelope methods do not depend on mode
+        con_matrices = envelope_connectivity_bands(np.asarray(data),con_method,sfreq,freq_bands,n_jobs = n_jobs)
+
+    elif mode == 'multitaper' and chunk_size is not None:
+
+        from neuropype_ephy.spectral import streaming_spectral_connectivity
+
+        con_matrices = streaming_spectral_connectivity(data,con_method,sfreq,freq_bands,chunk_size = chunk_size,n_jobs = n_jobs)
+
+    elif mode == 'multitaper':
+
+        from neuropype_ephy.spectral import streaming_spectral_connectivity
+
+        ### data are in memory, epochs are split in chunks of at most 32 epochs, spread over n_jobs
+        con_matrices = streaming_spectral_connectivity(data,con_method,sfreq,freq_bands,chunk_size = min(32,int(np.ceil(data.shape[0] / float(n_jobs)))),n_jobs = n_jobs)
+
+    elif mode == 'cwt_morlet':
+
+        from neuropype_ephy.spectral import morlet_spectral_connectivity
+
+        ### time-averaged connectivity, without the (nb_nodes, nb_nodes, n_freqs, n_times) array of spectral_connectivity
+        con_matrices = morlet_spectral_connectivity(data,con_method,sfreq,freq_bands,cwt_freqs = cwt_freqs,cwt_n_cycles = cwt_n_cycles,n_jobs = n_jobs)
+
+    else:
+
+        print "Error, mode = %s not implemented"%(mode)
+
+        return None
+
+    return con_matrices
+
+def save_conmat(basename,con_matrix,packed = False,node_names = None,precision = None):
+    """
+    Save conmat(s) as basename.npy (dense), or basename.npz in packed float32 format
+
+    If precision is set ('float32' or 'float64'), dense conmats are saved in this precision
+
+    Returns the absolute path of the saved file
+    """
+
+    import os
+
+    import numpy as np
+
+    from neuropype_ephy.packed_conmat import save_packed_conmat
+    from neuropype_ephy.aux_tools import cast_to_precision
+
+    if precision is not None:
+        con_matrix = cast_to_precision(con_matrix,precision)
+
+    if packed == True:
+
+        conmat_file = os.path.abspath(basename + ".npz")
+
+        save_packed_conmat(conmat_file,con_matrix,node_names = node_names)
+
+    else:
+
+        conmat_file = os.path.abspath(basename + ".npy")
+
+        np.save(conmat_file,con_matrix)
+
+    return conmat_file
+
+def compute_and_save_spectral_connectivity(data,con_method,sfreq,fmin,fmax,index = 0,mode = 'multitaper',export_to_matlab = False,n_jobs = 1,chunk_size = None,packed = False,node_names = None,indices = None,cwt_freqs = None,cwt_n_cycles = None,precision = None):
+
+    import numpy as np
+
+    from neuropype_ephy.spectral import compute_spectral_connectivity_bands, save_conmat
+    from neuropype_ephy.packed_conmat import export_conmat_to_matlab
+
+    print data.shape
+
+    if indices is not None:
+
+        ### only a subset of pairs, saved as a sparse conmat
+        from neuropype_ephy.spectral import compute_and_save_pair_spectral_connectivity
+
+        conmat_files,stacked_conmat_file = compute_and_save_pair_spectral_connectivity(data,con_method,sfreq,[[fmin,fmax]],indices,index = index,export_to_matlab = export_to_matlab,chunk_size = chunk_size,precision = precision,mode = mode,n_jobs = n_jobs,packed = packed)
+
+        return conmat_files[0]
+
+    con_matrices = compute_spectral_connectivity_bands(data,con_method,sfreq,freq_bands = [[fmin,fmax]],mode = mode,n_jobs = n_jobs,chunk_size = chunk_size,cwt_freqs = cwt_freqs,cwt_n_cycles = cwt_n_cycles)
+
+    if con_matrices is None:
+
+        return []
+
+    con_matrix = con_matrices[0]
+
+    print con_matrix.shape
+    print np.min(con_matrix),np.max(con_matrix)
+
+    conmat_file = save_conmat("conmat_" + str(index) + "_" + con_method,con_matrix,packed = packed,node_names = node_names,precision = precision)
+
+    if export_to_matlab == True:
+        
+        export_conmat_to_matlab(conmat_file)
+        
+    return conmat_file
+
+def compute_and_save_multiband_spectral_connectivity(data,con_method,sfreq,freq_bands,freq_band_names = None,index = 0,mode = 'multitaper',export_to_matlab = False,n_jobs = 1,chunk_size = None,packed = False,node_names = None,indices = None,cwt_freqs = None,cwt_n_cycles = None,precision = None):
+    """
+    Compute spectral connectivity for all frequency bands in a single pass,
+    and save one conmat per band, as well as all conmats stacked in a
+    (n_bands, nb_nodes, nb_nodes) array
+
+    If packed is True, conmats are saved in packed float32 format (see packed_conmat)
+
+    Returns the list of per-band conmat files and the stacked conmat file
+    """
+    import numpy as np
+
+    from neuropype_ephy.spectral import compute_spectral_connectivity_bands, save_conmat
+    from neuropype_ephy.packed_conmat import export_conmat_to_matlab
+
+    print data.shape
+
+    if freq_band_names is None or len(freq_band_names) == 0:
+        freq_band_names = [str(i) for i in range(len(freq_bands))]
+
+    assert len(freq_band_names) == len(freq_bands), "Error, freq_band_names ({}) and freq_bands ({}) should have the same length".format(len(freq_band_names),len(freq_bands))
+
+    if indices is not None:
+
+        ### only a subset of pairs, saved as sparse conmats
+        from neuropype_ephy.spectral import compute_and_save_pair_spectral_connectivity
+
+        return compute_and_save_pair_spectral_connectivity(data,con_method,sfreq,freq_bands,indices,freq_band_names = freq_band_names,index = index,export_to_matlab = export_to_matlab,chunk_size = chunk_size,precision = precision,mode = mode,n_jobs = n_jobs,packed = packed)
+
+    con_matrices = compute_spectral_connectivity_bands(data,con_method,sfreq,freq_bands = freq_bands,mode = mode,n_jobs = n_jobs,chunk_size = chunk_size,cwt_freqs = cwt_freqs,cwt_n_cycles = cwt_n_cycles)
+
+    if con_matrices is None:
+
+        return [],[]
+
+    print con_matrices.shape
+
+    stacked_conmat_file = save_conmat("conmat_" + str(index) + "_" + con_method + "_bands",con_matrices,packed = packed,node_names = node_names,precision = precision)
+
+    conmat_files = []
+
+    for freq_band_name,con_matrix in zip(freq_band_names,con_matrices):
+
+        print freq_band_name
+        print np.min(con_matrix),np.max(con_matrix)
+
+        conmat_file = save_conmat("conmat_" + str(index) + "_" + con_method + "_" + freq_band_name,con_matrix,packed = packed,node_names = node_names,precision = precision)
+
+        if export_to_matlab == True:
+
+            export_conmat_to_matlab(conmat_file)
+
+        conmat_files.append(conmat_file)
+
+    return conmat_files,stacked_conmat_file
+
+def compute_and_save_pair_spectral_connectivity(data,con_method,sfreq,freq_bands,indices,freq_band_names = None,index = 0,export_to_matlab = False,chunk_size = None,precision = None,mode = 'multitaper',n_jobs = 1,packed = False):
+    """
+    Compute multitaper spectral connectivity for a subset of pairs (seeds, targets)
+    and save it in sparse (COO) format, one file per band and all bands stacked
+
+    A ValueError is raised for cwt_morlet mode and envelope methods, which
+    are not computed for pairs; packed is ignored (pairs are always sparse).
+
+    Returns the list of per-band conmat files and the stacked conmat file
+    """
+
+    import os
+    import sys
+
+    import numpy as np
+
+    from neuropype_ephy.spectral import pair_spectral_connectivity
+    from neuropype_ephy.packed_conmat import save_sparse_conmat, export_conmat_to_matlab
+    from neuropype_ephy.aux_tools import cast_to_precision
+
+    if mode != 'multitaper' or con_method in ['aec','aec_orth']:
+        raise ValueError("connectivity of a subset of pairs is only implemented for multitaper spectral methods, not for {} in {} mode".format(con_method,mode))
+
+    if packed == True:
+        print "Warning, pairs are saved in sparse format, packed output is ignored"
+
+    if len(data.shape) < 3:
+
+        if chunk_size is not None:
+            print "Warning, data are not epoched, streaming reads the whole time series at once (set epoch_window_length)"
+
+        if con_method in ['coh','cohy','imcoh']:
+            data = data.reshape(1,data.shape[0],data.shape[1])
+
+        else:
+            print "warning, only work with epoched time series"
+            sys.exit()
+
+    if freq_band_names is None or len(freq_band_names) == 0:
+        freq_band_names = [str(i) for i in range(len(freq_bands))]
+
+    if chunk_size is None:
+        chunk_size = 32
+
+    con = pair_spectral_connectivity(data,con_method,sfreq,freq_bands,indices,chunk_size = chunk_size,n_jobs = n_jobs)
+
+    if precision is not None:
+        con = cast_to_precision(con,precision)
+
+    print con.shape
+    print np.min(con),np.max(con)
+
+    nb_nodes = data.shape[1]
+
+    stacked_conmat_file = save_sparse_conmat(os.path.abspath("conmat_" + str(index) + "_" + con_method + "_pairs_bands.npz"),indices,con,nb_nodes,con_method)
+
+    conmat_files = []
+
+    for freq_band_name,band_con in zip(freq_band_names,con):
+
+        if len(freq_bands) == 1:
+            conmat_file = os.path.abspath("conmat_" + str(index) + "_" + con_method + "_pairs.npz")
+        else:
+            conmat_file = os.path.abspath("conmat_" + str(index) + "_" + con_method + "_" + freq_band_name + "_pairs.npz")
+
+        save_sparse_conmat(conmat_file,indices,band_con,nb_nodes,con_method)
+
+        if export_to_matlab == True:
+
+            export_conmat_to_matlab(conmat_file)
+
+        conmat_files.append(conmat_file)
+
+    return conmat_files,stacked_conmat_file
+
+########################################################### batch spectral connectivity (multitaper) ######################################################
+
+def compute_con_terms(csd,con_method):
+    """
+    Cross-spectral terms of one epoch needed by con_method, to be summed over epochs
+
+    con_method can also be a list of methods, the union of their terms is returned
+
+    csd : array, shape (..., nb_nodes, nb_nodes, n_freqs)
+    """
+
+    if isinstance(con_method,basestring):
+        con_methods = [con_method]
+    else:
+        con_methods = con_method
+
+    terms = {}
+
+    for con_method in con_methods:
+
+        if con_method in ['coh','cohy','imcoh']:
+
+            ### psd are the diagonal of csd
+            terms['csd'] = csd
+
+        elif con_method in ['plv','ppc']:
+
+            if not 'phase' in terms:
+
+                ### handle zeros in denominator
+                abs_csd = np.abs(csd)
+                abs_csd[abs_csd == 0.] = 1.
+
+                terms['phase'] = csd / abs_csd
+
+        elif con_method in ['pli','pli2_unbiased']:
+
+            terms['sign_im'] = np.sign(np.imag(csd))
+
+        elif con_method in ['wpli','wpli2_debiased']:
+
+            ### np.imag is a view on csd, which may also be accumulated
+            im_csd = np.imag(csd).copy()
+
+            terms['im'] = im_csd
+            terms['abs_im'] = np.abs(im_csd)
+
+            if con_method == 'wpli2_debiased':
+                terms['sq_im'] = im_csd ** 2
+
+        else:
+
+            raise ValueError("con_method {} is not implemented".format(con_method))
+
+    return terms
+
+def add_con_terms(acc_terms,csd,con_method):
+    """
+    Add the terms of one epoch to acc_terms (a new dict is created if acc_terms is None)
+    """
+
+    terms = compute_con_terms(csd,con_method)
+
+    if acc_terms is None:
+        return terms
+
+    for key in acc_terms.keys():
+        acc_terms[key] += terms[key]
+
+    return acc_terms
+
+def con_terms_to_con(acc_terms,n_epochs,con_method,psd_xx = None,psd_yy = None):
+    """
+    Connectivity scores from the terms summed over n_epochs epochs (same estimators as mne.connectivity)
+
+    Returns an array of shape (..., nb_nodes, nb_nodes, n_freqs)
+
+    For a subset of pairs (terms of shape (n_pairs, n_freqs)), the mean psd of
+    the seeds (psd_xx) and targets (psd_yy) have to be given for coh, cohy and imcoh
+    """
+
+    if con_method in ['coh','cohy','imcoh']:
+
+        csd_mean = acc_terms['csd'] / n_epochs
+
+        if psd_xx is not None:
+
+            norm = np.sqrt(psd_xx * psd_yy)
+
+        else:
+
+            ### psd are the diagonal of csd, (..., n_freqs, nb_nodes) -> (..., nb_nodes, n_freqs)
+            psd = np.real(np.diagonal(csd_mean,axis1 = -3,axis2 = -2)).swapaxes(-1,-2)
+
+            norm = np.sqrt(psd[...,:,np.newaxis,:] * psd[...,np.newaxis,:,:])
+
+        if con_method == 'coh':
+            return np.abs(csd_mean) / norm
+
+        elif con_method == 'cohy':
+            return csd_mean / norm
+
+        else:
+            return np.imag(csd_mean) / norm
+
+    elif con_method == 'plv':
+
+        return np.abs(acc_terms['phase'] / n_epochs)
+
+    elif con_method == 'ppc':
+
+        phase = acc_terms['phase']
+
+        return np.real((phase * np.conj(phase) - n_epochs) / (n_epochs * (n_epochs - 1.)))
+
+    elif con_method == 'pli':
+
+        return np.abs(acc_terms['sign_im'] / n_epochs)
+
+    elif con_method == 'pli2_unbiased':
+
+        pli_mean = acc_terms['sign_im'] / n_epochs
+
+        return (n_epochs * pli_mean ** 2 - 1) / (n_epochs - 1)
+
+    elif con_method in ['wpli','wpli2_debiased']:
+
+        if con_method == 'wpli':
+
+            num = np.abs(acc_terms['im'])
+            denom = acc_terms['abs_im'].copy()
+
+        else:
+
+            num = acc_terms['im'] ** 2 - acc_terms['sq_im']
+            denom = acc_terms['abs_im'] ** 2 - acc_terms['sq_im']
+
+        ### where we have zeros in denominator, con is set to zero
+        z_denom = denom == 0.
+        denom[z_denom] = 1.
+
+        con = num / denom
+        con[z_denom] = 0.
+
+        return con
+
+    else:
+
+        raise ValueError("con_method {} is not implemented".format(con_method))
+
+def con_to_band_conmats(con,freq_idx_bands):
+    """
+    Average connectivity scores within each frequency band and keep the lower triangular part
+
+    con : array, shape (..., nb_nodes, nb_nodes, n_freqs)
+
+    Returns an array of shape (..., n_bands, nb_nodes, nb_nodes)
+    """
+
+    conmats = np.stack([np.mean(con[...,freq_idx],axis = -1) for freq_idx in freq_idx_bands],axis = -3)
+
+    upper_mask = np.triu(np.ones(conmats.shape[-2:],dtype = bool))
+
+    conmats[...,upper_mask] = 0.
+
+    return conmats
+
+def block_spectral_connectivity(data,con_method,sfreq,freq_bands):
+    """
+    Multitaper spectral connectivity for a block of samples (see batch_spectral_connectivity)
+
+    Tapered spectra of the whole block are computed with a single FFT, and
+    cross-spectra are reduced with einsum, epoch by epoch.
+    """
+
+    from neuropype_ephy.multitaper import compute_tapered_spectra, compute_csd
+
+    n_epochs = data.shape[1]
+
+    x_mt,freqs,freq_idx_bands = compute_tapered_spectra(data,sfreq,freq_bands)
+
+    acc_terms = None
+
+    for epoch_index in range(n_epochs):
+
+        acc_terms = add_con_terms(acc_terms,compute_csd(x_mt[:,epoch_index]),con_method)
+
+    con = con_terms_to_con(acc_terms,n_epochs,con_method)
+
+    return con_to_band_conmats(con,freq_idx_bands)
+
+def batch_spectral_connectivity(data,con_method,sfreq,freq_bands,block_size = 16,n_jobs = 1,out = None):
+    """
+    Compute multitaper spectral connectivity for many samples at once
+
+    data : array, shape (n_samples, n_epochs, nb_nodes, nb_timepoints)
+
+    Samples are processed by blocks of at most block_size samples, and blocks
+    are spread over n_jobs processes (see aux_tools.get_n_jobs).
+
+    out : preallocated array of shape (n_samples, n_bands, nb_nodes, nb_nodes),
+    possibly memory-mapped, in which results are written block by block
+
+    Returns conmats, shape (n_samples, n_bands, nb_nodes, nb_nodes) (lower triangular)
+    """
+
+    from neuropype_ephy.aux_tools import get_n_jobs
+
+    n_samples,n_epochs,n_nodes,n_times = data.shape
+
+    if out is None:
+
+        if con_method == 'cohy':
+            dtype = np.complex128
+        else:
+            dtype = np.float64
+
+        out = np.zeros((n_samples,len(freq_bands),n_nodes,n_nodes),dtype = dtype)
+
+    assert out.shape == (n_samples,len(freq_bands),n_nodes,n_nodes), "Error, out should have shape {}, not {}".format((n_samples,len(freq_bands),n_nodes,n_nodes),out.shape)
+
+    n_jobs = get_n_jobs(n_jobs)
+
+    ### smaller blocks, so that every process gets some work
+    block_size = max(1,min(block_size,int(np.ceil(n_samples / float(n_jobs)))))
+
+    starts = range(0,n_samples,block_size)
+
+    if n_jobs == 1:
+
+        for start in starts:
+
+            out[start:start + block_size] = block_spectral_connectivity(data[start:start + block_size],con_method,sfreq,freq_bands)
+
+    else:
+
+        from mne.parallel import parallel_func
+
+        parallel, p_block_spectral_connectivity, _ = parallel_func(block_spectral_connectivity, n_jobs)
+
+        ### blocks are dispatched by groups of n_jobs, so that results are written to out as they come
+        for group_index in range(0,len(starts),n_jobs):
+
+            group_starts = starts[group_index:group_index + n_jobs]
+
+            all_conmats = parallel(p_block_spectral_connectivity(data[start:start + block_size],con_method,sfreq,freq_bands) for start in group_starts)
+
+            for start,conmats in zip(group_starts,all_conmats):
+
+                out[start:start + block_size] = conmats
+
+    return out
+
+def get_epochs_view(data,epoch_length,step = None):
+    """
+    Split (..., nb_nodes, nb_timepoints) data in epochs of epoch_length time points, without copy
+
+    Epochs start every step time points (epoch_length by default, i.e.
+    consecutive epochs; a smaller step gives overlapping epochs). The remaining
+    time points are dropped. If data is memory-mapped, so is the result.
+
+    Returns a read-only strided view of shape (..., n_epochs, nb_nodes, epoch_length)
+    """
+
+    from numpy.lib.stride_tricks import as_strided
+
+    if step is None:
+        step = epoch_length
+
+    epoch_length,step = int(epoch_length),int(step)
+
+    assert epoch_length > 0 and step > 0, "Error, epoch_length ({}) and step ({}) should be positive".format(epoch_length,step)
+
+    n_epochs = max(0,(data.shape[-1] - epoch_length) // step + 1)
+
+    shape = data.shape[:-2] + (n_epochs,data.shape[-2],epoch_length)
+
+    strides = data.strides[:-2] + (data.strides[-1] * step,data.strides[-2],data.strides[-1])
+
+    return as_strided(data,shape = shape,strides = strides,writeable = False)
+
+def sum_con_terms(acc_terms,terms):
+    """
+    Add terms (already summed over epochs) to acc_terms, in place (terms is returned if acc_terms is None)
+    """
+
+    if acc_terms is None:
+        return terms
+
+    for key in acc_terms.keys():
+        acc_terms[key] += terms[key]
+
+    return acc_terms
+
+def parallel_chunk_terms(func,get_chunk,starts,n_jobs,*args):
+    """
+    Yield func(get_chunk(start),*args) for each start, computed in n_jobs processes
+
+    Chunks are read and dispatched by groups of n_jobs, the next group being
+    read only once the results of the previous one have been consumed, so that
+    at most n_jobs chunks and their results are in memory at once (when results
+    are summed as they are yielded)
+    """
+
+    from mne.parallel import parallel_func
+
+    parallel, p_func, _ = parallel_func(func, n_jobs)
+
+    for group_index in range(0,len(starts),n_jobs):
+
+        for result in parallel(p_func(get_chunk(start),*args) for start in starts[group_index:group_index + n_jobs]):
+
+            yield result
+
+def chunk_con_terms(chunk,con_method,sfreq,freq_bands):
+    """
+    Cross-spectral terms summed over a chunk of epochs (n_epochs, nb_nodes, nb_timepoints)
+    """
+
+    from neuropype_ephy.multitaper import compute_tapered_spectra, compute_csd
+
+    x_mt,freqs,freq_idx_bands = compute_tapered_spectra(np.asarray(chunk),sfreq,freq_bands)
+
+    acc_terms = None
+
+    for epoch_index in range(x_mt.shape[0]):
+
+        acc_terms = add_con_terms(acc_terms,compute_csd(x_mt[epoch_index]),con_method)
+
+    return acc_terms
+
+def streaming_spectral_connectivity(epochs,con_method,sfreq,freq_bands,chunk_size = 32,n_jobs = 1):
+    """
+    Multitaper spectral connectivity with memory bounded by chunks of epochs
+
+    epochs : array, shape (n_epochs, nb_nodes, nb_timepoints), typically a
+    memory-mapped array or a view on it (see get_epochs_view).
+
+    Only chunk_size epochs are read at a time; their cross-spectral terms are
+    summed and the chunk is released. Chunks can be spread over n_jobs
+    processes; they are then dispatched by groups of n_jobs, each group being
+    summed before the next one is read, so that at most n_jobs chunks and
+    their terms are in memory at once (see parallel_chunk_terms).
+
+    Returns conmats, shape (n_bands, nb_nodes, nb_nodes) (lower triangular)
+    """
+
+    from neuropype_ephy.aux_tools import get_n_jobs
+    from neuropype_ephy.multitaper import get_freq_mask
+
+    n_epochs = epochs.shape[0]
+
+    n_jobs = get_n_jobs(n_jobs)
+
+    starts = range(0,n_epochs,chunk_size)
+
+    print "accumulating cross-spectra over {} epochs by chunks of {} epochs".format(n_epochs,chunk_size)
+
+    if n_jobs == 1:
+
+        all_terms = (chunk_con_terms(epochs[start:start + chunk_size],con_method,sfreq,freq_bands) for start in starts)
+
+    else:
+
+        all_terms = parallel_chunk_terms(chunk_con_terms,lambda start: np.asarray(epochs[start:start + chunk_size]),starts,n_jobs,con_method,sfreq,freq_bands)
+
+    acc_terms = None
+
+    for terms in all_terms:
+
+        acc_terms = sum_con_terms(acc_terms,terms)
+
+    freqs,freq_mask,freq_idx_bands = get_freq_mask(epochs.shape[-1],sfreq,freq_bands)
+
+    con = con_terms_to_con(acc_terms,n_epochs,con_method)
+
+    return con_to_band_conmats(con,freq_idx_bands)
+
+def get_pair_indices(nb_nodes = None,seed_indices = None,target_indices = None,pairs_file = None):
+    """
+    Seed and target indices of the pairs for which connectivity is computed
+
+    Either all seed * target combinations (pairs of a node with itself are
+    dropped), or pairs read from pairs_file: a .npy file with either a
+    (2, n_pairs) array of indices, or a (nb_nodes, nb_nodes) mask (non-zero
+    entries are the pairs, row being the seed).
+
+    Each unordered pair is kept once, in the first orientation found (the
+    other one is given by packed_conmat.reverse_pair_orientation), so that
+    it is computed once and its sparse conmat can be loaded with load_conmat.
+
+    Returns (seeds, targets), two arrays of n_pairs indices
+    """
+
+    if pairs_file is not None:
+
+        pairs = np.load(pairs_file)
+
+        if pairs.ndim == 2 and pairs.shape[0] == 2 and not (pairs.shape[1] == 2 and pairs.dtype == bool):
+
+            seeds,targets = pairs.astype(int)
+
+        else:
+
+            assert pairs.ndim == 2 and pairs.shape[0] == pairs.shape[1], "Error, pairs_file should contain a (2, n_pairs) array or a squared mask, not {}".format(pairs.shape)
+
+            if nb_nodes is not None:
+                assert pairs.shape[0] == nb_nodes, "Error, mask has {} nodes instead of {}".format(pairs.shape[0],nb_nodes)
+
+            seeds,targets = np.where(pairs != 0)
+
+    else:
+
+        assert seed_indices is not None, "Error, seed_indices or pairs_file should be given"
+
+        if target_indices is None:
+            target_indices = range(nb_nodes)
+
+        seeds,targets = np.meshgrid(np.asarray(seed_indices,dtype = int),np.asarray(target_indices,dtype = int),indexing = 'ij')
+
+        seeds,targets = seeds.ravel(),targets.ravel()
+
+    keep = seeds != targets
+
+    seeds,targets = seeds[keep],targets[keep]
+
+    ### first occurrence of each unordered pair, in the original order
+    pairs = np.maximum(seeds,targets) * (max(np.max(seeds),np.max(targets)) + 1 if len(seeds) else 1) + np.minimum(seeds,targets)
+
+    first = np.sort(np.unique(pairs,return_index = True)[1])
+
+    return seeds[first],targets[first]
+
+def chunk_pair_con_terms(chunk,con_method,sfreq,freq_bands,seed_pos,target_pos,pair_block_size = 4096):
+    """
+    Cross-spectral terms of a subset of pairs and psd of the nodes, summed over a chunk of epochs
+
+    chunk : array, shape (n_epochs, n_used_nodes, nb_timepoints), seed_pos and
+    target_pos being positions among the used nodes
+
+    Returns acc_terms and psd, shape (n_used_nodes, n_freqs)
+    """
+
+    from neuropype_ephy.multitaper import compute_tapered_spectra, compute_pair_csd
+
+    x_mt,freqs,freq_idx_bands = compute_tapered_spectra(chunk,sfreq,freq_bands)
+
+    ### weighted spectra: psd is the sum over tapers of |x_mt| ** 2
+    psd = np.sum(np.abs(x_mt) ** 2,axis = (0,2))
+
+    acc_terms = None
+
+    for epoch_index in range(x_mt.shape[0]):
+
+        csd = compute_pair_csd(x_mt[epoch_index],seed_pos,target_pos,block_size = pair_block_size)
+
+        acc_terms = add_con_terms(acc_terms,csd,con_method)
+
+    return acc_terms,psd
+
+def pair_spectral_connectivity(epochs,con_method,sfreq,freq_bands,indices,chunk_size = 32,pair_block_size = 4096,n_jobs = 1):
+    """
+    Multitaper spectral connectivity for a subset of pairs only
+
+    epochs : array, shape (n_epochs, nb_nodes, nb_timepoints), possibly memory-mapped
+
+    indices : (seeds, targets), see get_pair_indices
+
+    Only the nodes involved in a pair are read, chunk_size epochs at a time,
+    and cross-spectra are computed pair-wise, pair_block_size pairs at a time,
+    so that time and memory scale with the number of pairs instead of nb_nodes ** 2.
+    Chunks are dispatched to n_jobs processes by groups of n_jobs, each group
+    being summed before the next one is read.
+
+    Returns con, shape (n_bands, n_pairs)
+    """
+
+    from neuropype_ephy.aux_tools import get_n_jobs
+    from neuropype_ephy.multitaper import get_freq_mask
+
+    seeds,targets = np.asarray(indices[0],dtype = int),np.asarray(indices[1],dtype = int)
+
+    assert len(seeds) == len(targets), "Error, seeds and targets should have the same length"
+
+    if con_method in ['aec','aec_orth']:
+        raise ValueError("{} is not implemented for a subset of pairs".format(con_method))
+
+    n_epochs = epochs.shape[0]
+    n_pairs = len(seeds)
+
+    ### positions of seeds and targets among the nodes actually read
+    used_nodes,used_pos = np.unique(np.concatenate((seeds,targets)),return_inverse = True)
+
+    seed_pos = used_pos[:n_pairs]
+    target_pos = used_pos[n_pairs:]
+
+    print "computing {} pairs on {} nodes, over {} epochs".format(n_pairs,len(used_nodes),n_epochs)
+
+    n_jobs = get_n_jobs(n_jobs)
+
+    starts = range(0,n_epochs,chunk_size)
+
+    if n_jobs == 1:
+
+        all_terms = (chunk_pair_con_terms(np.asarray(epochs[start:start + chunk_size][:,used_nodes]),con_method,sfreq,freq_bands,seed_pos,target_pos,pair_block_size) for start in starts)
+
+    else:
+
+        get_chunk = lambda start: np.asarray(epochs[start:start + chunk_size][:,used_nodes])
+
+        all_terms = parallel_chunk_terms(chunk_pair_con_terms,get_chunk,starts,n_jobs,con_method,sfreq,freq_bands,seed_pos,target_pos,pair_block_size)
+
+    acc_terms = None
+    psd = 0.
+
+    for terms,chunk_psd in all_terms:
+
+        acc_terms = sum_con_terms(acc_terms,terms)
+        psd = psd + chunk_psd
+
+    freqs,freq_mask,freq_idx_bands = get_freq_mask(epochs.shape[-1],sfreq,freq_bands)
+
+    psd_mean = psd / n_epochs
+
+    con = con_terms_to_con(acc_terms,n_epochs,con_method,psd_xx = psd_mean[seed_pos],psd_yy = psd_mean[target_pos])
+
+    return np.array([np.mean(con[:,freq_idx],axis = -1) for freq_idx in freq_idx_bands])
+
+def morlet_freq_batch_con(fft_data,fft_wavelets,offsets,n_times,con_method,time_block_size = 64):
+    """
+    Connectivity of a batch of frequencies, summed over time (see morlet_spectral_connectivity)
+
+    fft_data : array, shape (n_epochs, nb_nodes, fsize)
+
+    Returns an array of shape (nb_nodes, nb_nodes, n_freqs_batch)
+    """
+
+    from neuropype_ephy.morlet import compute_morlet_coefs
+
+    n_epochs = fft_data.shape[0]
+
+    ### (n_epochs, nb_nodes, n_freqs_batch, n_times)
+    coefs = compute_morlet_coefs(fft_data,fft_wavelets,offsets,n_times)
+
+    con_sum = None
+
+    for start in range(0,n_times,time_block_size):
+
+        ### (n_epochs, n_block_times, nb_nodes, n_freqs_batch), time is a leading (batch) dimension of the terms
+        x_cwt = coefs[...,start:start + time_block_size].transpose(0,3,1,2)
+
+        acc_terms = None
+
+        for epoch_index in range(n_epochs):
+
+            csd = np.einsum('tif,tjf->tijf',x_cwt[epoch_index],np.conj(x_cwt[epoch_index]))
+
+            acc_terms = add_con_terms(acc_terms,csd,con_method)
+
+        block_con_sum = np.sum(con_terms_to_con(acc_terms,n_epochs,con_method),axis = 0)
+
+        if con_sum is None:
+            con_sum = block_con_sum
+        else:
+            con_sum += block_con_sum
+
+    return con_sum
+
+def morlet_spectral_connectivity(epochs,con_method,sfreq,freq_bands,cwt_freqs = None,cwt_n_cycles = None,freq_batch_size = 4,time_block_size = 64,n_jobs = 1):
+    """
+    Morlet wavelet spectral connectivity averaged over time, with bounded memory
+
+    epochs : array, shape (n_epochs, nb_nodes, nb_timepoints)
+
+    cwt_freqs : frequency grid (default, np.arange(f_lower, f_upper, 1) merged over bands)
+
+    cwt_n_cycles : number of cycles, float or one per frequency (default, cwt_freqs / 7.)
+
+    Wavelet coefficients are computed by FFT convolution, freq_batch_size
+    frequencies at a time, and connectivity is computed time_block_size time
+    points at a time and summed over time. Memory is then
+    O(nb_nodes ** 2 * n_freqs) instead of O(nb_nodes ** 2 * n_freqs * nb_timepoints)
+    for spectral_connectivity with faverage = False. Frequency batches can be
+    spread over n_jobs processes.
+
+    Same estimates as the time average of spectral_connectivity with mode = 'cwt_morlet'
+
+    Returns conmats, shape (n_bands, nb_nodes, nb_nodes) (lower triangular)
+    """
+
+    from neuropype_ephy.aux_tools import get_n_jobs
+    from neuropype_ephy.morlet import get_cwt_freqs, compute_morlet_fft
+
+    n_times = epochs.shape[-1]
+
+    freqs,freq_mask,freq_idx_bands = get_cwt_freqs(freq_bands,n_times,sfreq,cwt_freqs)
+
+    if cwt_n_cycles is None:
+        n_cycles = freqs / 7.
+
+    else:
+        n_cycles = np.atleast_1d(np.asarray(cwt_n_cycles,dtype = float))
+
+        if len(n_cycles) > 1:
+            assert len(n_cycles) == len(freq_mask), "Error, cwt_n_cycles should be a float or have one value per frequency ({} != {})".format(len(n_cycles),len(freq_mask))
+
+            n_cycles = n_cycles[freq_mask]
+
+    print "computing morlet connectivity for {} frequencies by batches of {}".format(len(freqs),freq_batch_size)
+
+    fft_wavelets,offsets,fsize = compute_morlet_fft(n_times,sfreq,freqs,n_cycles)
+
+    fft_data = np.fft.fft(np.asarray(epochs),fsize)
+
+    batches = [slice(start,start + freq_batch_size) for start in range(0,len(freqs),freq_batch_size)]
+
+    n_jobs = get_n_jobs(n_jobs)
+
+    if n_jobs == 1:
+
+        all_con_sums = [morlet_freq_batch_con(fft_data,fft_wavelets[batch],offsets[batch],n_times,con_method,time_block_size) for batch in batches]
+
+    else:
+
+        from mne.parallel import parallel_func
+
+        parallel, p_morlet_freq_batch_con, _ = parallel_func(morlet_freq_batch_con, n_jobs)
+
+        all_con_sums = parallel(p_morlet_freq_batch_con(fft_data,fft_wavelets[batch],offsets[batch],n_times,con_method,time_block_size) for batch in batches)
+
+    con = np.concatenate(all_con_sums,axis = -1) / n_times
+
+    return con_to_band_conmats(con,freq_idx_bands)
+
+########################################################### envelope connectivity (aec) ###############################################################
+
+def compute_analytic_signal(data,sfreq,freq_band,n_jobs = 1):
+    """
+    Analytic signal of band-filtered data (..., nb_timepoints)
+
+    Data is filtered in freq_band (mne.filter.filter_data), then the Hilbert
+    transform of all time series is computed with a single FFT along time
+
+    Returns a complex array of the same shape as data
+    """
+
+    from mne.filter import filter_data
+    from scipy.signal import hilbert
+
+    filtered_data = filter_data(np.array(data,dtype = np.float64),sfreq,freq_band[0],freq_band[1],n_jobs = n_jobs,verbose = False)
+
+    return hilbert(filtered_data,axis = -1)
+
+def envelope_correlation(analytic,orthogonalize = False,block_size = 2 ** 24):
+    """
+    Amplitude envelope correlation (aec) between all pairs of nodes
+
+    analytic : complex array, shape (nb_nodes, n_samples), epochs being concatenated in time
+
+    If orthogonalize is True, for each pair (i, j) the signal of j is first
+    orthogonalized to the one of i (Hipp et al. 2012, Nat Neurosci), removing
+    zero-lag (volume conduction) components, and the correlations of both
+    directions are averaged. Orthogonalization is computed for blocks of
+    seed nodes at once, of about block_size values.
+
+    Returns a symmetric array of shape (nb_nodes, nb_nodes)
+    """
+
+    envelopes = np.abs(analytic)
+
+    if not orthogonalize:
+        return np.corrcoef(envelopes)
+
+    nb_nodes,n_samples = analytic.shape
+
+    ### centered and normalized envelopes of seeds
+    env_c = envelopes - np.mean(envelopes,axis = -1,keepdims = True)
+    env_c /= np.sqrt(np.sum(env_c ** 2,axis = -1,keepdims = True))
+
+    unit_phase = analytic / np.maximum(envelopes,np.finfo(float).tiny)
+
+    corr = np.zeros((nb_nodes,nb_nodes))
+
+    n_seeds = max(1,block_size // (nb_nodes * n_samples))
+
+    for start in range(0,nb_nodes,n_seeds):
+
+        seeds = slice(start,start + n_seeds)
+
+        ### (n_seeds, nb_nodes, n_samples) envelopes of all nodes orthogonalized to each seed
+        orth_env = np.abs(np.imag(analytic[np.newaxis,:,:] * np.conj(unit_phase[seeds,np.newaxis,:])))
+
+        orth_env -= np.mean(orth_env,axis = -1,keepdims = True)
+
+        norms = np.sqrt(np.sum(orth_env ** 2,axis = -1))
+        norms[norms == 0.] = 1.
+
+        corr[seeds] = np.einsum('bjs,bs->bj',orth_env,env_c[seeds]) / norms
+
+    np.fill_diagonal(corr,1.)
+
+    return (corr + corr.T) / 2.
+
+def envelope_connectivity_bands(data,con_method,sfreq,freq_bands,n_jobs = 1):
+    """
+    aec or aec_orth (orthogonalized) connectivity for several frequency bands
+
+    data : array, shape (n_epochs, nb_nodes, nb_timepoints) or (nb_nodes, nb_timepoints)
+
+    Envelopes of all epochs are concatenated in time before correlation
+
+    Returns an array of shape (n_bands, nb_nodes, nb_nodes) (lower triangular)
+    """
+
+    if data.ndim == 2:
+        data = data[np.newaxis]
+
+    nb_nodes = data.shape[1]
+
+    conmats = []
+
+    for freq_band in freq_bands:
+
+        analytic = compute_analytic_signal(data,sfreq,freq_band,n_jobs = n_jobs)
+
+        ### (n_epochs, nb_nodes, nb_timepoints) -> (nb_nodes, n_epochs * nb_timepoints)
+        analytic = analytic.swapaxes(0,1).reshape(nb_nodes,-1)
+
+        conmats.append(np.tril(envelope_correlation(analytic,orthogonalize = (con_method == 'aec_orth')),-1))
+
+    return np.array(conmats)
+
+class SpectralConnAccumulator(object):
+    """
+    Online multitaper cross-spectral accumulator
+
+    Keeps running sums over epochs of the cross-spectral terms (cross-spectra,
+    power, phase and imaginary part terms) needed by con_methods, so that
+    epochs can be fed one at a time or by blocks with constant memory, and
+    connectivity computed at any time. The state can be saved and reloaded to
+    append new sessions without recomputing the previous ones.
+
+    Example:
+
+    >> acc = SpectralConnAccumulator(sfreq = 300., freq_bands = [[8.,12.],[15.,30.]], con_methods = ['coh','wpli'])
+    >> for epochs in blocks_of_epochs:
+           acc.add_epochs(epochs)
+    >> conmats = acc.compute_con('coh')   # (n_bands, nb_nodes, nb_nodes)
+    >> acc.save('acc_state.npz')
+
+    """
+    def __init__(self, sfreq, freq_bands, con_methods = ['coh']):
+
+        if isinstance(con_methods,basestring):
+            con_methods = [con_methods]
+
+        self.sfreq = float(sfreq)
+        self.freq_bands = [list(freq_band) for freq_band in freq_bands]
+        self.con_methods = list(con_methods)
+
+        self.n_epochs = 0
+        self.n_times = None
+        self.acc_terms = None
+
+    def add_epochs(self, epochs):
+        """
+        Add epochs, of shape (n_epochs, nb_nodes, nb_timepoints) or (nb_nodes, nb_timepoints)
+        """
+
+        from neuropype_ephy.spectral import chunk_con_terms
+
+        if epochs.ndim == 2:
+            epochs = epochs[np.newaxis,:,:]
+
+        if self.n_times is None:
+            self.n_times = epochs.shape[-1]
+
+        assert epochs.shape[-1] == self.n_times, "Error, all epochs should have {} time points, not {}".format(self.n_times,epochs.shape[-1])
+
+        terms = chunk_con_terms(epochs,self.con_methods,self.sfreq,self.freq_bands)
+
+        self.add_terms(terms,epochs.shape[0])
+
+    def add_terms(self, terms, n_epochs):
+        """
+        Add cross-spectral terms already summed over n_epochs epochs
+        """
+
+        if self.acc_terms is None:
+            self.acc_terms = terms
+
+        else:
+            for key in self.acc_terms.keys():
+                self.acc_terms[key] += terms[key]
+
+        self.n_epochs += n_epochs
+
+    def combine(self, other):
+        """
+        Include the epochs accumulated in another accumulator (e.g. another session)
+        """
+
+        assert self.n_times is None or other.n_times is None or self.n_times == other.n_times, "Error, accumulators with different epoch lengths"
+
+        if other.acc_terms is not None:
+
+            if self.n_times is None:
+                self.n_times = other.n_times
+
+            self.add_terms(dict([(key,value.copy()) for key,value in other.acc_terms.items()]),other.n_epochs)
+
+    def compute_con(self, con_method = None):
+        """
+        Connectivity for the epochs accumulated so far
+
+        Returns conmats, shape (n_bands, nb_nodes, nb_nodes) (lower triangular)
+        """
+
+        from neuropype_ephy.multitaper import get_freq_mask
+
+        if con_method is None:
+            con_method = self.con_methods[0]
+
+        assert con_method in self.con_methods, "Error, {} was not accumulated ({})".format(con_method,self.con_methods)
+        assert self.n_epochs > 0, "Error, no epoch accumulated yet"
+
+        freqs,freq_mask,freq_idx_bands = get_freq_mask(self.n_times,self.sfreq,self.freq_bands)
+
+        con = con_terms_to_con(self.acc_terms,self.n_epochs,con_method)
+
+        return con_to_band_conmats(con,freq_idx_bands)
+
+    def save(self, fname):
+        """
+        Save accumulated state in .npz format
+        """
+
+        acc_terms = self.acc_terms if self.acc_terms is not None else {}
+
+        np.savez(fname, sfreq = self.sfreq, freq_bands = np.array(self.freq_bands), con_methods = np.array(self.con_methods),
+                 n_epochs = self.n_epochs, n_times = -1 if self.n_times is None else self.n_times,
+                 **dict([("term_" + key,value) for key,value in acc_terms.items()]))
+
+        return fname
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Reload a state saved with save
+        """
+
+        state = np.load(fname)
+
+        acc = cls(float(state['sfreq']),state['freq_bands'].tolist(),state['con_methods'].tolist())
+
+        acc.n_epochs = int(state['n_epochs'])
+
+        if int(state['n_times']) != -1:
+
+            acc.n_times = int(state['n_times'])
+            acc.acc_terms = dict([(key[len("term_"):],state[key]) for key in state.files if key.startswith("term_")])
+
+        return acc
 
-    import numpy as np
-    from scipy.io import savemat
-    
-    print data.shape
+########################################################### surrogate statistics (multitaper) ##########################################################
 
-    if len(data.shape) < 3:
-        if con_method in ['coh','cohy','imcoh']:
-            data = data.reshape(1,data.shape[0],data.shape[1])
+def make_surrogate_spectra(x_mt,n_surrogates,surrogate_method = 'trial_shuffle',rng = None):
+    """
+    Surrogates of tapered spectra x_mt (n_epochs, nb_nodes, n_tapers, n_freqs), without new FFTs
 
-        elif con_method in ['pli','plv','ppc' ,'pli','pli2_unbiased' ,'wpli' ,'wpli2_debiased']:
-            print "warning, only work with epoched time series"
-            sys.exit()
-        
-    if mode == 'multitaper':
-        
-        con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, sfreq=sfreq, fmin= fmin, fmax=fmax, faverage=True, tmin=None, mode = 'multitaper',   mt_adaptive=False, n_jobs=1)
-        
-        con_matrix = np.array(con_matrix[:,:,0])
+    - trial_shuffle: epochs are permuted independently for each node, which
+      keeps spectra and breaks the coupling between nodes
+    - phase_randomization: spectra of each (epoch, node, frequency) are rotated
+      by a random phase (the same for all tapers), which keeps power and breaks
+      phase relations
 
-    elif mode == 'cwt_morlet':
-        
-        frequencies = np.arange(fmin, fmax, 1)
-        n_cycles = frequencies / 7.
+    Returns an array of shape (n_surrogates, n_epochs, nb_nodes, n_tapers, n_freqs)
+    """
+
+    if rng is None:
+        rng = np.random.RandomState()
+
+    n_epochs,nb_nodes = x_mt.shape[:2]
+
+    if surrogate_method == 'trial_shuffle':
+
+        assert n_epochs > 1, "Error, trial_shuffle needs several epochs"
+
+        ### (n_surrogates, n_epochs, nb_nodes) epoch permutations, one per node
+        perms = np.argsort(rng.rand(n_surrogates,nb_nodes,n_epochs),axis = -1).swapaxes(1,2)
+
+        return x_mt[perms,np.arange(nb_nodes)]
+
+    elif surrogate_method == 'phase_randomization':
+
+        phases = np.exp(2j * np.pi * rng.rand(n_surrogates,n_epochs,nb_nodes,1,x_mt.shape[-1]))
+
+        return x_mt * phases
 
-        con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, sfreq=sfreq, faverage=True, tmin=None, mode='cwt_morlet',   cwt_frequencies= frequencies, cwt_n_cycles= n_cycles, n_jobs=1)
-        
-        con_matrix = np.mean(np.array(con_matrix[:,:,0,:]),axis = 2)
-    
     else:
-        
-        print "Error, mode = %s not implemented"%(mode)
-        
-        return []
 
-    print con_matrix.shape
-    print np.min(con_matrix),np.max(con_matrix)
+        raise ValueError("surrogate_method {} is not implemented".format(surrogate_method))
+
+def tapered_spectra_to_conmats(x_mt,con_method,freq_idx_bands):
+    """
+    Conmats from tapered spectra (..., n_epochs, nb_nodes, n_tapers, n_freqs)
+
+    Returns an array of shape (..., n_bands, nb_nodes, nb_nodes) (lower triangular)
+    """
+
+    from neuropype_ephy.multitaper import compute_csd
+
+    n_epochs = x_mt.shape[-4]
+
+    acc_terms = None
+
+    for epoch_index in range(n_epochs):
+
+        acc_terms = add_con_terms(acc_terms,compute_csd(x_mt[...,epoch_index,:,:,:]),con_method)
+
+    return con_to_band_conmats(con_terms_to_con(acc_terms,n_epochs,con_method),freq_idx_bands)
+
+def surrogate_batch_conmats(x_mt,con_method,freq_idx_bands,n_surrogates,surrogate_method = 'trial_shuffle',seed = None):
+    """
+    Conmats of a batch of n_surrogates surrogates (see make_surrogate_spectra)
+
+    Returns an array of shape (n_surrogates, n_bands, nb_nodes, nb_nodes)
+    """
+
+    rng = np.random.RandomState(seed)
+
+    x_surr = make_surrogate_spectra(x_mt,n_surrogates,surrogate_method,rng)
+
+    return tapered_spectra_to_conmats(x_surr,con_method,freq_idx_bands)
+
+def surrogate_spectral_connectivity(data,con_method,sfreq,freq_bands,n_surrogates = 200,surrogate_method = 'trial_shuffle',alpha = 0.05,batch_size = 10,n_jobs = 1,seed = None):
+    """
+    Multitaper spectral connectivity and its significance against surrogate data
+
+    data : array, shape (n_epochs, nb_nodes, nb_timepoints)
+
+    Tapered spectra are computed once; each surrogate (see make_surrogate_spectra)
+    then only costs a cross-spectrum reduction. Surrogates are computed by
+    batches of batch_size, spread over n_jobs processes.
+
+    Scores are compared in absolute value (for cohy and imcoh). The p-value is
+    (1 + number of surrogates >= observed) / (1 + n_surrogates), and the threshold
+    the (1 - alpha) quantile of the surrogates.
+
+    Returns conmats, p-values and thresholds, each of shape (n_bands, nb_nodes, nb_nodes)
+    (lower triangular)
+    """
+
+    from neuropype_ephy.aux_tools import get_n_jobs
+    from neuropype_ephy.multitaper import compute_tapered_spectra
+
+    x_mt,freqs,freq_idx_bands = compute_tapered_spectra(np.asarray(data),sfreq,freq_bands)
+
+    conmats = tapered_spectra_to_conmats(x_mt,con_method,freq_idx_bands)
+
+    ### one seed per batch, so that results do not depend on n_jobs
+    seeds = np.random.RandomState(seed).randint(np.iinfo(np.int32).max,size = (n_surrogates + batch_size - 1) // batch_size)
+
+    batches = [(min(batch_size,n_surrogates - start),batch_seed) for start,batch_seed in zip(range(0,n_surrogates,batch_size),seeds)]
+
+    print "computing {} {} surrogates by batches of {}".format(n_surrogates,surrogate_method,batch_size)
+
+    n_jobs = get_n_jobs(n_jobs)
+
+    if n_jobs == 1:
+
+        all_surr_conmats = [surrogate_batch_conmats(x_mt,con_method,freq_idx_bands,n_batch,surrogate_method,batch_seed) for n_batch,batch_seed in batches]
+
+    else:
+
+        from mne.parallel import parallel_func
+
+        parallel, p_surrogate_batch_conmats, _ = parallel_func(surrogate_batch_conmats, n_jobs)
+
+        all_surr_conmats = parallel(p_surrogate_batch_conmats(x_mt,con_method,freq_idx_bands,n_batch,surrogate_method,batch_seed) for n_batch,batch_seed in batches)
+
+    ### (n_surrogates, n_bands, nb_nodes, nb_nodes)
+    surr_conmats = np.abs(np.concatenate(all_surr_conmats))
+
+    pvals = (1. + np.sum(surr_conmats >= np.abs(conmats),axis = 0)) / (1. + n_surrogates)
+
+    thresholds = np.percentile(surr_conmats,100. * (1. - alpha),axis = 0)
+
+    return conmats,pvals,thresholds
+
+def compute_and_save_surrogate_spectral_connectivity(data,con_method,sfreq,fmin,fmax,index = 0,n_surrogates = 200,surrogate_method = 'trial_shuffle',alpha = 0.05,n_jobs = 1,seed = None):
+    """
+    Compute spectral connectivity in a band with surrogate statistics, and save
+    conmat, p-value and threshold matrices in .npy format
+
+    Returns conmat_file, pval_file and threshold_file
+    """
+
+    import os
+
+    import numpy as np
+
+    from neuropype_ephy.spectral import surrogate_spectral_connectivity
+
+    if len(data.shape) < 3:
+        data = data.reshape(1,data.shape[0],data.shape[1])
+
+    conmats,pvals,thresholds = surrogate_spectral_connectivity(data,con_method,sfreq,[[fmin,fmax]],n_surrogates = n_surrogates,surrogate_method = surrogate_method,alpha = alpha,n_jobs = n_jobs,seed = seed)
+
+    print conmats.shape
+    print np.min(pvals),np.max(pvals)
 
     conmat_file = os.path.abspath("conmat_" + str(index) + "_" + con_method + ".npy")
-    
-    np.save(conmat_file,con_matrix)
+    pval_file = os.path.abspath("pval_" + str(index) + "_" + con_method + ".npy")
+    threshold_file = os.path.abspath("threshold_" + str(index) + "_" + con_method + ".npy")
 
-    if export_to_matlab == True:
-        
-        conmat_matfile = os.path.abspath("conmat_" + str(index) + "_" + con_method + ".mat")
-        
-        savemat(conmat_matfile,{"conmat":con_matrix + np.transpose(con_matrix)})
-        
-    return conmat_file
+    np.save(conmat_file,conmats[0])
+    np.save(pval_file,pvals[0])
+    np.save(threshold_file,thresholds[0])
+
+    return conmat_file,pval_file,threshold_file
 
 ########################################################### plot spectral connectivity #################################################################
 
-def plot_circular_connectivity(conmat, label_names, node_colors, node_order, vmin = 0.3, vmax = 1.0, nb_lines = 200, fname = "_def"):
-    import os
+def get_top_edges(conmat, nb_lines = 200):
+    """
+    The nb_lines strongest (in absolute value) edges of the lower triangle of conmat,
+    selected with np.argpartition instead of a full sort
+
+    Returns indices (rows, cols) and values of the edges
+    """
     import numpy as np
-    from mne.viz import circular_layout, plot_connectivity_circle
+
+    rows,cols = np.tril_indices(conmat.shape[0],-1)
+
+    values = conmat[rows,cols]
+
+    if nb_lines is not None and nb_lines < len(values):
+
+        top = np.argpartition(np.abs(values),len(values) - nb_lines)[len(values) - nb_lines:]
+
+        rows,cols,values = rows[top],cols[top],values[top]
+
+    return (rows,cols),values
+
+def get_circular_layout(label_names, node_order):
+    """
+    Node angles of the circular plot (computed once for all conmats with the same labels)
+    """
+    from mne.viz import circular_layout
+
+    return circular_layout(label_names, node_order, start_pos=90,
+                           group_boundaries=[0, len(label_names) / 2])
+
+def draw_circular_connectivity(conmat, label_names, node_colors, node_angles, vmin = 0.3, vmax = 1.0, nb_lines = 200, title = 'All-to-All Connectivity', fig = None, subplot = 111):
+    """
+    Draw the nb_lines strongest edges of conmat in a circular plot, returns the figure
+    """
+    from mne.viz import plot_connectivity_circle
+
+    indices,values = get_top_edges(conmat,nb_lines)
+
+    ### only the top edges are passed, so no threshold has to be computed on the whole conmat
+    fig,_ = plot_connectivity_circle(values,
+                                     label_names,
+                                     indices = indices,
+                                     n_lines = None,
+                                     node_angles = node_angles,
+                                     node_colors = node_colors,
+                                     fontsize_names = 12,
+                                     title = title,
+                                     show = False,
+                                     vmin = vmin,
+                                     vmax = vmax,
+                                     fig = fig,
+                                     subplot = subplot)
+
+    return fig
+
+def plot_circular_connectivity(conmat, label_names, node_colors, node_order, vmin = 0.3, vmax = 1.0, nb_lines = 200, fname = "_def", node_angles = None, plot_format = 'eps', dpi = 100):
+    import os
     import matplotlib.pyplot as plt
 
     # Angles
-    node_angles = circular_layout(label_names, node_order, start_pos=90,
-                                group_boundaries=[0, len(label_names) / 2])
+    if node_angles is None:
+        node_angles = get_circular_layout(label_names, node_order)
 
     # Plot the graph using node colors from the FreeSurfer parcellation. We only
-    # show the 300 strongest connections.
-    fig,_ = plot_connectivity_circle(conmat, 
-                                     label_names, 
-                                     n_lines=nb_lines,  
-                                     node_angles=node_angles, 
-                                     node_colors = node_colors,
-                                     fontsize_names = 12, 
-                                     title='All-to-All Connectivity' , 
-                                     show = False, 
-                                     vmin = vmin, 
-                                     vmax = vmax)
-    
-    
-    #plot_conmat_file = os.path.abspath('circle.png')
-    plot_conmat_file = os.path.abspath('circle_' + fname + '.eps')
-    fig.savefig(plot_conmat_file, facecolor='black')
-    
-    
+    # show the nb_lines strongest connections.
+    fig = draw_circular_connectivity(conmat, label_names, node_colors, node_angles, vmin, vmax, nb_lines)
+
+    plot_conmat_file = os.path.abspath('circle_' + fname + '.' + plot_format)
+    fig.savefig(plot_conmat_file, facecolor='black', dpi = dpi)
+
     plt.close(fig)
-    #fig1.close()
     del fig
-    
+
     return plot_conmat_file
-    
+
+def plot_circular_connectivity_set(conmats, label_names, node_colors, node_angles, vmin, vmax, nb_lines, fnames, plot_format = 'png', dpi = 100, backend = None):
+    """
+    Plot a list of conmats in one file each (one batch of plot_circular_connectivity_batch)
+
+    backend: matplotlib backend set before plotting (Agg in worker processes, which have no display)
+    """
+    if backend is not None:
+        import matplotlib.pyplot as plt
+        plt.switch_backend(backend)
+
+
+    return [plot_circular_connectivity(conmat, label_names, node_colors, None, vmin, vmax, nb_lines, fname, node_angles = node_angles, plot_format = plot_format, dpi = dpi) for conmat,fname in zip(conmats,fnames)]
+
+def plot_circular_connectivity_batch(conmats, label_names, node_colors, node_order, vmin = 0.3, vmax = 1.0, nb_lines = 200, fnames = None, plot_format = 'png', dpi = 100, multi_panel = False, n_jobs = 1):
+    """
+    Circular plots of many conmats with the same nodes (bands, windows...)
+
+    The circular layout and label order are computed once. Figures are rendered
+    (by default in png) either as a set of images, one per conmat, spread over
+    n_jobs processes, or, if multi_panel is True, as a single figure with one
+    panel per conmat (vector formats are then rasterized).
+
+    Returns the list of image files, or the multi-panel file
+    """
+    import os
+    import numpy as np
+
+    from neuropype_ephy.aux_tools import get_n_jobs
+
+    if fnames is None:
+        fnames = [str(i) for i in range(len(conmats))]
+
+    assert len(fnames) == len(conmats), "Error, {} names for {} conmats".format(len(fnames),len(conmats))
+
+    node_angles = get_circular_layout(label_names, node_order)
+
+    if multi_panel:
+
+        import matplotlib.pyplot as plt
+
+        nb_cols = int(np.ceil(np.sqrt(len(conmats))))
+        nb_rows = int(np.ceil(len(conmats) / float(nb_cols)))
+
+        fig = plt.figure(figsize = (8 * nb_cols,8 * nb_rows),facecolor = 'black')
+
+        for i,(conmat,fname) in enumerate(zip(conmats,fnames)):
+            draw_circular_connectivity(conmat, label_names, node_colors, node_angles, vmin, vmax, nb_lines, title = fname, fig = fig, subplot = (nb_rows,nb_cols,i + 1))
+
+        for ax in fig.axes:
+            ax.set_rasterized(True)
+
+        plot_conmat_file = os.path.abspath('circle_' + fnames[0] + '_panels.' + plot_format)
+        fig.savefig(plot_conmat_file, facecolor='black', dpi = dpi)
+
+        plt.close(fig)
+        del fig
+
+        return plot_conmat_file
+
+    n_jobs = get_n_jobs(n_jobs)
+
+    if n_jobs == 1:
+
+        return plot_circular_connectivity_set(conmats, label_names, node_colors, node_angles, vmin, vmax, nb_lines, fnames, plot_format, dpi)
+
+    from mne.parallel import parallel_func
+
+    parallel, p_plot_circular_connectivity_set, _ = parallel_func(plot_circular_connectivity_set, n_jobs)
+
+    batches = np.array_split(np.arange(len(conmats)),n_jobs)
+
+    plot_conmat_files = parallel(p_plot_circular_connectivity_set([conmats[i] for i in batch], label_names, node_colors, node_angles, vmin, vmax, nb_lines, [fnames[i] for i in batch], plot_format, dpi, 'Agg') for batch in batches if len(batch))
+
+    return [plot_conmat_file for batch_files in plot_conmat_files for plot_conmat_file in batch_files]
+
 #################################################################################################################################################################"
 
 ################ laisser pour l'instant, a modifier dans brainvision_to_conmat
@@ -113,28 +1483,28 @@ def plot_circular_connectivity(conmat, label_names, node_colors, node_order, vmi
     #return conmat_file
 
 
-def spectral_proc_label(ts_file,sfreq,freq_band,con_method,label,mode):
+def spectral_proc_label(ts_file,sfreq,freq_band,con_method,label,mode,n_jobs = 1):
 
     import numpy as np
     #import os
 
     from neuropype_ephy.spectral import compute_and_save_spectral_connectivity
 
-    data = np.load(ts_file)
+    data = np.load(ts_file,mmap_mode = 'r')
 
-    conmat_file = compute_and_save_spectral_connectivity(data = data,con_method = con_method,sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1],index = label,mode = mode)
+    conmat_file = compute_and_save_spectral_connectivity(data = data,con_method = con_method,sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1],index = label,mode = mode,n_jobs = n_jobs)
 
     return conmat_file
 
 
-def multiple_spectral_proc(ts_file,sfreq,freq_band,con_method):
+def multiple_spectral_proc(ts_file,sfreq,freq_band,con_method,return_stacked = False,n_jobs = 1):
 
     import numpy as np
     import os
 
-    from mne.connectivity import spectral_connectivity
+    from neuropype_ephy.spectral import batch_spectral_connectivity
 
-    all_data = np.load(ts_file)
+    all_data = np.load(ts_file,mmap_mode = 'r')
 
     print all_data.shape
     
@@ -147,39 +1517,40 @@ def multiple_spectral_proc(ts_file,sfreq,freq_band,con_method):
         
         return []
     
-    conmat_files = []
-    
-    for i in range(all_data.shape[0]):
+    ### all samples are computed in batch, each sample being a single epoch
+    all_con_matrices = batch_spectral_connectivity(all_data[:,np.newaxis,:,:],con_method,sfreq,freq_bands = [freq_band],n_jobs = n_jobs)[:,0]
 
-        cur_data = all_data[i,:,:]
-
-        data = cur_data.reshape(1,cur_data.shape[0],cur_data.shape[1])
+    print all_con_matrices.shape
+    print np.min(all_con_matrices),np.max(all_con_matrices)
+    
+    stacked_conmat_file = os.path.abspath("conmats_"+ con_method + ".npy")
 
-        print data.shape
-        
-        con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, mode='multitaper', sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1], faverage=True, tmin=None,    mt_adaptive=False, n_jobs=1)
+    np.save(stacked_conmat_file,all_con_matrices)
 
-        con_matrix = np.array(con_matrix[:,:,0])
+    conmat_files = []
+    
+    for i,con_matrix in enumerate(all_con_matrices):
 
-        print con_matrix.shape
-        print np.min(con_matrix),np.max(con_matrix)
-        
         conmat_file = os.path.abspath("conmat_"+ con_method + "_" + str(i) + ".npy")
 
         np.save(conmat_file,con_matrix)
 
         conmat_files.append(conmat_file)
             
+    if return_stacked == True:
+        
+        return conmat_files,stacked_conmat_file
+        
     return conmat_files
 
-def epoched_multiple_spectral_proc(ts_file,sfreq,freq_band_name,freq_band,con_method,epoch_window_length):
+def epoched_multiple_spectral_proc(ts_file,sfreq,freq_band_name,freq_band,con_method,epoch_window_length,return_stacked = False,n_jobs = 1,epoch_window_overlap = 0.):
 
     import numpy as np
     import os
 
-    from mne.connectivity import spectral_connectivity
+    from neuropype_ephy.spectral import batch_spectral_connectivity, get_epochs_view
 
-    all_data = np.load(ts_file)
+    all_data = np.load(ts_file,mmap_mode = 'r')
 
     print all_data.shape
 
@@ -194,50 +1565,46 @@ def epoched_multiple_spectral_proc(ts_file,sfreq,freq_band_name,freq_band,con_me
         
         return []
 
-    conmat_files = []
+    if epoch_window_length == None :
+        
+        ### (n_samples, 1, nb_nodes, nb_timepoints)
+        data = all_data[:,np.newaxis,:,:]
 
-    for i in range(all_data.shape[0]):
+    else: 
+            
+        win = int(epoch_window_length * sfreq)
+        
+        ### (n_samples, nb_splits, nb_nodes, win), the remainder is dropped
+        ### this is a view on the memory-mapped data, only read block by block
+        data = get_epochs_view(all_data,win,step = win - int(epoch_window_overlap * sfreq))
+        
+        print "epoching data with {}s by window ({}s overlap), resulting in {} epochs".format(epoch_window_length,epoch_window_overlap,data.shape[1])
+        
+        print data.shape
 
-        cur_data = all_data[i,:,:]
+    all_con_matrices = batch_spectral_connectivity(data,con_method,sfreq,freq_bands = [freq_band],n_jobs = n_jobs)[:,0]
 
-        print cur_data.shape
-            
-        if epoch_window_length == None :
-            
-            data = cur_data.reshape(1,cur_data.shape[0],cur_data.shape[1])
+    print all_con_matrices.shape
+    print np.min(all_con_matrices),np.max(all_con_matrices)
+    
+    stacked_conmat_file = os.path.abspath("conmats_"+ con_method + ".npy")
 
-        else: 
-                
-            nb_splits = cur_data.shape[1] // (epoch_window_length * sfreq)
-            
-            print "epoching data with {}s by window, resulting in {} epochs".format(epoch_window_length,nb_splits)
-            
-            list_epoched_data = np.array_split(cur_data,nb_splits,axis = 1)
-            
-            print len(list_epoched_data)
-            
-            data = np.array(list_epoched_data)
-            
-            print data.shape
+    np.save(stacked_conmat_file,all_con_matrices)
 
-        con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, 
-                                                                              mode='multitaper', sfreq=sfreq, 
-                                                                              fmin= freq_band[0], fmax=freq_band[1], 
-                                                                              faverage=True, tmin=None,    
-                                                                              mt_adaptive=False, n_jobs=1)
+    conmat_files = []
 
-        print con_matrix.shape
-        con_matrix = np.array(con_matrix[:,:,0])
+    for i,con_matrix in enumerate(all_con_matrices):
 
-        print con_matrix.shape
-        print np.min(con_matrix),np.max(con_matrix)
-        
         conmat_file = os.path.abspath("conmat_"+ con_method + "_" + str(i) + ".npy")
 
         np.save(conmat_file,con_matrix)
 
         conmat_files.append(conmat_file)
             
+    if return_stacked == True:
+        
+        return conmat_files,stacked_conmat_file
+        
     return conmat_files
 
 ################# laisser pour l'instant, a modifier dans brainvision_to_conmat
@@ -298,14 +1665,14 @@ def epoched_multiple_spectral_proc(ts_file,sfreq,freq_band_name,freq_band,con_me
 
         #return conmat_file
     
-def multiple_windowed_spectral_proc(ts_file,sfreq,freq_band,con_method):
+def multiple_windowed_spectral_proc(ts_file,sfreq,freq_band,con_method,n_jobs = 1):
 
     import numpy as np
     import os
 
-    from mne.connectivity import spectral_connectivity
+    from neuropype_ephy.spectral import batch_spectral_connectivity
 
-    all_data = np.load(ts_file)
+    all_data = np.load(ts_file,mmap_mode = 'r')
 
     print all_data.shape
 
@@ -319,40 +1686,31 @@ def multiple_windowed_spectral_proc(ts_file,sfreq,freq_band,con_method):
         
         return []
 
-    all_con_matrices = []
+    nb_trials,nb_windows,nb_nodes,nb_timepoints = all_data.shape
 
-    for i in range(all_data.shape[0]):
+    if con_method == 'cohy':
+        dtype = np.complex128
+    else:
+        dtype = np.float64
 
-        trial_con_matrices = []
-        
-        for j in range(all_data.shape[1]):
-                        
-            cur_data = all_data[i,j,:,:]
+    ### results are written directly in the memory-mapped .npy file
+    conmat_file = os.path.abspath("multiple_windowed_conmat_"+ con_method + ".npy")
 
-            print cur_data.shape
-                
-            data = cur_data.reshape(1,cur_data.shape[0],cur_data.shape[1])
+    np_all_con_matrices = np.lib.format.open_memmap(conmat_file, mode = 'w+', dtype = dtype, shape = (nb_trials,nb_windows,nb_nodes,nb_nodes))
 
-            con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, mode='multitaper', sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1], faverage=True, tmin=None,    mt_adaptive=False, n_jobs=1)
+    ### trials * windows as a single batch dimension, each window being a single epoch (views, no copy)
+    data = all_data.reshape(nb_trials * nb_windows,1,nb_nodes,nb_timepoints)
 
-            print con_matrix.shape
-            
-            con_matrix = np.array(con_matrix[:,:,0])
-            print con_matrix.shape
+    out = np_all_con_matrices.reshape(nb_trials * nb_windows,1,nb_nodes,nb_nodes)
+
+    batch_spectral_connectivity(data,con_method,sfreq,freq_bands = [freq_band],n_jobs = n_jobs,out = out)
 
-            print np.min(con_matrix),np.max(con_matrix)
-    
-            trial_con_matrices.append(con_matrix)
-            
-        all_con_matrices.append(trial_con_matrices)
-        
-    np_all_con_matrices = np.array(all_con_matrices)
-    
     print np_all_con_matrices.shape
-    
-    conmat_file = os.path.abspath("multiple_windowed_conmat_"+ con_method + ".npy")
+    print np.min(np_all_con_matrices),np.max(np_all_con_matrices)
+
+    np_all_con_matrices.flush()
 
-    np.save(conmat_file,np_all_con_matrices)
+    del out, np_all_con_matrices
 
     return conmat_file
 
@@ -412,57 +1770,101 @@ def multiple_windowed_spectral_proc(ts_file,sfreq,freq_band,con_method):
     
     #return win_splitted_ts_files 
         
+def parse_contact_labels(labels_file,sep_label_name):
+    """
+    Parse contact labels (one per line, electrode name + sep_label_name + contact number) once
+
+    Returns an electrode index and a contact number per label (arrays of length nb_nodes)
+    """
+
+    import numpy as np
+
+    labels = [line.strip().split(sep_label_name) for line in open(labels_file)]
+
+    elec_names,elec_ids = np.unique([label[0] for label in labels],return_inverse = True)
+
+    contacts = np.array([int(label[1]) for label in labels])
+
+    return elec_ids,contacts
+
+def get_adjacent_contacts_mask(elec_ids,contacts,k_neigh):
+    """
+    Mask of pairs of contacts of the same electrode, up to k_neigh contacts apart
+
+    adj_mat[i,j] (i < j) is True if contacts[j] - contacts[i] is between 1 and k_neigh
+
+    Returns a boolean array of shape (nb_nodes, nb_nodes), upper triangular
+    """
+
+    import numpy as np
+
+    contact_diff = contacts[np.newaxis,:] - contacts[:,np.newaxis]
+
+    adj_mat = (elec_ids[:,np.newaxis] == elec_ids[np.newaxis,:]) & (contact_diff >= 1) & (contact_diff <= k_neigh)
+
+    return np.triu(adj_mat,1)
+
 def filter_adj_plot_mat(conmat_file,labels_file,sep_label_name,k_neigh):
+    """
+    Set to 0 connectivity between adjacent contacts of the same electrode (up to k_neigh contacts apart)
+
+    conmat_file can be a single conmat file, or a list of conmat files (bands,
+    windows...) sharing the same labels, then a list of filtered files is returned.
+    Conmats can be stacked (..., nb_nodes, nb_nodes).
+    """
 
     import numpy as np
     import os
-    
-    from itertools import combinations
-    
-    labels = [line.strip().split(sep_label_name) for line in open(labels_file)]
-    
-    print labels
-    
-    triu_indices = np.triu_indices(len(labels),1)
-    
-    print triu_indices
-            
-    adj_mat = np.zeros(shape = (len(labels),len(labels)),dtype = bool)
-                   
-    for i in range(k_neigh):               
-                    
-        adj_plots = [(a[0] == b[0]) and ((int(a[1]) + i + 1 )== int(b[1])) for a,b in combinations(labels,2)]
-        
-        print len(adj_plots)
-        
-        adj_mat[triu_indices] =  adj_mat[triu_indices] + adj_plots
-        
-        print np.sum(adj_mat == True)
-        
-    print adj_mat
-    
-    ### loading ad filtering conmat_file
-    conmat = np.load(conmat_file)
-    
-    print conmat
-    
-    assert conmat.shape[0] == len(labels), "warning, wrong dimensions between labels and conmat"
-    
-    filtered_conmat = np.transpose(conmat).copy()
-    
-    #print np.transpose(adj_mat) == True
-    
-    x,y = np.where(adj_mat == True)
-    
-    filtered_conmat[x,y] = 0.0
-    
-    print filtered_conmat
-    
-    filtered_conmat_file = os.path.abspath("filtered_conmat.npy")
-    
-    np.save(filtered_conmat_file,np.transpose(filtered_conmat))
-    
-    return filtered_conmat_file
+
+    from nipype.utils.filemanip import split_filename as split_f
+
+    from neuropype_ephy.packed_conmat import load_conmat
+    from neuropype_ephy.spectral import parse_contact_labels, get_adjacent_contacts_mask
+
+    ### labels are parsed once for all conmat files
+    elec_ids,contacts = parse_contact_labels(labels_file,sep_label_name)
+
+    adj_mat = get_adjacent_contacts_mask(elec_ids,contacts,k_neigh)
+
+    print "{} pairs of adjacent contacts filtered".format(np.sum(adj_mat))
+
+    is_batch = isinstance(conmat_file,list)
+
+    if is_batch:
+        conmat_files = conmat_file
+    else:
+        conmat_files = [conmat_file]
+
+    filtered_conmat_files = []
+
+    for conmat_file in conmat_files:
+
+        ### loading ad filtering conmat_file
+        conmat = load_conmat(conmat_file)
+
+        print conmat.shape
+
+        assert conmat.shape[-1] == len(contacts), "warning, wrong dimensions between labels and conmat"
+
+        ### conmats are lower triangular
+        filtered_conmat = conmat.copy()
+
+        filtered_conmat[...,adj_mat.T] = 0.0
+
+        if is_batch:
+            path,fname,ext = split_f(conmat_file)
+            filtered_conmat_file = os.path.abspath("filtered_" + fname + ".npy")
+        else:
+            filtered_conmat_file = os.path.abspath("filtered_conmat.npy")
+
+        np.save(filtered_conmat_file,filtered_conmat)
+
+        filtered_conmat_files.append(filtered_conmat_file)
+
+    if is_batch:
+        return filtered_conmat_files
+
+    return filtered_conmat_files[0]
   
             
             
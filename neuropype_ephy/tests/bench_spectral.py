@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the spectral connectivity stage
+
+Cases are run on synthetic data (random time series), over a sweep of node
+count, epoch count, epoch length, con_method and mode. Each case runs in a
+fresh process, and reports wall time and peak RSS (resident memory) of this
+process, so that results can be compared between releases:
+
+    python neuropype_ephy/tests/bench_spectral.py --quick
+    python neuropype_ephy/tests/bench_spectral.py --bench SpectralConn --output bench_0.0.1.json
+
+(this module is not collected by pytest, as its name does not start with test_)
+"""
+
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sfreq = 256.
+freq_band = [8., 30.]
+
+### parameters swept for each benchmarked function
+sweeps = {
+    'compute_and_save_spectral_connectivity': dict(nb_nodes=[16, 64, 128], n_epochs=[10, 50], epoch_length=[256, 1024],
+                                                   con_method=['coh', 'wpli'], mode=['multitaper', 'cwt_morlet']),
+    'multiple_spectral_proc': dict(n_samples=[10, 50], nb_nodes=[16, 64], epoch_length=[256, 1024],
+                                   con_method=['coh', 'imcoh']),
+    'multiple_windowed_spectral_proc': dict(n_trials=[5, 20], n_windows=[4], nb_nodes=[16, 64], epoch_length=[256, 1024],
+                                            con_method=['coh', 'imcoh']),
+    'SpectralConn': dict(nb_nodes=[16, 64], n_epochs=[10, 50], epoch_length=[256, 1024],
+                         con_method=['coh', 'wpli'], mode=['multitaper', 'cwt_morlet']),
+}
+
+### smallest case of each sweep, for smoke runs
+quick_sweeps = dict([(name, dict([(param, values[:1]) for param, values in sweep.items()])) for name, sweep in sweeps.items()])
+
+
+def make_data_file(data_dir, shape, seed=0):
+    """
+    Save random time series of a given shape in .npy format
+    """
+    ts_file = os.path.join(data_dir, 'ts_{}.npy'.format('_'.join([str(dim) for dim in shape])))
+
+    if not os.path.exists(ts_file):
+        np.save(ts_file, np.random.RandomState(seed).randn(*shape))
+
+    return ts_file
+
+
+def get_data_shape(bench_name, params):
+
+    if bench_name in ['compute_and_save_spectral_connectivity']:
+        return (params['n_epochs'], params['nb_nodes'], params['epoch_length'])
+
+    elif bench_name == 'SpectralConn':
+        ### continuous time series, epoched by the node
+        return (params['nb_nodes'], params['n_epochs'] * params['epoch_length'])
+
+    elif bench_name == 'multiple_spectral_proc':
+        return (params['n_samples'], params['nb_nodes'], params['epoch_length'])
+
+    elif bench_name == 'multiple_windowed_spectral_proc':
+        return (params['n_trials'], params['n_windows'], params['nb_nodes'], params['epoch_length'])
+
+    raise ValueError("Unknown benchmark {}".format(bench_name))
+
+
+def run_bench(bench_name, ts_file, params):
+    """
+    Function benchmarked for bench_name (data loading included)
+    """
+    if bench_name == 'compute_and_save_spectral_connectivity':
+
+        from neuropype_ephy.spectral import compute_and_save_spectral_connectivity
+
+        compute_and_save_spectral_connectivity(np.load(ts_file), params['con_method'], sfreq, freq_band[0], freq_band[1],
+                                               mode=params['mode'])
+
+    elif bench_name == 'multiple_spectral_proc':
+
+        from neuropype_ephy.spectral import multiple_spectral_proc
+
+        multiple_spectral_proc(ts_file, sfreq, freq_band, params['con_method'])
+
+    elif bench_name == 'multiple_windowed_spectral_proc':
+
+        from neuropype_ephy.spectral import multiple_windowed_spectral_proc
+
+        multiple_windowed_spectral_proc(ts_file, sfreq, freq_band, params['con_method'])
+
+    elif bench_name == 'SpectralConn':
+
+        from neuropype_ephy.interfaces.mne.spectral import SpectralConn
+
+        SpectralConn(ts_file=ts_file, sfreq=sfreq, freq_band=freq_band, con_method=params['con_method'],
+                     mode=params['mode'], epoch_window_length=params['epoch_length'] / sfreq).run()
+
+
+def _run_case(bench_name, ts_file, params, out_dir):
+    """
+    Run one case (in a worker process), returns wall time in s, and peak and baseline RSS in MB
+    """
+    import resource
+
+    ### Linux reports ru_maxrss in kB, OS X in bytes
+    rss_unit = 1024. ** 2 if sys.platform == 'darwin' else 1024.
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit
+
+    os.chdir(out_dir)
+
+    ### functions are verbose
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    try:
+        start = time.time()
+        run_bench(bench_name, ts_file, params)
+        wall_time = time.time() - start
+
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit
+
+    return wall_time, peak_rss, baseline_rss
+
+
+def bench_case(bench_name, params, data_dir):
+    """
+    Run one case in a fresh process, so that peak RSS is not shared between cases
+    """
+    from multiprocessing import Pool
+
+    ts_file = make_data_file(data_dir, get_data_shape(bench_name, params))
+
+    out_dir = tempfile.mkdtemp(dir=data_dir)
+
+    pool = Pool(1, maxtasksperchild=1)
+
+    try:
+        wall_time, peak_rss, baseline_rss = pool.apply(_run_case, (bench_name, ts_file, params, out_dir))
+    finally:
+        pool.terminate()
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    return {'bench': bench_name, 'params': params, 'wall_time': wall_time,
+            'peak_rss_mb': peak_rss, 'delta_rss_mb': peak_rss - baseline_rss}
+
+
+def iter_params(sweep):
+
+    names = sorted(sweep.keys())
+
+    for values in itertools.product(*[sweep[name] for name in names]):
+        yield dict(zip(names, values))
+
+
+def run_benchmarks(bench_names=None, quick=False, data_dir=None):
+    """
+    Run all cases of the benchmarks bench_names (default, all), returns a list of results
+    """
+    import mne
+
+    mne.set_log_level('ERROR')
+
+    all_sweeps = quick_sweeps if quick else sweeps
+
+    if bench_names is None:
+        bench_names = sorted(all_sweeps.keys())
+
+    tmp_dir = None
+    if data_dir is None:
+        data_dir = tmp_dir = tempfile.mkdtemp(prefix='bench_spectral_')
+
+    results = []
+
+    try:
+        for bench_name in bench_names:
+            for params in iter_params(all_sweeps[bench_name]):
+
+                result = bench_case(bench_name, params, data_dir)
+
+                print "{:<42} {:<80} {:>8.2f} s {:>8.1f} MB (+{:.1f} MB)".format(
+                    bench_name, ', '.join(['{} = {}'.format(name, value) for name, value in sorted(params.items())]),
+                    result['wall_time'], result['peak_rss_mb'], result['delta_rss_mb'])
+
+                sys.stdout.flush()
+
+                results.append(result)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return results
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the spectral connectivity stage')
+
+    parser.add_argument('--bench', action='append', choices=sorted(sweeps.keys()), help='benchmark to run (default, all)')
+    parser.add_argument('--quick', action='store_true', help='only run the smallest case of each benchmark')
+    parser.add_argument('--output', help='save results in .json format')
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.bench, quick=args.quick)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,43 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from neuropype_ephy.aux_tools import get_n_jobs
+
+
+@pytest.mark.parametrize('n_jobs,max_jobs,expected', [(1, None, 1),
+                                                      (2, None, 2),
+                                                      (16, None, 8),
+                                                      (-1, None, 8),
+                                                      (-3, None, 6),
+                                                      (-16, None, 1),
+                                                      (0, None, 1),
+                                                      (None, None, 1),
+                                                      (4, '2', 2),
+                                                      (-1, '3', 3),
+                                                      (2, '16', 2),
+                                                      (4, '0', 1),
+                                                      (4, '', 4)])
+def test_get_n_jobs(n_jobs, max_jobs, expected, monkeypatch):
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 8)
+    if max_jobs is None:
+        monkeypatch.delenv('NEUROPYPE_EPHY_MAX_JOBS', raising=False)
+    else:
+        monkeypatch.setenv('NEUROPYPE_EPHY_MAX_JOBS', max_jobs)
+    assert get_n_jobs(n_jobs) == expected
+
+
+def test_batch_spectral_connectivity_max_jobs(monkeypatch):
+    from neuropype_ephy.spectral import batch_spectral_connectivity
+    samples = np.random.RandomState(0).randn(3, 4, 3, 200)
+    ref_conmats = batch_spectral_connectivity(samples, 'coh', 100., [[8., 12.]])
+    # within a budget of 1 process, blocks are computed in the main process
+    def parallel_func(*args, **kwargs):
+        raise AssertionError('processes used beyond NEUROPYPE_EPHY_MAX_JOBS')
+    monkeypatch.setattr('mne.parallel.parallel_func', parallel_func)
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 4)
+    monkeypatch.setenv('NEUROPYPE_EPHY_MAX_JOBS', '1')
+    conmats = batch_spectral_connectivity(samples, 'coh', 100., [[8., 12.]],
+                                          block_size=1, n_jobs=4)
+    assert np.allclose(conmats, ref_conmats)
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+
+### submodules imported lazily by SpectralConn, imported here as the tests change the current directory
+import neuropype_ephy.multitaper
+import neuropype_ephy.packed_conmat
+import neuropype_ephy.interfaces.mne.spectral as spectral_interfaces
+
+from neuropype_ephy.conmat_cache import ConmatCache
+from neuropype_ephy.interfaces.mne.spectral import SpectralConn
+
+
+def save_array(array_file, array):
+    np.save(array_file, array)
+    return array_file
+
+
+def test_conmat_cache(tmpdir):
+    cache = ConmatCache(str(tmpdir.join('cache')))
+    rng = np.random.RandomState(0)
+    ts_file = save_array(str(tmpdir.join('ts.npy')), rng.randn(4, 100))
+    conmat_file = save_array(str(tmpdir.join('conmat.npy')), rng.rand(4, 4))
+    params = {'con_method': 'coh', 'freq_band': [8., 12.]}
+    key = cache.make_key(ts_file, params)
+    assert cache.get(key) is None
+    cache.put(key, {'conmat_file': conmat_file})
+    # hit, files are copied in out_dir
+    out_dir = tmpdir.mkdir('out')
+    outputs = cache.get(cache.make_key(ts_file, dict(params)), out_dir=str(out_dir))
+    assert outputs == {'conmat_file': str(out_dir.join('conmat.npy'))}
+    assert np.array_equal(np.load(outputs['conmat_file']), np.load(conmat_file))
+    # miss when a parameter changes
+    assert cache.get(cache.make_key(ts_file, dict(params, con_method='wpli'))) is None
+    # miss when the content of the input file changes (same path)
+    save_array(ts_file, rng.randn(4, 100))
+    assert cache.get(cache.make_key(ts_file, params)) is None
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_conmat_cache_eviction(tmpdir):
+    # about 1.2kB per entry, at most one entry in the cache
+    cache = ConmatCache(str(tmpdir.join('cache')), max_size=2e-3)
+    ts_file = save_array(str(tmpdir.join('ts.npy')), np.zeros(10))
+    conmat_file = save_array(str(tmpdir.join('conmat.npy')), np.zeros(128))
+    keys = [cache.make_key(ts_file, {'index': index}) for index in range(3)]
+    cache.put(keys[0], {'conmat_file': conmat_file})
+    # older last use, whatever the resolution of file times
+    manifest_file = os.path.join(cache.cache_dir, keys[0], 'manifest.json')
+    os.utime(manifest_file, (os.path.getmtime(manifest_file) - 10,) * 2)
+    cache.put(keys[1], {'conmat_file': conmat_file})
+    assert cache.stats()['size'] == 1
+    # least recently used entry removed
+    out_dir = str(tmpdir.mkdir('out'))
+    assert cache.get(keys[0], out_dir=out_dir) is None
+    assert cache.get(keys[1], out_dir=out_dir) is not None
+    # the most recent entry is kept, even if larger than max_size
+    cache.put(keys[2], {'conmat_file': save_array(str(tmpdir.join('big.npy')), np.zeros(1024))})
+    assert [os.path.basename(entry_dir) for mtime, size, entry_dir in cache.get_entries()] == [keys[2]]
+
+
+def make_spectral_conn(ts_file, cache_dir, **inputs):
+    spectral_conn = SpectralConn()
+    spectral_conn.inputs.ts_file = ts_file
+    spectral_conn.inputs.sfreq = 100.
+    spectral_conn.inputs.freq_bands = [[8., 12.], [15., 30.]]
+    spectral_conn.inputs.con_method = 'coh'
+    spectral_conn.inputs.use_cache = True
+    spectral_conn.inputs.cache_dir = cache_dir
+    for name, value in inputs.items():
+        setattr(spectral_conn.inputs, name, value)
+    return spectral_conn
+
+
+def test_spectral_conn_cache(tmpdir, monkeypatch):
+    ts_file = save_array(str(tmpdir.join('ts.npy')), np.random.RandomState(0).randn(6, 4, 200))
+    cache_dir = str(tmpdir.join('cache'))
+    monkeypatch.chdir(tmpdir.mkdir('run_1'))
+    outputs = make_spectral_conn(ts_file, cache_dir).run().outputs
+    stacked_conmats = np.load(outputs.stacked_conmat_file)
+    # the second run is a cache hit, nothing is computed
+    def compute_and_save(*args, **kwargs):
+        raise AssertionError('conmats computed on a cache hit')
+    monkeypatch.setattr(spectral_interfaces, 'compute_and_save_multiband_spectral_connectivity', compute_and_save)
+    monkeypatch.chdir(tmpdir.mkdir('run_2'))
+    cached_outputs = make_spectral_conn(ts_file, cache_dir, n_jobs=2).run().outputs
+    assert os.path.dirname(cached_outputs.stacked_conmat_file) == str(tmpdir.join('run_2'))
+    assert np.array_equal(np.load(cached_outputs.stacked_conmat_file), stacked_conmats)
+    assert len(cached_outputs.conmat_files) == 2
+
+
+@pytest.mark.parametrize('name,value', [('mode', 'cwt_morlet'),
+                                        ('freq_bands', [[8., 12.], [15., 25.]]),
+                                        ('freq_band_names', ['alpha', 'beta']),
+                                        ('precision', 'float32'),
+                                        ('con_method', 'wpli'),
+                                        ('epoch_window_length', 1.),
+                                        ('packed_output', True),
+                                        ('seed_indices', [0])])
+def test_spectral_conn_cache_key(name, value, tmpdir):
+    ts_file = save_array(str(tmpdir.join('ts.npy')), np.random.RandomState(0).randn(6, 4, 200))
+    cache = ConmatCache(str(tmpdir.join('cache')))
+    key = make_spectral_conn(ts_file, cache.cache_dir)._get_cache_key(cache)
+    # n_jobs, streaming and chunk_size do not change the results
+    assert make_spectral_conn(ts_file, cache.cache_dir, n_jobs=2, chunk_size=4)._get_cache_key(cache) == key
+    assert make_spectral_conn(ts_file, cache.cache_dir, **{name: value})._get_cache_key(cache) != key
@@ -0,0 +1,39 @@
+import mne
+import numpy as np
+import pytest
+
+from neuropype_ephy.fif2ts import ep2ts
+
+ch_names = ['MEG 001', 'MEG 002', 'MEG 003', 'MEG 004', 'EEG 001', 'EEG 002',
+            'EOG 001']
+ch_types = ['mag', 'grad', 'grad', 'mag', 'eeg', 'eeg', 'eog']
+
+
+def make_epochs_file(epochs_fname, n_epochs=10):
+    info = mne.create_info(ch_names, 200., ch_types)
+    info['bads'] = ['MEG 004']
+    data = np.random.RandomState(0).randn(n_epochs, len(ch_names), 100) * 1e-12
+    epochs = mne.EpochsArray(data, info, verbose='ERROR')
+    epochs.save(epochs_fname)
+    return epochs_fname
+
+
+@pytest.mark.parametrize('ch_types,names', [(['meg'], ['MEG 001', 'MEG 002', 'MEG 003']),
+                                            (['mag'], ['MEG 001']),
+                                            (['grad', 'eeg'], ['MEG 002', 'MEG 003', 'EEG 001', 'EEG 002']),
+                                            (['mag', 'grad', 'eog'], ['MEG 001', 'MEG 002', 'MEG 003', 'EOG 001'])])
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+def test_ep2ts(ch_types, names, precision, tmpdir, monkeypatch):
+    epochs_fname = make_epochs_file(str(tmpdir.join('test-epo.fif')))
+    epochs = mne.read_epochs(epochs_fname, verbose='ERROR')
+    # bad channels are excluded
+    expected = epochs.get_data()[:, [ch_names.index(name) for name in names]]
+    monkeypatch.chdir(tmpdir.mkdir('in_memory'))
+    ts = np.load(ep2ts(epochs_fname, precision, ch_types))
+    assert ts.dtype == np.dtype(precision)
+    assert np.array_equal(ts, expected.astype(precision))
+    # epochs read and written by chunks (not a divisor of the number of epochs)
+    monkeypatch.chdir(tmpdir.mkdir('chunks'))
+    chunked_ts = np.load(ep2ts(epochs_fname, precision, ch_types, chunk_size=3))
+    assert chunked_ts.dtype == np.dtype(precision)
+    assert np.array_equal(chunked_ts, ts)
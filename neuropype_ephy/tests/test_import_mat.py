@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from scipy.io import savemat
+
+from neuropype_ephy.import_mat import is_mat_v73, read_h5mat_ts, read_tsmat
+
+# v7.3 files are only read if h5py is installed
+h5py = pytest.importorskip('h5py')
+
+
+def make_mat_files(tmpdir):
+    rng = np.random.RandomState(0)
+    data = rng.randn(6, 1000)
+    channel_flag = np.array([[1], [1], [-1], [1], [-1], [1]])
+    v5_file = str(tmpdir.join('ts_v5.mat'))
+    savemat(v5_file, {'F': data, 'ChannelFlag': channel_flag})
+    # v7.3: HDF5 after a 512 bytes header, matlab arrays stored in column-major
+    # order, i.e. transposed for h5py
+    v73_file = str(tmpdir.join('ts_v73.mat'))
+    with h5py.File(v73_file, 'w', userblock_size=512) as mat:
+        mat.create_dataset('F', data=data.T)
+        mat.create_dataset('ChannelFlag', data=channel_flag.T)
+        mat.create_dataset('Time', data=np.arange(1000.)[:, np.newaxis])
+    with open(v73_file, 'r+b') as f:
+        f.write(b'MATLAB 7.3 MAT-file'.ljust(128))
+    return data, channel_flag.reshape(-1) == 1, v5_file, v73_file
+
+
+@pytest.mark.parametrize('block_size', [2 ** 24, 100])
+@pytest.mark.parametrize('precision', ['float32', 'float64'])
+def test_read_h5mat_ts(block_size, precision, tmpdir):
+    data, good_channels, v5_file, v73_file = make_mat_files(tmpdir)
+    assert is_mat_v73(v73_file) and not is_mat_v73(v5_file)
+    good_data = read_h5mat_ts(v73_file, precision=precision,
+                              block_size=block_size)
+    assert good_data.dtype == np.dtype(precision)
+    assert np.array_equal(good_data, data[good_channels].astype(precision))
+    # same as the v5 file
+    assert np.array_equal(read_tsmat(v73_file, precision=precision),
+                          read_tsmat(v5_file, precision=precision))
+    # all channels
+    assert np.array_equal(read_h5mat_ts(v73_file, good_channels_field_name=None,
+                                        precision=precision, block_size=block_size),
+                          read_tsmat(v5_file, good_channels_field_name=None,
+                                     precision=precision))
@@ -0,0 +1,75 @@
+import pickle
+
+import numpy as np
+from mne import Label
+
+from neuropype_ephy.labels_store import (save_labels_store, load_labels_store,
+                                         LabelsStore, memmap_npz_member)
+
+
+def make_labels():
+    rng = np.random.RandomState(0)
+    labels = []
+    # label y-positions: front (high y) to back
+    for name, hemi, y, color in [('frontal-lh', 'lh', 0.05, (1., 0., 0., 1.)),
+                                 ('occipital-lh', 'lh', -0.08, None),
+                                 ('parietal-lh', 'lh', -0.03, (0., 1., 0., 1.)),
+                                 ('frontal-rh', 'rh', 0.05, None),
+                                 ('parietal-rh', 'rh', -0.03, None),
+                                 ('occipital-rh', 'rh', -0.08, None)]:
+        n_vertices = rng.randint(3, 10)
+        pos = rng.randn(n_vertices, 3) * 1e-3 + [0., y, 0.]
+        vertices = np.sort(rng.choice(1000, n_vertices, replace=False))
+        labels.append(Label(vertices, pos, hemi=hemi, name=name, color=color))
+    return labels
+
+
+def test_labels_store(tmpdir):
+    labels = make_labels()
+    labels_file = save_labels_store(str(tmpdir.join('labels.npz')), labels)
+
+    with LabelsStore(labels_file) as labels_store:
+        assert labels_store.names == [label.name for label in labels]
+        assert len(labels_store) == len(labels)
+        assert labels_store.index('parietal-lh') == 2
+        assert labels_store.colors[0] == (1., 0., 0., 1.)
+        assert labels_store.colors[1] is None
+
+        label = labels_store['parietal-lh']
+        assert label['hemi'] == 'lh' and label['color'] == (0., 1., 0., 1.)
+        assert np.allclose(label['centroid'], np.mean(labels[2].pos, axis=0))
+        assert labels_store[2]['name'] == 'parietal-lh'
+
+        # left hemisphere from front to back, then the matching right labels
+        # from back to front (mirrored on the circle)
+        assert labels_store.node_order == ['frontal-lh', 'parietal-lh', 'occipital-lh',
+                                           'occipital-rh', 'parietal-rh', 'frontal-rh']
+
+        for label in labels:
+            assert np.array_equal(labels_store.get_vertices(label.name), label.vertices)
+            assert np.allclose(labels_store.get_pos(label.name), label.pos)
+
+
+def test_vertices_memmap(tmpdir):
+    labels = make_labels()
+    labels_file = save_labels_store(str(tmpdir.join('labels.npz')), labels)
+
+    vertices = memmap_npz_member(labels_file, 'vertices')
+    assert isinstance(vertices, np.memmap)
+    assert np.array_equal(vertices, np.concatenate([label.vertices for label in labels]))
+
+
+def test_load_pickled_labels(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    labels = make_labels()
+
+    # labels.dat of previous versions: number of labels, then pickled labels
+    with open('labels.dat', 'wb') as f:
+        pickle.dump(len(labels), f)
+        for label in labels:
+            pickle.dump(label, f)
+
+    with load_labels_store(str(tmpdir.join('labels.dat'))) as labels_store:
+        assert labels_store.labels_file == str(tmpdir.join('labels.npz'))
+        assert labels_store.names == [label.name for label in labels]
+        assert np.array_equal(labels_store.get_vertices('frontal-rh'), labels[3].vertices)
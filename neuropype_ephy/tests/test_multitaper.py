@@ -0,0 +1,64 @@
+from imp import reload
+
+import numpy as np
+import pytest
+
+from neuropype_ephy import multitaper
+from neuropype_ephy.multitaper import DPSSCache, make_dpss
+
+
+def test_dpss_cache_lru():
+    cache = DPSSCache(max_size=2)
+
+    tapers, eigvals = cache.get(200, 100.)
+    ref_tapers, ref_eigvals = make_dpss(200, 100.)
+    assert np.allclose(tapers, ref_tapers) and np.allclose(eigvals, ref_eigvals)
+
+    # cached arrays are shared, so they are read-only
+    assert cache.get(200, 100.)[0] is tapers
+    with pytest.raises(ValueError):
+        tapers[0, 0] = 0.
+
+    cache.get(300, 100.)
+    cache.get(200, 100.)
+    # 300 is now the least recently used, and is evicted
+    cache.get(400, 100.)
+    assert cache.stats() == {'hits': 2, 'disk_hits': 0, 'misses': 3, 'size': 2}
+
+    cache.get(200, 100.)
+    cache.get(300, 100.)
+    assert cache.stats() == {'hits': 3, 'disk_hits': 0, 'misses': 4, 'size': 2}
+
+    # other bandwidth, other tapers
+    cache.get(200, 100., bandwidth=8.)
+    assert cache.misses == 5
+
+    cache.clear()
+    assert cache.stats() == {'hits': 0, 'disk_hits': 0, 'misses': 0, 'size': 0}
+
+
+def test_dpss_cache_disk(tmpdir):
+    cache_dir = str(tmpdir.join('dpss'))
+
+    tapers, eigvals = DPSSCache(cache_dir=cache_dir).get(200, 100., 8.)
+
+    # another process (here another cache) reads the tapers from disk
+    other_cache = DPSSCache(cache_dir=cache_dir)
+    other_tapers, other_eigvals = other_cache.get(200, 100., 8.)
+
+    assert other_cache.stats() == {'hits': 0, 'disk_hits': 1, 'misses': 0, 'size': 1}
+    assert np.array_equal(tapers, other_tapers)
+    assert np.array_equal(eigvals, other_eigvals)
+
+
+def test_dpss_cache_dir_env(tmpdir, monkeypatch):
+    monkeypatch.setenv('NEUROPYPE_EPHY_DPSS_CACHE_DIR', str(tmpdir))
+    try:
+        reload(multitaper)
+        assert multitaper.dpss_cache.cache_dir == str(tmpdir)
+        multitaper.compute_dpss(250, 100.)
+        assert len(tmpdir.listdir()) == 1
+    finally:
+        monkeypatch.delenv('NEUROPYPE_EPHY_DPSS_CACHE_DIR')
+        reload(multitaper)
+    assert multitaper.dpss_cache.cache_dir is None
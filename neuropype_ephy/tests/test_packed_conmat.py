@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from scipy.io import loadmat
+
+from neuropype_ephy.packed_conmat import (pack_conmat, unpack_conmat,
+                                          save_packed_conmat, PackedConmat,
+                                          load_conmat, read_node_names,
+                                          export_conmat_to_matlab)
+
+
+def make_conmats(complex_values=False, n_bands=3, n_nodes=5):
+    rng = np.random.RandomState(0)
+    conmats = rng.rand(n_bands, n_nodes, n_nodes)
+    if complex_values:
+        conmats = conmats + 1j * rng.rand(n_bands, n_nodes, n_nodes)
+    # lower triangular, as the conmats of the spectral module
+    return np.tril(conmats, -1)
+
+
+@pytest.mark.parametrize('complex_values', [False, True])
+def test_pack_unpack(complex_values):
+    conmats = make_conmats(complex_values)
+
+    packed = pack_conmat(conmats)
+    assert packed.shape == (3, 10)
+    assert packed.dtype == (np.complex64 if complex_values else np.float32)
+
+    assert np.allclose(unpack_conmat(packed, 5), conmats, rtol=1e-6)
+    assert np.allclose(unpack_conmat(packed, 5, symmetric=True),
+                       conmats + conmats.swapaxes(-1, -2), rtol=1e-6)
+
+    # full precision on request
+    assert np.array_equal(unpack_conmat(pack_conmat(conmats, np.float64), 5), conmats)
+
+
+@pytest.mark.parametrize('complex_values', [False, True])
+def test_packed_conmat_file(complex_values, tmpdir):
+    conmats = make_conmats(complex_values)
+    node_names = ['node_{}'.format(i) for i in range(5)]
+
+    conmat_file = save_packed_conmat(str(tmpdir.join('conmat.npz')), conmats,
+                                     node_names=node_names)
+
+    assert read_node_names(conmat_file) == node_names
+
+    with PackedConmat(conmat_file) as packed_conmat:
+        assert packed_conmat.shape == (3, 5, 5)
+        assert len(packed_conmat) == 3
+        assert packed_conmat.node_names == node_names
+        assert np.allclose(packed_conmat[1], conmats[1], rtol=1e-6)
+
+    assert np.allclose(load_conmat(conmat_file), conmats, rtol=1e-6)
+    assert np.allclose(load_conmat(conmat_file, symmetric=True),
+                       conmats + conmats.swapaxes(-1, -2), rtol=1e-6)
+
+
+def test_load_dense_conmat(tmpdir):
+    conmats = make_conmats()
+
+    conmat_file = str(tmpdir.join('conmat.npy'))
+    np.save(conmat_file, conmats)
+
+    assert np.array_equal(load_conmat(conmat_file), conmats)
+    assert read_node_names(conmat_file) == []
+
+
+def test_export_packed_conmat_to_matlab(tmpdir):
+    conmats = make_conmats()
+
+    conmat_file = save_packed_conmat(str(tmpdir.join('conmat.npz')), conmats)
+    conmat_matfile = export_conmat_to_matlab(conmat_file,
+                                             str(tmpdir.join('conmat.mat')))
+
+    assert np.allclose(loadmat(conmat_matfile)['conmat'],
+                       conmats + conmats.swapaxes(-1, -2), rtol=1e-6)
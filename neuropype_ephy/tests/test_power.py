@@ -1,4 +1,13 @@
-from neuropype_ephy.power import compute_and_save_psd
+from neuropype_ephy.power import (compute_and_save_psd, compute_multitaper_psd,
+                                  compute_tfr_block, compute_raw_psd,
+                                  compute_epochs_psd,
+                                  compute_and_save_band_power)
+from neuropype_ephy.morlet import compute_morlet_fft
+from mne.time_frequency import (psd_array_multitaper, psd_array_welch,
+                                tfr_array_morlet)
+import mne
+import numpy as np
+import pytest
 import os
 
 def test_power_welch():
@@ -17,3 +26,144 @@ def test_power_multitaper():
     dir_path = os.path.dirname(os.path.realpath(__file__))
     epochs_fname_abs = os.path.join(dir_path, epochs_fname)
     compute_and_save_psd(epochs_fname_abs, fmin, fmax, method='multitaper')
+
+
+@pytest.mark.parametrize('n_times', [300, 301])
+@pytest.mark.parametrize('bandwidth', [None, 8.])
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_multitaper_psd(n_times, bandwidth, adaptive):
+    data = np.random.RandomState(0).randn(3, 4, n_times)
+    psds, freqs = compute_multitaper_psd(data, 100., 2., 40.,
+                                         bandwidth=bandwidth,
+                                         adaptive=adaptive, block_size=1e4)
+    mne_psds, mne_freqs = psd_array_multitaper(data, 100., 2., 40.,
+                                               bandwidth=bandwidth,
+                                               adaptive=adaptive,
+                                               normalization='length',
+                                               verbose='ERROR')
+    assert np.allclose(freqs, mne_freqs)
+    assert np.allclose(psds, mne_psds, rtol=1e-10, atol=0)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_tfr(n_jobs):
+    data = np.random.RandomState(0).randn(10, 3, 200)
+    freqs = np.arange(8., 30., 3.)
+    # wavelets transformed once, epochs processed by chunks
+    fft_wavelets, offsets, fsize = compute_morlet_fft(200, 200., freqs, 5.)
+    power = np.concatenate([compute_tfr_block(chunk, fft_wavelets, offsets,
+                                              fsize, decim=2, n_jobs=n_jobs)
+                            for chunk in np.array_split(data, 3)])
+    mne_power = tfr_array_morlet(data, 200., freqs, n_cycles=5.,
+                                 zero_mean=True, output='power', decim=2,
+                                 verbose='ERROR')
+    assert np.allclose(power, mne_power, rtol=1e-8, atol=0)
+
+
+def make_raw(n_times=2000, seed=0):
+    # 4 magnetometers, 1 eeg channel (not picked), with a projector
+    ch_names = ['MEG 001', 'MEG 002', 'MEG 003', 'MEG 004', 'EEG 001']
+    info = mne.create_info(ch_names, 200., ['mag'] * 4 + ['eeg'])
+    data = np.random.RandomState(seed).randn(5, n_times) * 1e-12
+    raw = mne.io.RawArray(data, info, verbose='ERROR')
+    proj_vec = np.ones(4) / 2.
+    raw.add_proj(mne.Projection(active=False, desc='test', kind=1,
+                                explained_var=None,
+                                data=dict(nrow=1, ncol=4, row_names=None,
+                                          col_names=ch_names[:4],
+                                          data=proj_vec[np.newaxis])))
+    return raw
+
+
+def make_epochs_file(epochs_fname, n_epochs=7, seed=0):
+    raw = make_raw(n_epochs * 200, seed)
+    events = np.array([[i * 200, 0, 1] for i in range(n_epochs)])
+    epochs = mne.Epochs(raw, events, tmin=0., tmax=199 / 200., baseline=None,
+                        proj=False, preload=True, verbose='ERROR')
+    epochs.save(epochs_fname)
+    return epochs_fname
+
+
+@pytest.mark.parametrize('proj', [False, True])
+def test_raw_welch_psd(proj, tmpdir):
+    raw_fname = str(tmpdir.join('test_raw.fif'))
+    make_raw().save(raw_fname, verbose='ERROR')
+    # 15 windows of 256 - 128 samples, read by chunks of 4
+    psds, freqs, ch_names = compute_raw_psd(raw_fname, 2., 40., n_fft=256,
+                                            n_overlap=128, proj=proj,
+                                            chunk_size=4)
+    raw = mne.io.read_raw_fif(raw_fname, preload=True, verbose='ERROR')
+    if proj:
+        raw.apply_proj()
+    mne_psds, mne_freqs = psd_array_welch(raw.get_data()[:4], 200., 2., 40.,
+                                          n_fft=256, n_overlap=128,
+                                          verbose='ERROR')
+    assert ch_names == raw.ch_names[:4]
+    assert np.allclose(freqs, mne_freqs)
+    assert np.allclose(psds, mne_psds, rtol=1e-10, atol=0)
+    # the projector changes the psds
+    no_proj_psds = compute_raw_psd(raw_fname, 2., 40., n_fft=256,
+                                   n_overlap=128)[0]
+    assert proj == (not np.allclose(psds, no_proj_psds, rtol=1e-6, atol=0))
+    # multitaper needs epochs
+    with pytest.raises(Exception):
+        compute_raw_psd(raw_fname, 2., 40., method='multitaper')
+
+
+@pytest.mark.parametrize('proj', [False, True])
+def test_epochs_welch_psd(proj, tmpdir):
+    # epochs file detected from its content, whatever its name
+    epochs_fname = make_epochs_file(str(tmpdir.join('test-epo.fif')))
+    psds, freqs, ch_names = compute_epochs_psd(epochs_fname, 2., 40.,
+                                               n_fft=64, n_overlap=32,
+                                               proj=proj, chunk_size=3)
+    epochs = mne.read_epochs(epochs_fname, proj=proj, verbose='ERROR')
+    mne_psds, mne_freqs = psd_array_welch(epochs.get_data()[:, :4], 200., 2.,
+                                          40., n_fft=64, n_overlap=32,
+                                          verbose='ERROR')
+    assert psds.shape == (7, 4, len(mne_freqs))
+    assert np.allclose(psds, mne_psds, rtol=1e-10, atol=0)
+
+
+def test_compute_and_save_psd(tmpdir, monkeypatch):
+    raw_fname = str(tmpdir.join('test_raw.fif'))
+    make_raw().save(raw_fname, verbose='ERROR')
+    epochs_fname = make_epochs_file(str(tmpdir.join('test-epo.fif')))
+    monkeypatch.chdir(tmpdir)
+    # a psd per epoch for epochs files, a single psd for raw files
+    with np.load(compute_and_save_psd(epochs_fname, 2., 40., n_fft=64)) as f:
+        assert f['psds'].shape == (7, 4, len(f['freqs']))
+    with np.load(compute_and_save_psd(raw_fname, 2., 40., n_fft=64)) as f:
+        assert f['psds'].shape == (4, len(f['freqs']))
+        assert list(f['ch_names']) == ['MEG 001', 'MEG 002', 'MEG 003', 'MEG 004']
+
+
+def test_band_power(tmpdir, monkeypatch):
+    epochs_fnames = [make_epochs_file(str(tmpdir.join('sub1-epo.fif')), 7, 0),
+                     make_epochs_file(str(tmpdir.join('sub2-epo.fif')), 4, 1)]
+    raw_fname = str(tmpdir.join('sub3_raw.fif'))
+    make_raw(seed=2).save(raw_fname, verbose='ERROR')
+    freq_bands = [[4., 8.], [8., 13.], [13., 30.]]
+    monkeypatch.chdir(tmpdir)
+    band_power_fname = compute_and_save_band_power(
+        epochs_fnames + [raw_fname], freq_bands, ['theta', 'alpha', 'beta'],
+        2., 40., n_fft=64, chunk_size=3)
+    with np.load(band_power_fname) as f:
+        band_power, n_epochs = f['band_power'], f['n_epochs']
+        assert list(f['band_names']) == ['theta', 'alpha', 'beta']
+    assert band_power.shape == (3, 7, 4, 3)
+    assert list(n_epochs) == [7, 4, 1]
+    # files with less epochs are padded with nan
+    assert np.isnan(band_power[1, 4:]).all() and np.isnan(band_power[2, 1:]).all()
+    assert not np.isnan(band_power[0]).any()
+    # psd summed over the frequencies of each band (f_lower <= f < f_upper)
+    psds = [compute_epochs_psd(epochs_fname, 2., 40., n_fft=64)
+            for epochs_fname in epochs_fnames]
+    raw_psds, freqs, _ = compute_raw_psd(raw_fname, 2., 40., n_fft=64)
+    psds.append((raw_psds[np.newaxis], freqs, None))
+    for i, (file_psds, freqs, _) in enumerate(psds):
+        for j, (f_lower, f_upper) in enumerate(freq_bands):
+            band_mask = (freqs >= f_lower) & (freqs < f_upper)
+            assert np.allclose(band_power[i, :n_epochs[i], :, j],
+                               file_psds[..., band_mask].sum(axis=-1) * (freqs[1] - freqs[0]),
+                               rtol=1e-10, atol=0)
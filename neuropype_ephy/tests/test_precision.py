@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from scipy.io import savemat
+
+### submodules imported lazily by the nodes, imported here as the tests change the current directory
+import neuropype_ephy.import_mat
+import neuropype_ephy.fif2ts
+import neuropype_ephy.multitaper
+import neuropype_ephy.packed_conmat
+
+from neuropype_ephy.multitaper import compute_tapered_spectra
+from neuropype_ephy.nodes.import_data import ImportMat, Ep2ts
+from neuropype_ephy.interfaces.mne.spectral import SpectralConn
+from neuropype_ephy.spectral import compute_spectral_connectivity_bands
+
+sfreq = 100.
+freq_bands = [[8., 12.], [15., 30.]]
+
+
+def make_epochs(n_epochs=6, n_nodes=4, n_times=200):
+    # lagged coupling between nodes 0 and 1
+    data = np.random.RandomState(0).randn(n_epochs, n_nodes, n_times)
+    data[:, 1] += np.roll(data[:, 0], 2, axis=-1)
+    return data
+
+
+@pytest.mark.parametrize('precision', ['float32', 'float64'])
+def test_import_mat_precision(precision, tmpdir, monkeypatch):
+    tsmat_file = str(tmpdir.join('ts.mat'))
+    data = np.random.RandomState(0).randn(3, 100)
+    savemat(tsmat_file, {'F': data, 'ChannelFlag': np.array([[1], [-1], [1]])})
+    monkeypatch.chdir(tmpdir)
+    import_mat = ImportMat(tsmat_file=tsmat_file, good_channels_field_name='ChannelFlag',
+                           precision=precision)
+    ts = np.load(import_mat.run().outputs.ts_file)
+    assert ts.dtype == np.dtype(precision)
+    assert np.array_equal(ts, data[[0, 2]].astype(precision))
+
+
+@pytest.mark.parametrize('chunk_size', [None, 2])
+@pytest.mark.parametrize('precision', ['float32', 'float64'])
+def test_ep2ts_precision(precision, chunk_size, tmpdir, monkeypatch):
+    import mne
+    info = mne.create_info(['MEG 001', 'MEG 002'], 200., 'mag')
+    epochs_fname = str(tmpdir.join('test-epo.fif'))
+    mne.EpochsArray(np.random.RandomState(0).randn(5, 2, 50) * 1e-12, info,
+                    verbose='ERROR').save(epochs_fname)
+    monkeypatch.chdir(tmpdir)
+    ep2ts = Ep2ts(fif_file=epochs_fname, precision=precision)
+    if chunk_size is not None:
+        ep2ts.inputs.chunk_size = chunk_size
+    ts = np.load(ep2ts.run().outputs.ts_file)
+    assert ts.dtype == np.dtype(precision) and ts.shape == (5, 2, 50)
+
+
+@pytest.mark.parametrize('bandwidth', [None, 6.])
+def test_tapered_spectra_precision(bandwidth):
+    data = make_epochs()
+    x_mt, freqs, freq_idx_bands = compute_tapered_spectra(data, sfreq, freq_bands, bandwidth)
+    x_mt_32, freqs_32, _ = compute_tapered_spectra(data.astype(np.float32), sfreq, freq_bands, bandwidth)
+    assert x_mt.dtype == np.complex128 and x_mt_32.dtype == np.complex64
+    assert np.array_equal(freqs, freqs_32)
+    assert np.allclose(x_mt_32, x_mt, rtol=1e-5, atol=1e-5 * np.abs(x_mt).max())
+
+
+@pytest.mark.parametrize('con_method', ['coh', 'cohy', 'imcoh', 'plv', 'ppc',
+                                        'pli', 'wpli', 'wpli2_debiased'])
+def test_connectivity_precision(con_method):
+    data = make_epochs()
+    conmats = compute_spectral_connectivity_bands(data, con_method, sfreq, freq_bands)
+    conmats_32 = compute_spectral_connectivity_bands(data.astype(np.float32), con_method, sfreq, freq_bands)
+    assert conmats_32.dtype == (np.complex64 if con_method == 'cohy' else np.float32)
+    # connectivity values are at most 1, single precision is accurate to about 1e-6
+    assert np.allclose(conmats_32, conmats, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize('con_method', ['coh', 'cohy'])
+@pytest.mark.parametrize('streaming', [False, True])
+@pytest.mark.parametrize('precision', ['float32', 'float64'])
+def test_spectral_conn_precision(con_method, streaming, precision, tmpdir, monkeypatch):
+    ts_file = str(tmpdir.join('ts.npy'))
+    # in streaming mode, the precision is the one of ts_file
+    np.save(ts_file, make_epochs().astype(precision))
+    monkeypatch.chdir(tmpdir)
+    spectral_conn = SpectralConn(ts_file=ts_file, sfreq=sfreq, freq_bands=freq_bands,
+                                 con_method=con_method, streaming=streaming,
+                                 chunk_size=4, precision=precision)
+    conmats = np.load(spectral_conn.run().outputs.stacked_conmat_file)
+    dtype = np.result_type(np.dtype(precision), np.complex64) if con_method == 'cohy' else np.dtype(precision)
+    assert conmats.dtype == dtype
+    assert np.allclose(conmats, compute_spectral_connectivity_bands(make_epochs(), con_method, sfreq, freq_bands),
+                       rtol=0, atol=1e-5)
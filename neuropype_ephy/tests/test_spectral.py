@@ -0,0 +1,551 @@
+import multiprocessing
+import os
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from mne.connectivity import spectral_connectivity
+
+### submodules imported lazily by spectral, imported here as some tests change the current directory
+import neuropype_ephy.aux_tools
+import neuropype_ephy.morlet
+import neuropype_ephy.multitaper
+
+from neuropype_ephy.packed_conmat import save_sparse_conmat, load_conmat
+from neuropype_ephy.spectral import (batch_spectral_connectivity,
+                                     compute_spectral_connectivity_bands,
+                                     compute_and_save_spectral_connectivity,
+                                     compute_and_save_multiband_spectral_connectivity,
+                                     compute_and_save_pair_spectral_connectivity,
+                                     streaming_spectral_connectivity,
+                                     parallel_chunk_terms,
+                                     SpectralConnAccumulator,
+                                     get_pair_indices,
+                                     get_epochs_view,
+                                     parse_contact_labels,
+                                     get_adjacent_contacts_mask,
+                                     filter_adj_plot_mat,
+                                     get_top_edges,
+                                     plot_circular_connectivity_batch,
+                                     pair_spectral_connectivity,
+                                     morlet_spectral_connectivity,
+                                     surrogate_spectral_connectivity)
+
+sfreq = 100.
+freq_bands = [[8., 12.], [15., 30.]]
+
+con_methods = ['coh', 'cohy', 'imcoh', 'plv', 'ppc', 'pli', 'pli2_unbiased',
+               'wpli', 'wpli2_debiased']
+
+
+def make_epochs(n_epochs=6, n_nodes=4, n_times=200, seed=0):
+    """
+    Random epochs, with a lagged coupling between nodes 0 and 1
+    """
+    rng = np.random.RandomState(seed)
+
+    data = rng.randn(n_epochs, n_nodes, n_times)
+    data[:, 1] += np.roll(data[:, 0], 2, axis=-1)
+
+    return data
+
+
+def mne_conmats(data, con_method, **kwargs):
+    """
+    Reference conmats (n_bands, nb_nodes, nb_nodes) of mne spectral_connectivity
+    """
+    fmin = tuple([freq_band[0] for freq_band in freq_bands])
+    fmax = tuple([freq_band[1] for freq_band in freq_bands])
+
+    con = spectral_connectivity(data, method=con_method, sfreq=sfreq,
+                                fmin=fmin, fmax=fmax, faverage=True,
+                                mt_adaptive=False, verbose='ERROR',
+                                **kwargs)[0]
+
+    return np.rollaxis(np.asarray(con), 2)
+
+
+@pytest.mark.parametrize('con_method', con_methods)
+def test_batch_spectral_connectivity(con_method):
+
+    samples = np.array([make_epochs(seed=seed) for seed in range(3)])
+
+    conmats = batch_spectral_connectivity(samples, con_method, sfreq,
+                                          freq_bands, block_size=2)
+
+    for sample, sample_conmats in zip(samples, conmats):
+        assert np.allclose(sample_conmats, mne_conmats(sample, con_method))
+
+
+@pytest.mark.parametrize('con_method', con_methods)
+def test_compute_spectral_connectivity_bands(con_method):
+
+    from neuropype_ephy.multitaper import dpss_cache
+
+    data = make_epochs()
+
+    conmats = compute_spectral_connectivity_bands(data, con_method, sfreq,
+                                                  freq_bands)
+
+    assert np.allclose(conmats, mne_conmats(data, con_method))
+
+    ### tapers of the same epoch length come from the cache
+    hits = dpss_cache.hits
+    compute_spectral_connectivity_bands(data, con_method, sfreq, freq_bands)
+    assert dpss_cache.hits > hits
+
+
+@pytest.mark.parametrize('con_method', con_methods)
+def test_streaming_spectral_connectivity(con_method):
+
+    data = make_epochs(n_epochs=7)
+
+    conmats = streaming_spectral_connectivity(data, con_method, sfreq,
+                                              freq_bands, chunk_size=3)
+
+    assert np.allclose(conmats, mne_conmats(data, con_method))
+
+
+def test_streaming_spectral_connectivity_n_jobs(monkeypatch):
+
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 4)
+
+    data = make_epochs(n_epochs=9)
+
+    conmats = streaming_spectral_connectivity(data, 'coh', sfreq, freq_bands,
+                                              chunk_size=2, n_jobs=2)
+
+    assert np.allclose(conmats, mne_conmats(data, 'coh'))
+
+
+def test_parallel_chunk_terms_groups():
+
+    read_starts = []
+
+    def get_chunk(start):
+        read_starts.append(start)
+        return np.arange(start, start + 2)
+
+    results = parallel_chunk_terms(np.sum, get_chunk, range(0, 10, 2), 2)
+
+    ### the next group of chunks is read only once the previous one is consumed
+    assert next(results) == 1
+    assert read_starts == [0, 2]
+
+    assert list(results) == [5, 9, 13, 17]
+    assert read_starts == [0, 2, 4, 6, 8]
+
+
+@pytest.mark.parametrize('con_method,mode', [('coh', 'cwt_morlet'),
+                                             ('aec', 'multitaper')])
+def test_streaming_not_implemented(con_method, mode):
+
+    with pytest.raises(ValueError):
+        compute_spectral_connectivity_bands(make_epochs(), con_method, sfreq,
+                                            freq_bands, mode=mode,
+                                            chunk_size=3)
+
+
+def test_spectral_conn_accumulator(tmpdir):
+
+    data = make_epochs(n_epochs=7)
+
+    acc = SpectralConnAccumulator(sfreq, freq_bands, ['coh', 'wpli'])
+    acc.add_epochs(data[:3])
+
+    ### second session, saved and reloaded before being combined
+    other_acc = SpectralConnAccumulator(sfreq, freq_bands, ['coh', 'wpli'])
+    other_acc.add_epochs(data[3:])
+
+    acc.combine(SpectralConnAccumulator.load(
+        other_acc.save(str(tmpdir.join('acc_state.npz')))))
+
+    assert acc.n_epochs == 7
+
+    for con_method in ['coh', 'wpli']:
+        assert np.allclose(acc.compute_con(con_method),
+                           mne_conmats(data, con_method))
+
+
+@pytest.mark.parametrize('con_method', con_methods)
+def test_pair_spectral_connectivity(con_method):
+
+    data = make_epochs()
+
+    indices = (np.array([0, 3, 1]), np.array([2, 1, 0]))
+
+    con = pair_spectral_connectivity(data, con_method, sfreq, freq_bands,
+                                     indices, chunk_size=4)
+
+    ### (n_pairs, n_bands)
+    mne_con = spectral_connectivity(data, method=con_method, sfreq=sfreq,
+                                    fmin=(8., 15.), fmax=(12., 30.),
+                                    faverage=True, mt_adaptive=False,
+                                    indices=indices, verbose='ERROR')[0]
+
+    assert np.allclose(con, np.asarray(mne_con).T)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_pair_spectral_connectivity_n_jobs(n_jobs, monkeypatch):
+
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 4)
+
+    data = make_epochs(n_epochs=9)
+
+    indices = (np.array([0, 3, 1]), np.array([2, 1, 0]))
+
+    con = pair_spectral_connectivity(data, 'wpli', sfreq, freq_bands, indices,
+                                     chunk_size=2, n_jobs=n_jobs)
+
+    assert np.allclose(con, pair_spectral_connectivity(data, 'wpli', sfreq,
+                                                       freq_bands, indices))
+
+
+@pytest.mark.parametrize('con_method,mode', [('coh', 'cwt_morlet'),
+                                             ('aec', 'multitaper')])
+def test_pair_not_implemented(con_method, mode):
+
+    with pytest.raises(ValueError):
+        compute_and_save_pair_spectral_connectivity(
+            make_epochs(), con_method, sfreq, freq_bands,
+            (np.array([0]), np.array([1])), mode=mode)
+
+
+@pytest.mark.parametrize('con_method', ['coh', 'cohy', 'imcoh'])
+def test_load_sparse_conmat_orientation(con_method, tmpdir):
+
+    data = make_epochs()
+
+    ### seeds on both sides of the diagonal
+    indices = (np.array([0, 3, 1]), np.array([2, 1, 0]))
+
+    con = pair_spectral_connectivity(data, con_method, sfreq, freq_bands,
+                                     indices)
+
+    conmat = load_conmat(save_sparse_conmat(str(tmpdir.join('pairs.npz')),
+                                            indices, con, data.shape[1],
+                                            con_method))
+
+    rows, cols = [2, 3, 1], [0, 1, 0]
+
+    assert np.allclose(conmat[:, rows, cols],
+                       mne_conmats(data, con_method)[:, rows, cols])
+
+
+@pytest.mark.parametrize('con_method', ['coh', 'imcoh'])
+def test_pair_indices_load_conmat(con_method, tmpdir):
+
+    data = make_epochs()
+
+    ### several seeds with all targets, and a symmetric mask, give both
+    ### orientations of some pairs
+    mask = np.ones((4, 4), dtype=bool)
+    np.save(str(tmpdir.join('mask.npy')), mask)
+
+    for indices in [get_pair_indices(4, seed_indices=[0, 1]),
+                    get_pair_indices(4, pairs_file=str(tmpdir.join('mask.npy')))]:
+
+        pairs = set(zip(*indices))
+        assert not any((target, seed) in pairs for seed, target in pairs)
+
+        con = pair_spectral_connectivity(data, con_method, sfreq, freq_bands,
+                                         indices)
+
+        conmat = load_conmat(save_sparse_conmat(str(tmpdir.join('pairs.npz')),
+                                                indices, con, data.shape[1],
+                                                con_method))
+
+        rows, cols = np.maximum(*indices), np.minimum(*indices)
+
+        assert np.allclose(conmat[:, rows, cols],
+                           mne_conmats(data, con_method)[:, rows, cols])
+
+
+@pytest.mark.parametrize('con_method', ['coh', 'imcoh', 'plv', 'wpli'])
+def test_morlet_spectral_connectivity(con_method):
+
+    data = make_epochs()
+
+    cwt_freqs = np.arange(8., 30.)
+    cwt_n_cycles = cwt_freqs / 7.
+
+    conmats = morlet_spectral_connectivity(data, con_method, sfreq,
+                                           freq_bands, cwt_freqs=cwt_freqs,
+                                           cwt_n_cycles=cwt_n_cycles,
+                                           freq_batch_size=3,
+                                           time_block_size=50)
+
+    ### (nb_nodes, nb_nodes, n_freqs, n_times), averaged over time and bands
+    con = spectral_connectivity(data, method=con_method, sfreq=sfreq,
+                                mode='cwt_morlet', cwt_freqs=cwt_freqs,
+                                cwt_n_cycles=cwt_n_cycles,
+                                verbose='ERROR')[0].mean(axis=-1)
+
+    for band_conmat, (f_lower, f_upper) in zip(conmats, freq_bands):
+        band_mask = (cwt_freqs >= f_lower) & (cwt_freqs < f_upper)
+        assert np.allclose(band_conmat, np.tril(con[..., band_mask].mean(axis=-1), -1))
+
+
+@pytest.mark.parametrize('con_method', ['coh', 'imcoh', 'wpli'])
+def test_surrogate_spectral_connectivity(con_method):
+
+    data = make_epochs()
+
+    conmats, pvals, thresholds = surrogate_spectral_connectivity(
+        data, con_method, sfreq, freq_bands, n_surrogates=20, batch_size=7,
+        seed=0)
+
+    assert np.allclose(conmats, mne_conmats(data, con_method))
+
+    assert np.all((pvals > 0.) & (pvals <= 1.))
+    assert thresholds.shape == conmats.shape
+
+
+def naive_envelope_conmats(data, con_method):
+    """
+    aec of each pair from the Hilbert envelopes of each epoch, concatenated
+    (aec_orth: correlation with the envelope orthogonalized to the other
+    node, averaged over both directions)
+    """
+    from mne.filter import filter_data
+    from scipy.signal import hilbert
+
+    n_nodes = data.shape[1]
+
+    conmats = np.zeros((len(freq_bands), n_nodes, n_nodes))
+
+    for band_index, (f_lower, f_upper) in enumerate(freq_bands):
+
+        analytic = np.concatenate(
+            [hilbert(filter_data(epoch, sfreq, f_lower, f_upper,
+                                 verbose=False), axis=-1)
+             for epoch in data], axis=-1)
+
+        for i in range(n_nodes):
+            for j in range(i):
+                x, y = analytic[i], analytic[j]
+                if con_method == 'aec':
+                    corr = np.corrcoef(np.abs(x), np.abs(y))[0, 1]
+                else:
+                    y_orth_x = np.abs(np.imag(y * np.conj(x) / np.abs(x)))
+                    x_orth_y = np.abs(np.imag(x * np.conj(y) / np.abs(y)))
+                    corr = (np.corrcoef(np.abs(x), y_orth_x)[0, 1] +
+                            np.corrcoef(np.abs(y), x_orth_y)[0, 1]) / 2.
+                conmats[band_index, i, j] = corr
+
+    return conmats
+
+
+@pytest.mark.parametrize('con_method', ['aec', 'aec_orth'])
+def test_envelope_connectivity(con_method):
+
+    data = make_epochs(n_times=400)
+
+    conmats = compute_spectral_connectivity_bands(data, con_method, sfreq,
+                                                  freq_bands)
+
+    assert np.allclose(conmats, naive_envelope_conmats(data, con_method))
+
+
+@pytest.mark.parametrize('con_method', ['aec', 'aec_orth'])
+def test_envelope_connectivity_not_implemented(con_method):
+
+    data = make_epochs()
+
+    ### envelopes are neither streamed nor computed for a subset of pairs
+    with pytest.raises(ValueError):
+        compute_spectral_connectivity_bands(data, con_method, sfreq,
+                                            freq_bands, chunk_size=3)
+
+    with pytest.raises(ValueError):
+        compute_and_save_spectral_connectivity(data, con_method, sfreq, 8., 12.,
+                                               indices=(np.array([0]),
+                                                        np.array([1])))
+
+
+### several electrodes, multi-digit and unordered contact numbers
+contact_labels = ["A'_1", "A'_2", "A'_3", "B_9", "B_10", "B_11", "B_12",
+                  "A'_5", "A'_4", "C_2", "C_1", "C_10", "C_11", "B_13"]
+
+
+def naive_adjacent_contacts_mask(labels, k_neigh):
+    """
+    Former itertools.combinations loop of filter_adj_plot_mat
+    """
+    triu_indices = np.triu_indices(len(labels), 1)
+
+    adj_mat = np.zeros(shape=(len(labels), len(labels)), dtype=bool)
+
+    for i in range(k_neigh):
+        adj_plots = [(a[0] == b[0]) and (int(a[1]) + i + 1 == int(b[1]))
+                     for a, b in combinations(labels, 2)]
+        adj_mat[triu_indices] = adj_mat[triu_indices] + adj_plots
+
+    return adj_mat
+
+
+@pytest.mark.parametrize('k_neigh', [1, 2, 3])
+def test_adjacent_contacts_mask(k_neigh, tmpdir):
+
+    labels_file = str(tmpdir.join('labels.txt'))
+    with open(labels_file, 'w') as f:
+        f.write('\n'.join(contact_labels) + '\n')
+
+    elec_ids, contacts = parse_contact_labels(labels_file, '_')
+
+    adj_mat = get_adjacent_contacts_mask(elec_ids, contacts, k_neigh)
+
+    naive_adj_mat = naive_adjacent_contacts_mask(
+        [label.split('_') for label in contact_labels], k_neigh)
+
+    assert adj_mat.any()
+    assert np.array_equal(adj_mat, naive_adj_mat)
+
+
+def test_filter_adj_plot_mat(tmpdir, monkeypatch):
+
+    labels_file = str(tmpdir.join('labels.txt'))
+    with open(labels_file, 'w') as f:
+        f.write('\n'.join(contact_labels) + '\n')
+
+    n_nodes = len(contact_labels)
+    conmats = np.tril(np.random.RandomState(0).rand(2, n_nodes, n_nodes), -1)
+
+    conmat_files = [str(tmpdir.join('conmat_{}.npy'.format(i))) for i in range(2)]
+    for conmat_file, conmat in zip(conmat_files, conmats):
+        np.save(conmat_file, conmat)
+
+    ### former version: conmat transposed, filtered by the upper triangular mask
+    naive_adj_mat = naive_adjacent_contacts_mask(
+        [label.split('_') for label in contact_labels], 2)
+
+    monkeypatch.chdir(tmpdir)
+
+    filtered_conmat_files = filter_adj_plot_mat(conmat_files, labels_file, '_', 2)
+
+    for filtered_conmat_file, conmat in zip(filtered_conmat_files, conmats):
+        naive_filtered_conmat = np.transpose(conmat).copy()
+        naive_filtered_conmat[np.where(naive_adj_mat)] = 0.
+        assert np.array_equal(np.load(filtered_conmat_file),
+                              np.transpose(naive_filtered_conmat))
+
+    ### single file
+    assert np.array_equal(np.load(filter_adj_plot_mat(conmat_files[0], labels_file, '_', 2)),
+                          np.load(filtered_conmat_files[0]))
+
+
+@pytest.mark.parametrize('epoch_length,step', [(50, None), (50, 30), (40, 15)])
+def test_get_epochs_view(epoch_length, step, tmpdir):
+
+    ### 233 time points, trailing samples are dropped for all steps
+    raw_data = np.random.RandomState(0).randn(3, 233)
+
+    epochs = get_epochs_view(raw_data, epoch_length, step)
+
+    if step is None:
+        step = epoch_length
+
+    naive_epochs = []
+    start = 0
+    while start + epoch_length <= raw_data.shape[-1]:
+        naive_epochs.append(raw_data[:, start:start + epoch_length])
+        start += step
+
+    assert epochs.shape == (len(naive_epochs), 3, epoch_length)
+    assert np.array_equal(epochs, np.array(naive_epochs))
+    assert (len(naive_epochs) - 1) * step + epoch_length < raw_data.shape[-1]
+
+    ### strided view, no copy
+    assert np.shares_memory(epochs, raw_data)
+    assert epochs.base is not None
+    assert not epochs.flags.writeable
+
+    ### memory-mapped file
+    ts_file = str(tmpdir.join('ts.npy'))
+    np.save(ts_file, raw_data)
+
+    mmap_data = np.load(ts_file, mmap_mode='r')
+    mmap_epochs = get_epochs_view(mmap_data, epoch_length, step)
+
+    assert np.shares_memory(mmap_epochs, mmap_data)
+    assert np.array_equal(mmap_epochs, epochs)
+
+
+@pytest.mark.parametrize('con_method,mode', [('coh', 'multitaper'),
+                                             ('wpli', 'multitaper'),
+                                             ('imcoh', 'cwt_morlet'),
+                                             ('aec', 'multitaper')])
+def test_multiband_spectral_connectivity(con_method, mode, tmpdir,
+                                         monkeypatch):
+
+    data = make_epochs(n_times=400)
+
+    monkeypatch.chdir(tmpdir)
+
+    conmat_files, stacked_conmat_file = \
+        compute_and_save_multiband_spectral_connectivity(
+            data, con_method, sfreq, freq_bands,
+            freq_band_names=['alpha', 'beta'], mode=mode)
+
+    assert [os.path.basename(conmat_file) for conmat_file in conmat_files] == \
+        ['conmat_0_{}_alpha.npy'.format(con_method),
+         'conmat_0_{}_beta.npy'.format(con_method)]
+
+    stacked_conmats = np.load(stacked_conmat_file)
+
+    assert stacked_conmats.shape == (2, 4, 4)
+
+    ### band k of the single pass is the single band result
+    for k, (fmin, fmax) in enumerate(freq_bands):
+
+        band_conmat = np.load(compute_and_save_spectral_connectivity(
+            data, con_method, sfreq, fmin, fmax, index=k, mode=mode))
+
+        assert np.allclose(stacked_conmats[k], band_conmat)
+        assert np.array_equal(np.load(conmat_files[k]), stacked_conmats[k])
+
+
+def test_get_top_edges():
+
+    conmat = np.tril(np.random.RandomState(0).randn(10, 10), -1)
+
+    (rows, cols), values = get_top_edges(conmat, nb_lines=7)
+
+    ### same edges as a full sort of the lower triangle
+    tril_rows, tril_cols = np.tril_indices(10, -1)
+    top = np.argsort(np.abs(conmat[tril_rows, tril_cols]))[::-1][:7]
+
+    assert set(zip(rows, cols)) == set(zip(tril_rows[top], tril_cols[top]))
+    assert np.array_equal(values, conmat[rows, cols])
+
+    ### all edges if nb_lines is larger
+    assert len(get_top_edges(conmat, nb_lines=100)[1]) == 45
+
+
+@pytest.mark.parametrize('multi_panel', [False, True])
+def test_plot_circular_connectivity_batch(multi_panel, tmpdir, monkeypatch):
+
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+    conmats = np.tril(np.random.RandomState(0).rand(3, 6, 6), -1)
+
+    label_names = ['node_{}'.format(i) for i in range(6)]
+    node_colors = [(0.5, 0.5, 0.5, 1.)] * 6
+
+    monkeypatch.chdir(tmpdir)
+
+    plot_files = plot_circular_connectivity_batch(
+        conmats, label_names, node_colors, label_names, vmin=0., vmax=1.,
+        nb_lines=5, fnames=['alpha', 'beta', 'gamma'], multi_panel=multi_panel)
+
+    ### one panel per conmat in a single file, or one file per conmat
+    if multi_panel:
+        assert plot_files == str(tmpdir.join('circle_alpha_panels.png'))
+        assert os.path.exists(plot_files)
+    else:
+        assert plot_files == [str(tmpdir.join('circle_{}.png'.format(fname)))
+                              for fname in ['alpha', 'beta', 'gamma']]
+        assert all(os.path.exists(plot_file) for plot_file in plot_files)